@@ -0,0 +1,213 @@
+"""
+Seat allocation, independent of the database and of Telegram.
+
+allocate() takes the pending registrations of an event, its seat limit and a
+seed, and decides who gets a seat. Given the same input order and seed it
+always returns the same result, so an allocation can be replayed exactly.
+
+Priority order:
+1. Admins, plus their partner (registered or not)
+2. Neulings, plus their partner (registered or not)
+3. Everyone else in random order while seats remain; a registered partner
+   pair or a user with an unregistered partner needs two free seats
+Priority users are accepted even when this exceeds the seat limit.
+
+Registrations are held as Registrations: parallel columns indexed by
+registration position, with every partner resolved to a position once.
+The allocation works on those positions and returns one outcome per
+position, so no per-registration dicts, list copies or id sets are built.
+
+allocate_snapshot() runs the same on a compact tuple snapshot of the
+registrations, which can be sent to a worker process (see allocation_pool).
+"""
+import random
+from array import array
+from itertools import compress
+from typing import Iterable, Optional
+
+from partners import normalize_name, normalize_partner_name, resolve_positions
+
+
+# Column order of the tuples allocate_snapshot() takes: the normalized name
+# keys stored with every registration, and the partner name as typed
+SNAPSHOT_COLUMNS = ('user_id', 'name_key', 'username_key', 'is_admin', 'is_neuling', 'partner_key', 'partner_name')
+
+# Registrations.flags
+ADMIN = 1
+NEULING = 2
+
+# Registrations.partners: no partner named, or one who is not registered
+NO_PARTNER = -1
+GUEST = -2
+
+# AllocationResult.outcome
+WAITING = 0
+ACCEPTED = 1
+# Accepted together with an unregistered partner, who has a seat as well
+ACCEPTED_WITH_GUEST = 2
+
+# bytes.translate tables turning flags/outcomes into masks for compress(),
+# which selects positions without a Python-level loop
+_IS_ADMIN = bytes(value & ADMIN for value in range(256))
+_IS_NEULING = bytes(value & NEULING for value in range(256))
+_IS_WAITING = bytes(value == WAITING for value in range(256))
+
+
+class Registrations:
+    """
+    Pending registrations of one event as columns indexed by position.
+
+    user_ids[i], flags[i] (ADMIN | NEULING) and partners[i] (the position of
+    the partner's registration, NO_PARTNER or GUEST) describe the i-th
+    registration in registration order. Names are only needed to resolve
+    partners and are not kept.
+    """
+
+    __slots__ = ('user_ids', 'flags', 'partners')
+
+    def __init__(self, rows: list):
+        """rows: tuples in SNAPSHOT_COLUMNS order, as read by database.get_allocation_snapshot."""
+        # One list per column: unpacking the rows with zip(*rows) would
+        # allocate a tuple per row and trigger the garbage collector
+        self.user_ids = array('q', [row[0] for row in rows])
+        self.flags = bytearray([(ADMIN if row[3] else 0) | (NEULING if row[4] else 0) for row in rows])
+        positions = resolve_positions([row[1] for row in rows], [row[2] for row in rows], [row[5] for row in rows])
+        # A partner name that resolves to nobody (even one that normalizes
+        # to nothing, like "@") still brings a guest
+        self.partners = array('i', [
+            NO_PARTNER if not row[6] else GUEST if pos is None else pos
+            for row, pos in zip(rows, positions)
+        ])
+
+    @classmethod
+    def from_mappings(cls, registrations: Iterable) -> 'Registrations':
+        """From rows or dicts with user_id, full_name, username, is_admin, is_neuling and partner_name."""
+        return cls([(reg['user_id'], normalize_name(reg['full_name']), normalize_name(reg['username']),
+                     reg['is_admin'], reg['is_neuling'], normalize_partner_name(reg['partner_name']),
+                     reg['partner_name']) for reg in registrations])
+
+    def __len__(self):
+        return len(self.user_ids)
+
+
+class AllocationResult:
+    """
+    Outcome of an allocation: outcome[i] (WAITING, ACCEPTED or
+    ACCEPTED_WITH_GUEST) for the registration at position i, and the seats
+    used.
+
+    accepted, waiting and guests (accepted users whose unregistered partner
+    got a seat with them) are the same as sets of user ids, built on each
+    access; accepted_count is cheap.
+    """
+
+    def __init__(self, user_ids: array, outcome: bytearray, seats_taken: int, seed):
+        self.user_ids = user_ids
+        self.outcome = outcome
+        self.seats_taken = seats_taken
+        self.seed = seed
+
+    def _ids(self, *outcomes) -> set:
+        return {user_id for user_id, result in zip(self.user_ids, self.outcome) if result in outcomes}
+
+    @property
+    def accepted(self) -> set:
+        return self._ids(ACCEPTED, ACCEPTED_WITH_GUEST)
+
+    @property
+    def waiting(self) -> set:
+        return self._ids(WAITING)
+
+    @property
+    def guests(self) -> set:
+        return self._ids(ACCEPTED_WITH_GUEST)
+
+    @property
+    def accepted_count(self) -> int:
+        return len(self.outcome) - self.outcome.count(WAITING)
+
+
+def new_seed() -> int:
+    """A fresh random seed, to be logged so the allocation can be replayed."""
+    return random.SystemRandom().randrange(2 ** 32)
+
+
+def allocate(registrations: Iterable, seat_limit: int, seed: Optional[int] = None) -> AllocationResult:
+    """
+    Allocate seats for one event.
+
+    Args:
+        registrations: Pending registrations (a Registrations, or rows or
+            dicts with user_id, full_name, username, is_admin, is_neuling
+            and partner_name)
+        seat_limit: Number of seats of the event
+        seed: Seed for the random stage; None picks a fresh one
+
+    Returns:
+        AllocationResult with the outcome per registration and seats taken
+    """
+    if seed is None:
+        seed = new_seed()
+    rng = random.Random(seed)
+    regs = registrations if isinstance(registrations, Registrations) else Registrations.from_mappings(registrations)
+    flags = regs.flags
+    partners = regs.partners
+
+    outcome = bytearray(len(regs))
+    seats_taken = 0
+
+    def accept_with_partner(pos):
+        nonlocal seats_taken
+        partner = partners[pos]
+        outcome[pos] = ACCEPTED_WITH_GUEST if partner == GUEST else ACCEPTED
+        seats_taken += 2 if partner == GUEST else 1
+        if partner >= 0 and not outcome[partner]:
+            outcome[partner] = ACCEPTED
+            seats_taken += 1
+
+    # 1. Admins, 2. Neulinge, each in registration order
+    positions = range(len(outcome))
+    for mask in (_IS_ADMIN, _IS_NEULING):
+        for pos in compress(positions, flags.translate(mask)):
+            if not outcome[pos]:
+                accept_with_partner(pos)
+
+    # 3. Random
+    remaining = list(compress(positions, outcome.translate(_IS_WAITING)))
+    rng.shuffle(remaining)
+
+    for pos in remaining:
+        if seats_taken >= seat_limit:
+            break
+        if outcome[pos]:
+            continue
+
+        partner = partners[pos]
+        if partner >= 0:
+            if outcome[partner]:
+                # Partner already accepted, just accept this one
+                if seats_taken + 1 <= seat_limit:
+                    outcome[pos] = ACCEPTED
+                    seats_taken += 1
+            elif seats_taken + 2 <= seat_limit:
+                # Both need acceptance (one seat if they named themselves)
+                outcome[pos] = ACCEPTED
+                outcome[partner] = ACCEPTED
+                seats_taken += 1 if partner == pos else 2
+        elif partner == GUEST:
+            if seats_taken + 2 <= seat_limit:
+                # Partner is NOT registered (just a name), still counts as a seat
+                outcome[pos] = ACCEPTED_WITH_GUEST
+                seats_taken += 2
+        elif seats_taken + 1 <= seat_limit:
+            # Single user
+            outcome[pos] = ACCEPTED
+            seats_taken += 1
+
+    # 4. Waiting list: everyone still WAITING
+    return AllocationResult(regs.user_ids, outcome, seats_taken, seed)
+
+
+def allocate_snapshot(rows: list, seat_limit: int, seed: int) -> AllocationResult:
+    """allocate() on tuples in SNAPSHOT_COLUMNS order, as read by database.get_allocation_snapshot."""
+    return allocate(Registrations(rows), seat_limit, seed)
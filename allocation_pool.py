@@ -0,0 +1,130 @@
+"""
+Seat allocation off the event loop.
+
+Allocating a large event (building the registrations, matching partners,
+shuffling) takes about a second per 100,000 registrations. Run on the event
+loop, that stalls every other user while an admin closes registration.
+allocate() instead sends a compact tuple snapshot of the pending
+registrations (database.get_allocation_snapshot) to a worker process and
+awaits the result. Events closed at the same time are allocated in
+parallel on separate workers. Small events are allocated inline, where a
+worker round trip would cost more than the allocation itself.
+
+Workers are started with 'spawn' (the bot process has threads and an event
+loop that must not be forked) on the first large allocation.
+
+ProgressMessage keeps the admin informed while that runs, editing one
+message at most every few seconds.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import allocation
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+DEFAULT_PROCESS_THRESHOLD = 2000
+DEFAULT_PROGRESS_INTERVAL = 3.0
+# Rows pickled at a time for a worker
+CHUNK_ROWS = 5000
+
+# Set from main.py (ALLOCATION_WORKERS, ALLOCATION_PROCESS_THRESHOLD); 0 workers allocates inline
+workers = DEFAULT_WORKERS
+process_threshold = DEFAULT_PROCESS_THRESHOLD
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+def _encode(rows: list) -> list:
+    # Pickling 100,000 rows in one call holds the GIL for over 100 ms, which
+    # would stall the event loop just the same; chunks let it run in between
+    return [pickle.dumps(rows[i:i + CHUNK_ROWS], pickle.HIGHEST_PROTOCOL) for i in range(0, len(rows), CHUNK_ROWS)]
+
+
+def _allocate_encoded(chunks: list, seat_limit: int, seed: int) -> allocation.AllocationResult:
+    # Runs in the worker process
+    rows = []
+    for chunk in chunks:
+        rows.extend(pickle.loads(chunk))
+    return allocation.allocate_snapshot(rows, seat_limit, seed)
+
+
+async def allocate(rows: list, seat_limit: int, seed: Optional[int] = None) -> allocation.AllocationResult:
+    """Allocate a snapshot (allocation.SNAPSHOT_COLUMNS tuples), in a worker process if it is large."""
+    if seed is None:
+        seed = allocation.new_seed()
+    if workers < 1 or len(rows) < process_threshold:
+        return allocation.allocate_snapshot(rows, seat_limit, seed)
+    loop = asyncio.get_running_loop()
+    chunks = await loop.run_in_executor(None, _encode, rows)
+    return await loop.run_in_executor(_get_executor(), _allocate_encoded, chunks, seat_limit, seed)
+
+
+def shutdown():
+    """Stop the worker processes (call on shutdown)."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+class ProgressMessage:
+    """
+    Shows the current step of a long operation by editing one message.
+
+    edit is a coroutine function taking the new text. Nothing is edited for
+    operations that finish within `interval` seconds; after that the text
+    (with the elapsed time) is edited at most once per interval.
+
+        async with ProgressMessage(query.edit_message_text) as progress:
+            progress.step("Lade Anmeldungen...")
+    """
+
+    def __init__(self, edit, interval: float = DEFAULT_PROGRESS_INTERVAL):
+        self._edit = edit
+        self.interval = interval
+        self._text = None
+        self._started = None
+        self._task = None
+        self.edits = 0
+
+    def step(self, text: str):
+        self._text = text
+
+    async def __aenter__(self):
+        self._started = time.monotonic()
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self._text is None:
+                continue
+            elapsed = time.monotonic() - self._started
+            try:
+                await self._edit(f"{self._text} ({elapsed:.0f} s)")
+                self.edits += 1
+            except Exception as e:
+                logger.warning(f"Progress update failed: {e}")
@@ -0,0 +1,137 @@
+"""
+Async facade over database.py.
+
+SQLite calls block, so running them directly inside a handler stalls the
+asyncio event loop for every user while one write waits on fsync or a lock.
+Every function here has the same name and arguments as its counterpart in
+database.py, but runs on a single dedicated executor thread and is awaited:
+
+    import async_db as adb
+    events = await adb.get_events()
+
+A single worker thread means a single long-lived SQLite connection (see
+database.get_connection) and no writer contention inside the process.
+"""
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import database as db
+import metrics
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+# Calls that queued behind other calls for the database thread, see queue_stats()
+_QUEUE_WAIT_THRESHOLD = 0.001
+_queue_stats = {'calls': 0, 'queued': 0, 'queue_wait_seconds': 0.0}
+
+
+def _observe_db_call(name, seconds):
+    metrics.DB_SECONDS.observe(seconds, name)
+
+
+# database.py times its own calls, whichever thread makes them
+db.set_timer(_observe_db_call)
+
+
+def _timed(submitted, func, args, kwargs):
+    waited = time.perf_counter() - submitted
+    _queue_stats['calls'] += 1
+    if waited > _QUEUE_WAIT_THRESHOLD:
+        _queue_stats['queued'] += 1
+        _queue_stats['queue_wait_seconds'] += waited
+    metrics.DB_QUEUE_WAIT_SECONDS.observe(waited)
+    # Callables that are not database functions (projection.preview,
+    # waitlist._create_offers, ...) are reported under their own name; the
+    # database functions they call are then not reported separately
+    with db.timing(func.__name__):
+        return func(*args, **kwargs)
+
+
+async def run(func, *args, **kwargs):
+    """Run any callable on the database thread and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, _timed, time.perf_counter(), func, args, kwargs)
+
+
+def queue_stats():
+    """How many calls had to wait for the database thread, and for how long."""
+    return dict(_queue_stats)
+
+
+def reset_queue_stats():
+    for key in _queue_stats:
+        _queue_stats[key] = 0
+
+
+def _wrap(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    return wrapper
+
+
+def shutdown():
+    """Close the database thread's connection and stop the executor."""
+    _executor.submit(db.close_connection).result()
+    _executor.shutdown(wait=True)
+
+
+# --- Event Counters ---
+rebuild_event_counters = _wrap(db.rebuild_event_counters)
+check_event_counters = _wrap(db.check_event_counters)
+get_event_counters = _wrap(db.get_event_counters)
+get_seats_taken = _wrap(db.get_seats_taken)
+
+# --- Event Operations ---
+create_event = _wrap(db.create_event)
+get_events = _wrap(db.get_events)
+get_event = _wrap(db.get_event)
+set_event_open = _wrap(db.set_event_open)
+
+# --- Registration Operations ---
+add_registration = _wrap(db.add_registration)
+add_registrations = _wrap(db.add_registrations)
+get_max_user_id = _wrap(db.get_max_user_id)
+get_registration = _wrap(db.get_registration)
+get_user_registrations = _wrap(db.get_user_registrations)
+update_status = _wrap(db.update_status)
+update_statuses = _wrap(db.update_statuses)
+apply_allocation = _wrap(db.apply_allocation)
+get_event_registrations = _wrap(db.get_event_registrations)
+get_registrations_by_users = _wrap(db.get_registrations_by_users)
+get_pending_registrations = _wrap(db.get_pending_registrations)
+get_allocation_snapshot = _wrap(db.get_allocation_snapshot)
+get_waiting_list = _wrap(db.get_waiting_list)
+offer_seats = _wrap(db.offer_seats)
+resolve_offer = _wrap(db.resolve_offer)
+get_open_offers = _wrap(db.get_open_offers)
+set_admin = _wrap(db.set_admin)
+
+# --- User Operations ---
+upsert_user = _wrap(db.upsert_user)
+get_user_by_username = _wrap(db.get_user_by_username)
+count_users = _wrap(db.count_users)
+get_user_ids_after = _wrap(db.get_user_ids_after)
+
+# --- Bot Persistence ---
+get_persisted_user_data = _wrap(db.get_persisted_user_data)
+get_persisted_chat_data = _wrap(db.get_persisted_chat_data)
+get_persisted_conversations = _wrap(db.get_persisted_conversations)
+save_persisted_data = _wrap(db.save_persisted_data)
+
+# --- Outbox Operations ---
+enqueue_messages = _wrap(db.enqueue_messages)
+claim_due_messages = _wrap(db.claim_due_messages)
+release_claimed_messages = _wrap(db.release_claimed_messages)
+get_next_message_time = _wrap(db.get_next_message_time)
+mark_message_sent = _wrap(db.mark_message_sent)
+mark_message_failed = _wrap(db.mark_message_failed)
+reschedule_message = _wrap(db.reschedule_message)
+
+# --- Broadcast Operations ---
+create_broadcast = _wrap(db.create_broadcast)
+get_broadcast = _wrap(db.get_broadcast)
+get_running_broadcasts = _wrap(db.get_running_broadcasts)
+save_broadcast_progress = _wrap(db.save_broadcast_progress)
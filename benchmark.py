@@ -0,0 +1,975 @@
+"""
+Benchmarks for the bot's hot paths.
+
+Every benchmark runs against a throwaway SQLite file, never against eventbot.db.
+
+Usage:
+    python benchmark.py db [--ops 10000] [--seed 1]
+    python benchmark.py partners [--sizes 5000 50000] [--legacy-max 5000]
+    python benchmark.py plans
+    python benchmark.py previews [--events 150] [--max-registrations 200]
+    python benchmark.py counters [--events 100] [--max-registrations 200]
+    python benchmark.py status [--sizes 10000 100000] [--lookups 5000] [--changes 200]
+    python benchmark.py allocation [--sizes 100 10000 1000000] [--profiles default couples] [--history FILE]
+    python benchmark.py persistence [--users 100000] [--changed 100]
+    python benchmark.py updates [--modes polling webhook] [--updates 500] [--concurrency 1 32] [--latency-ms 50]
+    python benchmark.py closes [--events 2] [--registrations 100000] [--workers 0 4]
+    python benchmark.py e2e [--users 500] [--concurrency 32] [--latency-ms 50] [--jitter-ms 50] [--flood 0.02]
+    python benchmark.py broadcast [--users 5000] [--blocked 0.05] [--send-rate 30] [--stop-at 0.5]
+"""
+import argparse
+import asyncio
+import datetime
+import gc
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import allocation
+import async_db as adb
+import database as db
+import event_catalog
+from partners import PartnerIndex, normalize_partner_name
+
+
+def _use_temp_database():
+    """Point the database module at a fresh temporary file and initialise it."""
+    tmp_dir = tempfile.mkdtemp(prefix="whipbot_bench_")
+    db.DB_NAME = os.path.join(tmp_dir, "bench.db")
+    db.init_db()
+    return db.DB_NAME
+
+
+def bench_db(ops: int = 10000, seed: int = 1) -> dict:
+    """
+    Run a mixed workload of reads and writes through database.py.
+
+    Roughly 60% of the operations are reads (registration lookups, event
+    listing, /status queries) and 40% are writes (new registrations, status
+    changes, user upserts), mirroring a registration evening.
+    """
+    rng = random.Random(seed)
+    path = _use_temp_database()
+    event_ids = [db.create_event(f"Bench Event {i}", seat_limit=35) for i in range(3)]
+    for event_id in event_ids:
+        db.set_event_open(event_id, True)
+
+    registered = []
+    next_user_id = 1
+    start = time.perf_counter()
+    for _ in range(ops):
+        roll = rng.random()
+        if roll < 0.2 or not registered:
+            event_id = rng.choice(event_ids)
+            user_id = next_user_id
+            next_user_id += 1
+            db.add_registration(user_id, event_id, f"user{user_id}", f"User {user_id}", rng.random() < 0.3, None)
+            registered.append((user_id, event_id))
+        elif roll < 0.3:
+            user_id, event_id = rng.choice(registered)
+            db.update_status(user_id, event_id, rng.choice(['ACCEPTED', 'WAITING', 'CANCELLED']))
+        elif roll < 0.4:
+            user_id = rng.randint(1, next_user_id)
+            db.upsert_user(user_id, f"user{user_id}", f"User {user_id}")
+        elif roll < 0.6:
+            user_id, event_id = rng.choice(registered)
+            db.get_registration(user_id, event_id)
+        elif roll < 0.8:
+            db.get_events()
+        else:
+            user_id, _ = rng.choice(registered)
+            db.get_user_registrations(user_id)
+    elapsed = time.perf_counter() - start
+    counter_mismatches = len(db.check_event_counters())
+    db.close_all_connections()
+
+    return {
+        'ops': ops,
+        'seconds': elapsed,
+        'ops_per_second': ops / elapsed if elapsed else float('inf'),
+        'counter_mismatches': counter_mismatches,
+        'database': path,
+    }
+
+
+def synthetic_registrations(count: int, rng: random.Random, admin_ratio: float = 0.02,
+                            neuling_ratio: float = 0.3, partner_ratio: float = 0.4,
+                            registered_partner_ratio: float = 0.5) -> list:
+    """
+    Build registration dicts shaped like rows of the registrations table.
+
+    A partner_ratio share of users name a partner; registered_partner_ratio of
+    those name another registrant (by full name or @username), the rest name
+    someone who never registered.
+    """
+    regs = []
+    for i in range(count):
+        regs.append({
+            'id': i + 1,
+            'user_id': 1000000 + i,
+            'event_id': 1,
+            'username': f"user_{i}",
+            'full_name': f"Person {i}",
+            'is_admin': rng.random() < admin_ratio,
+            'is_neuling': rng.random() < neuling_ratio,
+            'partner_name': None,
+            'status': 'PENDING',
+            'registration_time': None,
+        })
+    for reg in regs:
+        if rng.random() >= partner_ratio:
+            continue
+        if rng.random() < registered_partner_ratio:
+            other = regs[rng.randrange(count)]
+            reg['partner_name'] = f"@{other['username']}" if rng.random() < 0.5 else other['full_name'].upper()
+        else:
+            reg['partner_name'] = f"Guest {reg['id']}"
+    return regs
+
+
+def _legacy_find_partner(partner_name, all_registrations):
+    # The linear scan partner matching used before PartnerIndex existed
+    key = normalize_partner_name(partner_name)
+    for reg in all_registrations:
+        if reg['full_name'].lower().strip() == key:
+            return reg
+        if reg['username'] and reg['username'].lower().strip() == key:
+            return reg
+    return None
+
+
+def _count_seats(registrations, find):
+    # Same seat count /admin_list shows: one per registration plus unregistered partners
+    count = 0
+    for reg in registrations:
+        count += 1
+        if reg['partner_name'] and not find(reg['partner_name']):
+            count += 1
+    return count
+
+
+def bench_partners(sizes=(5000, 50000), legacy_max: int = 5000, seed: int = 1) -> dict:
+    """Time the /admin_list seat count with PartnerIndex and the legacy linear scan."""
+    results = {}
+    for size in sizes:
+        regs = synthetic_registrations(size, random.Random(seed))
+
+        start = time.perf_counter()
+        index = PartnerIndex(regs)
+        seats = _count_seats(regs, index.find)
+        results[f"index_{size}_seconds"] = time.perf_counter() - start
+
+        if size <= legacy_max:
+            start = time.perf_counter()
+            legacy_seats = _count_seats(regs, lambda name: _legacy_find_partner(name, regs))
+            results[f"legacy_{size}_seconds"] = time.perf_counter() - start
+            if legacy_seats != seats:
+                raise AssertionError(f"Seat count mismatch at {size}: {legacy_seats} != {seats}")
+        results[f"seats_{size}"] = seats
+    return results
+
+
+def bench_status(sizes=(10000, 100000), lookups: int = 5000, changes: int = 200, seed: int = 1) -> dict:
+    """
+    Waiting-list positions for /status: the first lookup (which ranks the
+    list), further lookups, and lookups after `changes` people left the list
+    one at a time, compared with counting the registrations ahead in SQL.
+    """
+    import waiting_positions
+
+    rng = random.Random(seed)
+    results = {}
+    base = datetime.datetime(2026, 1, 1)
+    for size in sizes:
+        _use_temp_database()
+        event_id = db.create_event("Bench Event")
+        db.add_registrations((user_id, event_id, f"user{user_id}", f"User {user_id}", 0, None,
+                              base + datetime.timedelta(seconds=user_id // 4)) for user_id in range(1, size + 1))
+        db.update_statuses(event_id, ((user_id, 'WAITING') for user_id in range(1, size + 1)))
+        sample = [rng.randrange(1, size + 1) for _ in range(lookups)]
+
+        conn = db.get_connection()
+        count_sql = '''SELECT COUNT(*) + 1 FROM registrations w JOIN registrations r
+                        ON w.event_id = r.event_id AND w.status = 'WAITING'
+                        AND (w.registration_time, w.id) < (r.registration_time, r.id)
+                        WHERE r.user_id = ? AND r.event_id = ?'''
+        counted = sample[:200]
+        start = time.perf_counter()
+        for user_id in counted:
+            conn.execute(count_sql, (user_id, event_id)).fetchone()
+        results[f"count_query_{size}_ms"] = (time.perf_counter() - start) / len(counted) * 1000
+
+        start = time.perf_counter()
+        waiting_positions.get_positions(sample[0], [event_id])
+        results[f"rank_{size}_ms"] = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        for user_id in sample:
+            waiting_positions.get_positions(user_id, [event_id])
+        results[f"lookup_{size}_us"] = (time.perf_counter() - start) / lookups * 1e6
+
+        for user_id in rng.sample(range(1, size + 1), changes):
+            db.update_status(user_id, event_id, 'OFFERED')
+        start = time.perf_counter()
+        positions = [waiting_positions.get_positions(user_id, [event_id])[event_id] for user_id in sample]
+        results[f"lookup_after_changes_{size}_us"] = (time.perf_counter() - start) / lookups * 1e6
+        expected = {reg['user_id']: i + 1 for i, reg in enumerate(db.get_waiting_list(event_id))}
+        if positions != [expected.get(user_id) for user_id in sample]:
+            raise AssertionError(f"Waiting-list positions differ from get_waiting_list at {size}")
+        db.close_all_connections()
+    return results
+
+
+# Hot read paths and the index each one must be served by
+HOT_QUERIES = [
+    ("get_pending_registrations", lambda: db.get_pending_registrations(1), "idx_registrations_event_status_time"),
+    ("get_waiting_list", lambda: db.get_waiting_list(1), "idx_registrations_event_status_time"),
+    ("get_waiting_order", lambda: db.get_waiting_order(1), "idx_registrations_event_status_time"),
+    ("get_event_registrations", lambda: db.get_event_registrations(1), "idx_registrations_event"),
+    ("get_user_registrations", lambda: db.get_user_registrations(1), "sqlite_autoindex_registrations_1"),
+    ("get_registration", lambda: db.get_registration(1, 1), "sqlite_autoindex_registrations_1"),
+    ("get_user_by_username", lambda: db.get_user_by_username("@Someone"), "idx_users_username_lower"),
+    ("iter_event_registrations", lambda: list(db.iter_event_registrations(1, after_id=10)), "idx_registrations_event"),
+    ("get_event_counters", lambda: db.get_event_counters(1), "sqlite_autoindex_event_counters_1"),
+    ("get_seats_taken", lambda: db.get_seats_taken(1), "sqlite_autoindex_event_counters_1"),
+    ("get_user_ids_after", lambda: db.get_user_ids_after(10, 200), "INTEGER PRIMARY KEY"),
+]
+
+
+def check_query_plans() -> dict:
+    """
+    Run each hot query, capture the SQL it executes and check its
+    EXPLAIN QUERY PLAN: it must use the expected index and must not scan the
+    table or sort in a temporary B-tree.
+    """
+    _use_temp_database()
+    conn = db.get_connection()
+    results = {}
+    for name, call, index in HOT_QUERIES:
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            call()
+        finally:
+            conn.set_trace_callback(None)
+        plan = [line for sql in statements for line in db.explain_query_plan(sql)]
+        ok = (any(index in line for line in plan)
+              and not any(line.startswith("SCAN") or "TEMP B-TREE" in line for line in plan))
+        results[name] = ("ok: " if ok else "FAIL: ") + " | ".join(plan)
+    db.close_all_connections()
+    return results
+
+
+# Partner names that normalize to nothing; allocation still seats them as a guest
+_BLANK_PARTNER_NAMES = ("@", "   ", "@ ")
+
+
+def check_previews(events: int = 150, max_registrations: int = 200, seed: int = 1) -> dict:
+    """
+    Build random events through the database listeners and check each
+    /admin_preview (projection.py) against allocate(..., seat_limit=0),
+    which seats exactly the guaranteed registrations and leaves the random
+    pool waiting. Registrations are added, some made admin and some
+    cancelled; some name a partner that normalizes to nothing.
+    """
+    import projection
+
+    _use_temp_database()
+    rng = random.Random(seed)
+    base = datetime.datetime(2026, 1, 1)
+    mismatches = []
+    for n in range(events):
+        event_id = db.create_event(f"Event {n}")
+        # Loaded while empty, so every write below goes through the listener
+        projection.load(event_id)
+        regs = synthetic_registrations(rng.randrange(1, max_registrations + 1), rng,
+                                       admin_ratio=0.0, neuling_ratio=0.2)
+        for reg in regs:
+            if reg['partner_name'] is None and rng.random() < 0.1:
+                reg['partner_name'] = rng.choice(_BLANK_PARTNER_NAMES)
+        db.add_registrations((reg['user_id'], event_id, reg['username'], reg['full_name'], reg['is_neuling'],
+                              reg['partner_name'], base + datetime.timedelta(seconds=reg['id'])) for reg in regs)
+        for reg in rng.sample(regs, len(regs) // 10):
+            db.set_admin(reg['user_id'], event_id, True)
+        db.update_statuses(event_id, ((reg['user_id'], 'CANCELLED') for reg in rng.sample(regs, len(regs) // 10)))
+
+        preview = projection.preview(event_id)
+        pending = allocation.Registrations(db.get_allocation_snapshot(event_id))
+        result = allocation.allocate(pending, 0, seed)
+        waiting = [pos for pos, outcome in enumerate(result.outcome) if outcome == allocation.WAITING]
+        expected = (result.seats_taken, len(waiting),
+                    sum(2 if pending.partners[pos] == allocation.GUEST else 1 for pos in waiting))
+        got = (preview.guaranteed_seats, preview.pool_people, preview.pool_seats_needed)
+        if got != expected:
+            mismatches.append(f"event {event_id}: preview {got} != allocate {expected}")
+    db.close_all_connections()
+    results = {'events': str(events), 'mismatches': str(len(mismatches))}
+    for i, mismatch in enumerate(mismatches[:5]):
+        results[f"mismatch_{i}"] = mismatch
+    return results
+
+
+def _seats_in_use(event_id) -> int:
+    # ACCEPTED and OFFERED registrations plus the partners they name who
+    # hold no registration, counted from the rows rather than the counters
+    rows = db.get_event_registrations(event_id)
+    holders = {key for r in rows if r['status'] not in ('CANCELLED', 'DECLINED', 'EXPIRED')
+               for key in (r['name_key'], r['username_key'])}
+    return sum(1 + (1 if r['partner_name'] and r['partner_key'] not in holders else 0)
+               for r in rows if r['status'] in ('ACCEPTED', 'OFFERED'))
+
+
+def check_counters(events: int = 100, max_registrations: int = 200, seed: int = 1) -> dict:
+    """
+    Build random events, cancel some registrations (among them partners
+    others name), then allocate and check that the seats the event counters
+    report for the ACCEPTED registrations are the seats allocate() took.
+    After cancelling some of the accepted ones too, the counters are
+    checked against a full recount.
+
+    Then the freed seats are offered to the waiting list, and the seats in
+    use, recounted from the registrations, must stay within the limit.
+
+    Someone allocate() takes along as a partner does not bring a partner of
+    their own, which the per-registration counters cannot know, so people
+    named as partner name nobody themselves here.
+    """
+    import waitlist
+
+    _use_temp_database()
+    rng = random.Random(seed)
+    base = datetime.datetime(2026, 1, 1)
+    mismatches = []
+    for n in range(events):
+        regs = synthetic_registrations(rng.randrange(1, max_registrations + 1), rng,
+                                       registered_partner_ratio=0.8)
+        named = {normalize_partner_name(reg['partner_name']) for reg in regs}
+        for reg in regs:
+            if normalize_partner_name(reg['username']) in named or normalize_partner_name(reg['full_name']) in named:
+                reg['partner_name'] = None
+        seat_limit = rng.randrange(1, len(regs) + 2)
+        event_id = db.create_event(f"Event {n}", seat_limit=seat_limit)
+        db.add_registrations((reg['user_id'], event_id, reg['username'], reg['full_name'], reg['is_neuling'],
+                              reg['partner_name'], base + datetime.timedelta(seconds=reg['id'])) for reg in regs)
+        cancelled = rng.sample(regs, len(regs) // 5)
+        # Half in one bulk write, half one by one as /cancel does
+        db.update_statuses(event_id, ((reg['user_id'], 'CANCELLED') for reg in cancelled[::2]))
+        for reg in cancelled[1::2]:
+            db.update_status(reg['user_id'], event_id, 'CANCELLED')
+
+        result = allocation.allocate_snapshot(db.get_allocation_snapshot(event_id), seat_limit, seed)
+        db.apply_allocation(event_id, [(user_id, 'WAITING' if outcome == allocation.WAITING else 'ACCEPTED')
+                                       for user_id, outcome in zip(result.user_ids, result.outcome)], [])
+        seats = db.get_seats_taken(event_id, ('ACCEPTED',))
+        if seats != result.seats_taken:
+            mismatches.append(f"event {event_id}: counters {seats} accepted seats != allocate {result.seats_taken}")
+
+        accepted = sorted(result.accepted)
+        for user_id in rng.sample(accepted, len(accepted) // 5):
+            db.update_status(user_id, event_id, 'CANCELLED')
+        for mismatch in db.check_event_counters(event_id):
+            mismatches.append(f"event {event_id}: {mismatch[1]} stored {mismatch[2]} != recount {mismatch[3]}")
+
+        # The freed seats go to the waiting list; offers must not overbook
+        before = _seats_in_use(event_id)
+        waitlist._create_offers(event_id, seat_limit, time.time() + 60)
+        after = _seats_in_use(event_id)
+        if after > max(seat_limit, before):
+            mismatches.append(f"event {event_id}: offers took {after} of {seat_limit} seats")
+    db.close_all_connections()
+    results = {'events': str(events), 'mismatches': str(len(mismatches))}
+    for i, mismatch in enumerate(mismatches[:5]):
+        results[f"mismatch_{i}"] = mismatch
+    return results
+
+
+# Registration mixes for the allocation benchmark:
+# (admin_ratio, neuling_ratio, partner_ratio, registered_partner_ratio)
+ALLOCATION_PROFILES = {
+    'default': (0.02, 0.3, 0.4, 0.5),
+    'few_priority': (0.005, 0.05, 0.2, 0.5),
+    'couples': (0.02, 0.1, 0.8, 0.8),
+    'guests': (0.02, 0.1, 0.6, 0.0),
+}
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def bench_allocation(sizes=(100, 10000, 1000000), profiles=('default',), seat_ratio: float = 0.3,
+                     seed: int = 1, history: str = None) -> dict:
+    """
+    Run allocation.allocate on synthetic events of each size and profile.
+
+    Time is measured on a plain run; peak memory on a second run under
+    tracemalloc (which slows the code down, so it is not timed). The seat
+    limit is seat_ratio * size. Each measurement is appended to `history`
+    (JSON lines) together with a timestamp and the git revision, so results
+    can be compared over time.
+    """
+    results = {}
+    revision = _git_revision()
+    for profile in profiles:
+        admin_ratio, neuling_ratio, partner_ratio, registered_partner_ratio = ALLOCATION_PROFILES[profile]
+        for size in sizes:
+            regs = synthetic_registrations(size, random.Random(seed), admin_ratio, neuling_ratio,
+                                           partner_ratio, registered_partner_ratio)
+            seat_limit = max(1, int(size * seat_ratio))
+            # Don't let garbage from the previous (larger) run land in this timing
+            gc.collect()
+
+            start = time.perf_counter()
+            result = allocation.allocate(regs, seat_limit, seed)
+            elapsed = time.perf_counter() - start
+
+            tracemalloc.start()
+            allocation.allocate(regs, seat_limit, seed)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            record = {
+                'profile': profile,
+                'size': size,
+                'seat_limit': seat_limit,
+                'seconds': elapsed,
+                'registrations_per_second': size / elapsed if elapsed else float('inf'),
+                'peak_memory_mb': peak / 2 ** 20,
+                'accepted': len(result.accepted),
+                'seats_taken': result.seats_taken,
+            }
+            results[f"{profile}_{size}"] = (f"{elapsed:.4f}s, {record['registrations_per_second']:,.0f} regs/s, "
+                                            f"peak {record['peak_memory_mb']:.2f} MiB, "
+                                            f"{record['seats_taken']}/{seat_limit} seats")
+            if history:
+                record.update({'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+                               'revision': revision, 'benchmark': 'allocation'})
+                with open(history, 'a') as f:
+                    f.write(json.dumps(record) + "\n")
+    return results
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def _updates_run(api, mode: str, updates: int, concurrency: int) -> float:
+    # main pulls in python-telegram-bot; only load it for this benchmark
+    import main
+    from fake_bot_api import FakeBotAPI, message_update
+
+    application = main.build_application(FakeBotAPI.TOKEN, base_url=api.base_url, concurrent_updates=concurrency)
+    await application.initialize()
+    if mode == "webhook":
+        port = _free_port()
+        await application.updater.start_webhook(
+            listen="127.0.0.1", port=port, url_path="telegram",
+            webhook_url=f"http://127.0.0.1:{port}/telegram", secret_token="bench-secret"
+        )
+    else:
+        await application.updater.start_polling(poll_interval=0.0, timeout=5)
+    await application.start()
+
+    already_sent = len(api.sent_messages)
+    start = time.perf_counter()
+    for i in range(updates):
+        api.push_update(message_update(1000 + i, "/events" if i % 2 else "/status"))
+    done = await asyncio.get_running_loop().run_in_executor(
+        None, api.wait_for_messages, already_sent + updates, 120
+    )
+    elapsed = time.perf_counter() - start
+
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    if not done:
+        raise RuntimeError(f"{mode}: only {len(api.sent_messages) - already_sent}/{updates} replies arrived")
+    return elapsed
+
+
+def bench_updates(modes=("polling", "webhook"), updates: int = 500, concurrency_levels=(1, 32),
+                  latency_ms: float = 50.0) -> dict:
+    """
+    Feed /events and /status updates through the real Application, talking to
+    fake_bot_api instead of Telegram, and measure updates per second until
+    every reply has been sent, per delivery mode and concurrency limit.
+
+    latency_ms is added to every Bot API call; with an instant API the run is
+    pure CPU and concurrency has nothing to overlap.
+    """
+    from fake_bot_api import FakeBotAPI
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    _use_temp_database()
+    event_id = db.create_event("Bench Event", seat_limit=35)
+    db.set_event_open(event_id, True)
+
+    async def run_all():
+        # The database thread may still hold a connection to another file
+        await adb.run(db.close_connection)
+        event_catalog.invalidate()
+        results = {}
+        for mode in modes:
+            for concurrency in concurrency_levels:
+                api = FakeBotAPI(latency=latency_ms / 1000).start()
+                try:
+                    elapsed = await _updates_run(api, mode, updates, concurrency)
+                finally:
+                    api.stop()
+                results[f"{mode}_c{concurrency}"] = f"{elapsed:.2f}s, {updates / elapsed:,.0f} updates/s"
+        return results
+
+    results = asyncio.run(run_all())
+    db.close_all_connections()
+    return results
+
+
+async def _closes_run(api, event_ids: list) -> tuple:
+    import main
+    from fake_bot_api import FakeBotAPI, callback_update
+
+    application = main.build_application(FakeBotAPI.TOKEN, base_url=api.base_url)
+    await application.initialize()
+    await application.updater.start_polling(poll_interval=0.0, timeout=5)
+    await application.start()
+
+    # Event loop stalls while the closes run: how late a 10 ms sleep wakes up
+    lags = []
+
+    async def watch_loop():
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - before - 0.01)
+
+    watcher = asyncio.create_task(watch_loop())
+    start = time.perf_counter()
+    for event_id in event_ids:
+        api.push_update(callback_update(BENCH_ADMIN_ID, f"admin_close_{event_id}"))
+    while sum(1 for _, _, text in api.sent_messages if text.startswith("Zuteilung für")) < len(event_ids):
+        if time.perf_counter() - start > 600:
+            raise RuntimeError("Allocations did not finish within 10 minutes")
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    watcher.cancel()
+
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    return elapsed, max(lags), sorted(lags)[int(len(lags) * 0.99)]
+
+
+BENCH_ADMIN_ID = 999
+
+
+def bench_closes(events: int = 2, registrations: int = 100000, worker_counts=(0, 4), seed: int = 1) -> dict:
+    """
+    Close `events` events of `registrations` pending registrations each at
+    the same time through the real handlers (against fake_bot_api) and
+    measure the time until every allocation is done, and how long the event
+    loop stalled meanwhile. workers=0 allocates on the event loop.
+    """
+    import allocation_pool
+    import main  # sets allocation_pool.workers from the environment, overridden below
+    from fake_bot_api import FakeBotAPI
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    main.ADMIN_IDS = [BENCH_ADMIN_ID]
+    rng = random.Random(seed)
+    results = {}
+    for workers in worker_counts:
+        _use_temp_database()
+        event_ids = []
+        for i in range(events):
+            event_id = db.create_event(f"Bench Event {i}", seat_limit=registrations // 3)
+            rows = [(reg['user_id'], event_id, reg['username'], reg['full_name'], reg['is_neuling'],
+                     reg['partner_name'], None) for reg in synthetic_registrations(registrations, rng)]
+            db.add_registrations(rows)
+            db.set_event_open(event_id, True)
+            event_ids.append(event_id)
+
+        async def run():
+            await adb.run(db.close_connection)
+            event_catalog.invalidate()
+            api = FakeBotAPI().start()
+            try:
+                return await _closes_run(api, event_ids)
+            finally:
+                api.stop()
+
+        allocation_pool.workers = workers
+        elapsed, max_lag, p99_lag = asyncio.run(run())
+        allocation_pool.shutdown()
+        db.close_all_connections()
+        results[f"workers_{workers}"] = (f"{elapsed:.2f}s until all allocated, event loop stalled "
+                                         f"max {max_lag * 1000:.0f} ms, p99 {p99_lag * 1000:.0f} ms")
+    return results
+
+
+def bench_e2e(users: int = 500, concurrency: int = 32, latency_ms: float = 50.0, jitter_ms: float = 50.0,
+              think_ms: float = 0.0, flood_probability: float = 0.02, send_rate: float = 30.0,
+              outbox_rate: float = 25.0, seed: int = 1) -> dict:
+    """
+    A registration evening end to end, against fake_bot_api with network
+    latency and jitter:
+
+    1. `users` scripted users register through /register at the same time
+       (a third of them Neulinge, 40% with a partner, half of whom
+       registered themselves); every user taps on once the bot answered.
+    2. An admin closes the event; measured until every user has received
+       their allocation notification through the outbox, while the fake API
+       answers `flood_probability` of the sends and everything beyond
+       `send_rate` per second with 429.
+    """
+    import main
+    from fake_bot_api import FakeBotAPI, callback_update, registration_script
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    main.OUTBOX_RATE = outbox_rate
+    main.ADMIN_IDS = [BENCH_ADMIN_ID]
+    _use_temp_database()
+    event_id = db.create_event("Bench Event", seat_limit=max(1, users // 3))
+    db.set_event_open(event_id, True)
+
+    rng = random.Random(seed)
+    user_ids = [3000000 + i for i in range(users)]
+    scripts = {}
+    for user_id in user_ids:
+        partner_name = None
+        if rng.random() < 0.4:
+            # fake_bot_api users are called "User <id>" with username user<id>
+            partner_name = f"@user{rng.choice(user_ids)}" if rng.random() < 0.5 else f"Gast {user_id}"
+        scripts[user_id] = registration_script(user_id, is_neuling=rng.random() < 0.3, partner_name=partner_name)
+    steps = sum(len(script) for script in scripts.values())
+
+    async def run():
+        await adb.run(db.close_connection)
+        event_catalog.invalidate()
+        api = FakeBotAPI(latency=latency_ms / 1000, jitter=jitter_ms / 1000, seed=seed).start()
+        application = main.build_application(FakeBotAPI.TOKEN, base_url=api.base_url, concurrent_updates=concurrency)
+        await application.initialize()
+        await application.updater.start_polling(poll_interval=0.0, timeout=5)
+        await application.start()
+        # Only run_polling() calls these; the outbox delivers the notifications
+        await main.post_init(application)
+        loop = asyncio.get_running_loop()
+        results = {}
+        try:
+            start = time.perf_counter()
+            api.play(scripts, think_time=think_ms / 1000)
+            if not await loop.run_in_executor(None, api.wait_for_scripts, 300):
+                raise RuntimeError(f"{api.scripts_running()} of {users} users did not finish registering")
+            elapsed = time.perf_counter() - start
+            step_seconds = sorted(api.step_seconds)
+            results['registration'] = (f"{elapsed:.2f}s, {steps / elapsed:,.0f} updates/s, "
+                                       f"step p50 {step_seconds[len(step_seconds) // 2] * 1000:.0f} ms, "
+                                       f"p95 {step_seconds[int(len(step_seconds) * 0.95)] * 1000:.0f} ms")
+
+            api.flood_probability = flood_probability
+            api.send_rate = send_rate
+            sent_before = len(api.sent_messages)
+            waiting = set(user_ids)
+            start = time.perf_counter()
+            api.push_update(callback_update(BENCH_ADMIN_ID, f"admin_close_{event_id}"))
+            while waiting:
+                if time.perf_counter() - start > 600:
+                    raise RuntimeError(f"{len(waiting)} users were not notified within 10 minutes")
+                await asyncio.sleep(0.02)
+                for _, chat_id, _ in api.sent_messages[sent_before:]:
+                    waiting.discard(chat_id)
+                sent_before = len(api.sent_messages)
+            elapsed = time.perf_counter() - start
+            results['fan_out'] = (f"{elapsed:.2f}s until all {users} users were notified, "
+                                  f"{users / elapsed:,.1f} messages/s, {api.floods} answered with 429")
+        finally:
+            await application.updater.stop()
+            await main.post_stop(application)
+            await application.stop()
+            await application.shutdown()
+            api.stop()
+        return results
+
+    results = asyncio.run(run())
+    db.close_all_connections()
+    return results
+
+
+def bench_broadcast(users: int = 5000, blocked: float = 0.05, latency_ms: float = 50.0, jitter_ms: float = 50.0,
+                    send_rate: float = 30.0, outbox_rate: float = 25.0, stop_at: float = 0.5, seed: int = 1) -> dict:
+    """
+    An /admin_broadcast to `users` known users against fake_bot_api, of whom
+    a share `blocked` blocked the bot. The bot is stopped once `stop_at` of
+    them were reached and started again, which has to resume the broadcast
+    from its checkpoint; reports the totals and how many users got the
+    message twice.
+    """
+    import broadcast
+    import main
+    from fake_bot_api import FakeBotAPI
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    main.OUTBOX_RATE = outbox_rate
+    _use_temp_database()
+    rng = random.Random(seed)
+    user_ids = [4000000 + i for i in range(users)]
+    with db.transaction() as c:
+        c.executemany("INSERT INTO users (user_id, username, full_name) VALUES (?, ?, ?)",
+                      ((user_id, f"user{user_id}", f"User {user_id}") for user_id in user_ids))
+
+    async def run_bot(api, until):
+        application = main.build_application(FakeBotAPI.TOKEN, base_url=api.base_url)
+        await application.initialize()
+        await application.start()
+        # Only run_polling() calls these; post_init resumes unfinished broadcasts
+        await main.post_init(application)
+        try:
+            await until()
+        finally:
+            await main.post_stop(application)
+            await application.stop()
+            await application.shutdown()
+
+    async def run():
+        await adb.run(db.close_connection)
+        api = FakeBotAPI(latency=latency_ms / 1000, jitter=jitter_ms / 1000, send_rate=send_rate, seed=seed).start()
+        api.blocked_chats = set(rng.sample(user_ids, int(users * blocked)))
+        loop = asyncio.get_running_loop()
+        broadcast_id = None
+
+        async def until_stop_at():
+            nonlocal broadcast_id
+            broadcast_id = await broadcast.begin("Neues Event!", BENCH_ADMIN_ID)
+            await loop.run_in_executor(None, api.wait_for_messages, int(users * stop_at * (1 - blocked)), 600)
+
+        async def until_done():
+            while not any(chat_id == BENCH_ADMIN_ID for _, chat_id, _ in api.sent_messages):
+                await asyncio.sleep(0.05)
+
+        try:
+            start = time.perf_counter()
+            await run_bot(api, until_stop_at)
+            checkpoint = await adb.get_broadcast(broadcast_id)
+            await run_bot(api, until_done)
+            elapsed = time.perf_counter() - start
+        finally:
+            api.stop()
+
+        row = await adb.get_broadcast(broadcast_id)
+        received = {}
+        for _, chat_id, _ in api.sent_messages:
+            if chat_id != BENCH_ADMIN_ID:
+                received[chat_id] = received.get(chat_id, 0) + 1
+        return {
+            'broadcast': f"{elapsed:.2f}s for {users} users, {users / elapsed:,.1f} sends/s, {api.floods} answered with 429",
+            'totals': f"{row['delivered']} delivered, {row['blocked']} blocked, {row['failed']} failed ({row['status']})",
+            'restart': (f"stopped at {checkpoint['delivered'] + checkpoint['blocked'] + checkpoint['failed']} "
+                        f"checkpointed users, {sum(1 for n in received.values() if n > 1)} users got it twice"),
+            'missed': str(len(set(user_ids) - api.blocked_chats - set(received))),
+        }
+
+    results = asyncio.run(run())
+    db.close_all_connections()
+    return results
+
+
+def bench_persistence(users: int = 100000, changed: int = 100) -> dict:
+    """
+    Compare SQLitePersistence with PTB's PicklePersistence on a bot that
+    knows `users` users: the start-up load, and persisting a run in which
+    `changed` of them updated their registration state.
+    """
+    from telegram.ext import PicklePersistence
+    from persistence import SQLitePersistence
+
+    _use_temp_database()
+    pickle_path = os.path.join(os.path.dirname(db.DB_NAME), "persistence.pickle")
+    user_data = {'event_id': 1, 'event_name': "Bench Event", 'is_neuling': False}
+    changed_ids = random.Random(1).sample(range(1, users + 1), min(changed, users))
+
+    async def run():
+        await adb.run(db.close_connection)
+        results = {}
+
+        await adb.save_persisted_data([(user_id, json.dumps(user_data)) for user_id in range(1, users + 1)])
+        sqlite = SQLitePersistence()
+        start = time.perf_counter()
+        await sqlite.get_user_data()
+        await sqlite.get_conversations("registration")
+        results['sqlite_startup_seconds'] = time.perf_counter() - start
+        start = time.perf_counter()
+        for user_id in changed_ids:
+            data = {}
+            await sqlite.refresh_user_data(user_id, data)
+            data['is_neuling'] = True
+            await sqlite.update_user_data(user_id, data)
+        await sqlite.flush()
+        results['sqlite_persist_seconds'] = time.perf_counter() - start
+        results['sqlite_rows_written'] = sqlite.rows_written
+
+        seed = PicklePersistence(pickle_path, on_flush=True)
+        await seed.get_user_data()
+        for user_id in range(1, users + 1):
+            await seed.update_user_data(user_id, dict(user_data))
+        await seed.flush()
+        pickle = PicklePersistence(pickle_path, on_flush=True)
+        start = time.perf_counter()
+        await pickle.get_user_data()
+        await pickle.get_conversations("registration")
+        results['pickle_startup_seconds'] = time.perf_counter() - start
+        start = time.perf_counter()
+        for user_id in changed_ids:
+            await pickle.update_user_data(user_id, dict(user_data, is_neuling=True))
+        await pickle.flush()
+        results['pickle_persist_seconds'] = time.perf_counter() - start
+        results['pickle_file_mb'] = os.path.getsize(pickle_path) / 2 ** 20
+        return results
+
+    results = asyncio.run(run())
+    db.close_all_connections()
+    return results
+
+
+def _print_result(name: str, result: dict):
+    print(f"[{name}]")
+    for key, value in result.items():
+        if isinstance(value, float):
+            value = f"{value:.4f}"
+        print(f"  {key}: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WhipBot benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_db = sub.add_parser("db", help="Mixed read/write workload through database.py")
+    p_db.add_argument("--ops", type=int, default=10000)
+    p_db.add_argument("--seed", type=int, default=1)
+
+    p_partners = sub.add_parser("partners", help="Partner resolution for /admin_list seat counts")
+    p_partners.add_argument("--sizes", type=int, nargs="+", default=[5000, 50000])
+    p_partners.add_argument("--legacy-max", type=int, default=5000,
+                            help="Largest size to also time with the O(n^2) linear scan")
+    p_partners.add_argument("--seed", type=int, default=1)
+
+    sub.add_parser("plans", help="Check that hot queries are served by indexes")
+
+    p_previews = sub.add_parser("previews", help="Check /admin_preview against the allocation it predicts")
+    p_previews.add_argument("--events", type=int, default=150)
+    p_previews.add_argument("--max-registrations", type=int, default=200)
+    p_previews.add_argument("--seed", type=int, default=1)
+
+    p_counters = sub.add_parser("counters", help="Check the event counters against allocation and waiting-list "
+                                                 "offers after cancellations")
+    p_counters.add_argument("--events", type=int, default=100)
+    p_counters.add_argument("--max-registrations", type=int, default=200)
+    p_counters.add_argument("--seed", type=int, default=1)
+
+    p_status = sub.add_parser("status", help="Waiting-list positions for /status")
+    p_status.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    p_status.add_argument("--lookups", type=int, default=5000)
+    p_status.add_argument("--changes", type=int, default=200, help="People leaving the list before the last lookups")
+    p_status.add_argument("--seed", type=int, default=1)
+
+    p_alloc = sub.add_parser("allocation", help="Seat allocation engine at scale")
+    p_alloc.add_argument("--sizes", type=int, nargs="+", default=[100, 10000, 1000000])
+    p_alloc.add_argument("--profiles", nargs="+", default=list(ALLOCATION_PROFILES),
+                         choices=list(ALLOCATION_PROFILES))
+    p_alloc.add_argument("--seat-ratio", type=float, default=0.3, help="Seat limit as a share of registrations")
+    p_alloc.add_argument("--seed", type=int, default=1)
+    p_alloc.add_argument("--history", default="bench_history.jsonl",
+                         help="JSON lines file results are appended to ('' to disable)")
+
+    p_persistence = sub.add_parser("persistence", help="SQLite vs pickle persistence of handler state")
+    p_persistence.add_argument("--users", type=int, default=100000)
+    p_persistence.add_argument("--changed", type=int, default=100)
+
+    p_updates = sub.add_parser("updates", help="End-to-end update throughput against a local fake Bot API")
+    p_updates.add_argument("--modes", nargs="+", default=["polling", "webhook"], choices=["polling", "webhook"])
+    p_updates.add_argument("--updates", type=int, default=500)
+    p_updates.add_argument("--concurrency", type=int, nargs="+", default=[1, 32],
+                           help="concurrent_updates limits to compare")
+    p_updates.add_argument("--latency-ms", type=float, default=50.0, help="Simulated Bot API round trip")
+
+    p_closes = sub.add_parser("closes", help="Closing large events at once: allocation time and event loop stalls")
+    p_closes.add_argument("--events", type=int, default=2)
+    p_closes.add_argument("--registrations", type=int, default=100000)
+    p_closes.add_argument("--workers", type=int, nargs="+", default=[0, 4],
+                          help="allocation_pool worker counts to compare (0: on the event loop)")
+    p_closes.add_argument("--seed", type=int, default=1)
+
+    p_e2e = sub.add_parser("e2e", help="Registrations and allocation fan-out against a fake Bot API with "
+                                       "latency and flood control")
+    p_e2e.add_argument("--users", type=int, default=500)
+    p_e2e.add_argument("--concurrency", type=int, default=32)
+    p_e2e.add_argument("--latency-ms", type=float, default=50.0, help="Simulated Bot API round trip")
+    p_e2e.add_argument("--jitter-ms", type=float, default=50.0, help="Random extra latency of up to this much")
+    p_e2e.add_argument("--think-ms", type=float, default=0.0, help="Random pause of up to this much between taps")
+    p_e2e.add_argument("--flood", type=float, default=0.02, help="Share of sends answered with 429 during fan-out")
+    p_e2e.add_argument("--send-rate", type=float, default=30.0, help="Sends per second before 429 during fan-out")
+    p_e2e.add_argument("--outbox-rate", type=float, default=25.0, help="OUTBOX_RATE of the bot")
+    p_e2e.add_argument("--seed", type=int, default=1)
+
+    p_broadcast = sub.add_parser("broadcast", help="/admin_broadcast against a fake Bot API, restarted halfway")
+    p_broadcast.add_argument("--users", type=int, default=5000)
+    p_broadcast.add_argument("--blocked", type=float, default=0.05, help="Share of users who blocked the bot")
+    p_broadcast.add_argument("--latency-ms", type=float, default=50.0, help="Simulated Bot API round trip")
+    p_broadcast.add_argument("--jitter-ms", type=float, default=50.0, help="Random extra latency of up to this much")
+    p_broadcast.add_argument("--send-rate", type=float, default=30.0, help="Sends per second before 429")
+    p_broadcast.add_argument("--outbox-rate", type=float, default=25.0, help="OUTBOX_RATE of the bot")
+    p_broadcast.add_argument("--stop-at", type=float, default=0.5, help="Share of users reached before the restart")
+    p_broadcast.add_argument("--seed", type=int, default=1)
+
+    args = parser.parse_args()
+    if args.command == "db":
+        _print_result("db", bench_db(args.ops, args.seed))
+    elif args.command == "partners":
+        _print_result("partners", bench_partners(args.sizes, args.legacy_max, args.seed))
+    elif args.command == "status":
+        _print_result("status", bench_status(args.sizes, args.lookups, args.changes, args.seed))
+    elif args.command == "allocation":
+        _print_result("allocation", bench_allocation(args.sizes, args.profiles, args.seat_ratio,
+                                                     args.seed, args.history or None))
+    elif args.command == "persistence":
+        _print_result("persistence", bench_persistence(args.users, args.changed))
+    elif args.command == "updates":
+        _print_result("updates", bench_updates(args.modes, args.updates, args.concurrency,
+                                                      args.latency_ms))
+    elif args.command == "closes":
+        _print_result("closes", bench_closes(args.events, args.registrations, args.workers, args.seed))
+    elif args.command == "e2e":
+        _print_result("e2e", bench_e2e(args.users, args.concurrency, args.latency_ms, args.jitter_ms, args.think_ms,
+                                       args.flood, args.send_rate, args.outbox_rate, args.seed))
+    elif args.command == "broadcast":
+        _print_result("broadcast", bench_broadcast(args.users, args.blocked, args.latency_ms, args.jitter_ms,
+                                                   args.send_rate, args.outbox_rate, args.stop_at, args.seed))
+    elif args.command == "previews":
+        results = check_previews(args.events, args.max_registrations, args.seed)
+        _print_result("previews", results)
+        if results['mismatches'] != "0":
+            sys.exit(1)
+    elif args.command == "counters":
+        results = check_counters(args.events, args.max_registrations, args.seed)
+        _print_result("counters", results)
+        if results['mismatches'] != "0":
+            sys.exit(1)
+    elif args.command == "plans":
+        results = check_query_plans()
+        _print_result("plans", results)
+        if any(value.startswith("FAIL") for value in results.values()):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
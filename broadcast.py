@@ -0,0 +1,216 @@
+"""
+Admin broadcasts to every known user, resumable across restarts.
+
+A broadcast is a row in the `broadcasts` table. Recipients are streamed from
+the users table in user_id order, one page at a time
+(database.get_user_ids_after), so the full user list is never held in
+memory. Sends run concurrently and share the outbox's global rate limiter,
+which keeps broadcasts and allocation notifications together within
+Telegram's send limit. A send that keeps failing, or keeps hitting flood
+control, is given up after a bounded number of tries, and no more than a few
+times the concurrency in sends are ever in flight or waiting to be counted.
+
+After each page, and when the bot stops, the broadcast is checkpointed: the
+highest user id up to which every send has finished, plus the
+delivered/blocked/failed totals. A restarted bot resumes running broadcasts from their checkpoint
+(resume_broadcasts), so at most the sends after it are repeated (delivery is
+at-least-once). When a broadcast finishes, its creator gets the totals
+through the outbox.
+"""
+import asyncio
+import collections
+import logging
+from typing import Optional
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+import async_db as adb
+import metrics
+import outbox
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_PAGE_SIZE = 200
+DEFAULT_MAX_ATTEMPTS = 3
+MAX_BACKOFF_SECONDS = 60
+# Flood-control pauses one send waits out before it counts as failed
+MAX_FLOOD_WAITS = 10
+# Sends started but not yet folded into the checkpoint, as a multiple of the
+# concurrency; beyond that no new sends start until the oldest one is done
+MAX_BACKLOG_FACTOR = 4
+
+# Outcomes of one send, counted per broadcast
+DELIVERED = 'delivered'
+# The user blocked the bot or deleted their account
+BLOCKED = 'blocked'
+FAILED = 'failed'
+
+
+class Broadcaster:
+    """Runs broadcasts as background tasks, all within one concurrency limit."""
+
+    def __init__(self, bot, rate_limiter: Optional[outbox.RateLimiter] = None,
+                 concurrency: int = DEFAULT_CONCURRENCY, page_size: int = DEFAULT_PAGE_SIZE,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self.bot = bot
+        self.page_size = page_size
+        self.max_attempts = max_attempts
+        self._rate = rate_limiter or outbox.RateLimiter(outbox.DEFAULT_RATE)
+        self._slots = asyncio.Semaphore(concurrency)
+        self._max_backlog = MAX_BACKLOG_FACTOR * concurrency
+        # broadcast id -> task
+        self._tasks = {}
+
+    @property
+    def running(self) -> list:
+        """Ids of the broadcasts being sent right now."""
+        return sorted(self._tasks)
+
+    def run(self, row):
+        """Send (or continue sending) the broadcast in `row`, a broadcasts table row."""
+        if row['id'] in self._tasks:
+            return
+        task = asyncio.create_task(self._run(row), name=f"broadcast-{row['id']}")
+        self._tasks[row['id']] = task
+        task.add_done_callback(lambda _: self._tasks.pop(row['id'], None))
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, row):
+        broadcast_id = row['id']
+        totals = {DELIVERED: row['delivered'], BLOCKED: row['blocked'], FAILED: row['failed']}
+        checkpoint = row['last_user_id']
+        cursor = checkpoint
+        # (user_id, send task) in user_id order; the finished ones at the
+        # front are folded into the totals and move the checkpoint
+        sends = collections.deque()
+
+        def collect():
+            nonlocal checkpoint
+            while sends and sends[0][1].done():
+                user_id, task = sends.popleft()
+                totals[task.result()] += 1
+                checkpoint = user_id
+
+        try:
+            while True:
+                user_ids = await adb.get_user_ids_after(cursor, self.page_size)
+                if not user_ids:
+                    break
+                cursor = user_ids[-1]
+                for user_id in user_ids:
+                    # Finished sends stay queued behind a slow one (retries,
+                    # flood control); wait for it rather than read on
+                    while len(sends) >= self._max_backlog:
+                        await asyncio.wait([sends[0][1]])
+                        collect()
+                    # Taken here rather than in _send, so only `concurrency`
+                    # sends exist at a time instead of a whole page of them
+                    await self._slots.acquire()
+                    sends.append((user_id, asyncio.create_task(self._send(user_id, row['text']))))
+                    collect()
+                await adb.save_broadcast_progress(broadcast_id, checkpoint, **totals)
+
+            await asyncio.gather(*(task for _, task in sends))
+            collect()
+            await adb.save_broadcast_progress(broadcast_id, checkpoint, finished=True, **totals)
+        except asyncio.CancelledError:
+            # Stopped with the bot: keep what finished, the next start resumes
+            # after it and repeats only the sends cut off here
+            collect()
+            for _, task in sends:
+                task.cancel()
+            await asyncio.gather(*(task for _, task in sends), return_exceptions=True)
+            await adb.save_broadcast_progress(broadcast_id, checkpoint, **totals)
+            raise
+        except Exception:
+            logger.exception(f"Broadcast {broadcast_id} stopped, resuming on the next start")
+            return
+
+        logger.info(f"Broadcast {broadcast_id} finished: {totals[DELIVERED]} delivered, "
+                    f"{totals[BLOCKED]} blocked, {totals[FAILED]} failed")
+        if row['created_by']:
+            await adb.enqueue_messages([(row['created_by'], report(broadcast_id, totals), None)])
+            outbox.wake()
+
+    async def _send(self, chat_id, text) -> str:
+        try:
+            attempts = 0
+            flood_waits = 0
+            while True:
+                await self._rate.acquire()
+                try:
+                    await self.bot.send_message(chat_id=chat_id, text=text)
+                except RetryAfter as e:
+                    flood_waits += 1
+                    if flood_waits > MAX_FLOOD_WAITS:
+                        logger.warning(f"Giving up on broadcast to {chat_id} after {MAX_FLOOD_WAITS} flood-control pauses")
+                        outcome = FAILED
+                        break
+                    # Flood control is global to the bot: slow everything down
+                    logger.warning(f"Flood control hit, pausing sends for {e.retry_after}s")
+                    self._rate.pause(e.retry_after)
+                except Forbidden:
+                    outcome = BLOCKED
+                    break
+                except BadRequest as e:
+                    logger.warning(f"Broadcast to {chat_id} failed: {e}")
+                    outcome = FAILED
+                    break
+                except Exception as e:
+                    attempts += 1
+                    if attempts >= self.max_attempts:
+                        logger.warning(f"Giving up on broadcast to {chat_id} after {attempts} attempts: {e}")
+                        outcome = FAILED
+                        break
+                    await asyncio.sleep(min(2 ** attempts, MAX_BACKOFF_SECONDS))
+                else:
+                    outcome = DELIVERED
+                    break
+            metrics.BROADCAST_MESSAGES.inc(outcome)
+            return outcome
+        finally:
+            self._slots.release()
+
+
+def report(broadcast_id, totals) -> str:
+    return (f"📣 Rundnachricht #{broadcast_id} abgeschlossen: {totals[DELIVERED]} zugestellt, "
+            f"{totals[BLOCKED]} blockiert, {totals[FAILED]} fehlgeschlagen.")
+
+
+_broadcaster: Optional[Broadcaster] = None
+
+
+def start(bot, **config) -> Broadcaster:
+    """Create the process-wide broadcaster (call from Application.post_init)."""
+    global _broadcaster
+    if _broadcaster is None:
+        _broadcaster = Broadcaster(bot, **config)
+    return _broadcaster
+
+
+async def stop():
+    global _broadcaster
+    if _broadcaster is not None:
+        await _broadcaster.stop()
+        _broadcaster = None
+
+
+async def resume_broadcasts() -> int:
+    """Continue every broadcast a previous run left unfinished; returns how many."""
+    rows = await adb.get_running_broadcasts()
+    for row in rows:
+        _broadcaster.run(row)
+    return len(rows)
+
+
+async def begin(text: str, created_by: int) -> int:
+    """Store a new broadcast and start sending it; returns its id."""
+    broadcast_id = await adb.create_broadcast(text, created_by)
+    _broadcaster.run(await adb.get_broadcast(broadcast_id))
+    return broadcast_id
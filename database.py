@@ -1,22 +1,238 @@
 import sqlite3
 import datetime
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import query_profiler
+from partners import normalize_name, normalize_partner_name
 
 DB_NAME = "eventbot.db"
 
-def get_connection():
-    conn = sqlite3.connect(DB_NAME)
+# Connections are long-lived and owned by the thread that opened them (sqlite3
+# objects must not be shared across threads). Each one is tuned once on open.
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+)
+_STATEMENT_CACHE_SIZE = 256
+
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+
+# Callbacks told about committed writes, see add_listener()
+_listeners = []
+
+# Write-lock contention, see lock_stats()
+_LOCK_WAIT_THRESHOLD = 0.001
+_lock_stats = {'transactions': 0, 'lock_waits': 0, 'lock_wait_seconds': 0.0, 'lock_errors': 0}
+
+# Told how long database calls take, see set_timer()
+_timer = None
+
+def _open_connection():
+    # isolation_level=None: we issue BEGIN/COMMIT ourselves in transaction()
+    # DB_PROFILE=1 times every statement, see query_profiler.py
+    factory = query_profiler.ProfilingConnection if query_profiler.enabled else sqlite3.Connection
+    conn = sqlite3.connect(DB_NAME, isolation_level=None, cached_statements=_STATEMENT_CACHE_SIZE,
+                           factory=factory)
     conn.row_factory = sqlite3.Row
+    for pragma in _PRAGMAS:
+        conn.execute(pragma)
     return conn
 
-def init_db():
+def get_connection():
+    """Return this thread's connection, opening it on first use."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.db_name != DB_NAME:
+        if conn is not None:
+            close_connection()
+        conn = _open_connection()
+        _local.conn = conn
+        _local.db_name = DB_NAME
+        _local.depth = 0
+        _local.pending_notifications = []
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+def close_connection():
+    """Close the calling thread's connection, if any."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        return
+    _local.conn = None
+    with _connections_lock:
+        if conn in _connections:
+            _connections.remove(conn)
+    conn.close()
+
+def close_all_connections():
+    """Close every connection opened by this module (call on shutdown)."""
+    with _connections_lock:
+        conns = list(_connections)
+        _connections.clear()
+    for conn in conns:
+        try:
+            conn.close()
+        except sqlite3.ProgrammingError:
+            # Owned by another thread; it is closed when that thread exits
+            pass
+    _local.conn = None
+
+@contextmanager
+def transaction():
+    """
+    Run a block of statements atomically and yield a cursor.
+
+    Commits on success and rolls back on any exception, including a failed
+    COMMIT. Nested calls join the outermost transaction, so helpers can be
+    composed freely.
+    """
     conn = get_connection()
-    c = conn.cursor()
-    
-    # Drop existing tables for clean slate (as per plan)
-    c.execute("DROP TABLE IF EXISTS registrations")
-    c.execute("DROP TABLE IF EXISTS events")
-    c.execute("DROP TABLE IF EXISTS settings")
+    if _local.depth:
+        _local.depth += 1
+        try:
+            yield conn.cursor()
+        finally:
+            _local.depth -= 1
+        return
+
+    # Reported as 'transaction' when opened outside the timed functions,
+    # e.g. by waitlist._create_offers
+    with timing('transaction'):
+        yield from _outermost_transaction(conn)
+
+def _outermost_transaction(conn):
+    started = time.perf_counter()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+    except sqlite3.OperationalError as e:
+        if 'locked' in str(e):
+            _lock_stats['lock_errors'] += 1
+        raise
+    waited = time.perf_counter() - started
+    _lock_stats['transactions'] += 1
+    if waited > _LOCK_WAIT_THRESHOLD:
+        # Another connection held the write lock
+        _lock_stats['lock_waits'] += 1
+        _lock_stats['lock_wait_seconds'] += waited
+    _local.depth = 1
+    try:
+        yield conn.cursor()
+    except BaseException:
+        _local.depth = 0
+        _local.pending_notifications = []
+        conn.execute("ROLLBACK")
+        raise
+    _local.depth = 0
+    try:
+        conn.execute("COMMIT")
+    except BaseException as e:
+        # A failed COMMIT (e.g. 'database is locked') leaves the transaction
+        # open; roll it back so the next write on this thread starts clean
+        if isinstance(e, sqlite3.OperationalError) and 'locked' in str(e):
+            _lock_stats['lock_errors'] += 1
+        _local.pending_notifications = []
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    pending, _local.pending_notifications = _local.pending_notifications, []
+    for kind, data in pending:
+        _dispatch(kind, data)
+
+def set_timer(callback):
+    """
+    Have callback(name, seconds) told how long each database call took.
 
+    Every public function below is timed, on whichever thread calls it
+    (async_db's thread, commit listeners, the allocation workers' parent),
+    and so is a transaction() opened outside of them. Only the outermost
+    call on a thread is reported, so nested calls are not counted twice.
+    """
+    global _timer
+    _timer = callback
+
+@contextmanager
+def timing(name):
+    """Report the block to the timer as `name`, unless an enclosing call already is."""
+    if _timer is None or getattr(_local, 'timing', False):
+        yield
+        return
+    _local.timing = True
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _local.timing = False
+        _timer(name, time.perf_counter() - started)
+
+def _timed(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _timer is None or getattr(_local, 'timing', False):
+            return func(*args, **kwargs)
+        _local.timing = True
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.timing = False
+            _timer(func.__name__, time.perf_counter() - started)
+    return wrapper
+
+def lock_stats():
+    """
+    Counters of write-lock contention since start (or the last reset):
+    transactions started, how many waited for another connection's write
+    lock (and for how long in total), and how many gave up with
+    'database is locked'.
+    """
+    return dict(_lock_stats)
+
+def reset_lock_stats():
+    for key in _lock_stats:
+        _lock_stats[key] = 0
+
+def add_listener(callback):
+    """
+    Register callback(kind, data) to be told about committed writes.
+
+    Callbacks run on the thread that made the write, right after its
+    transaction commits; writes that roll back are never reported. Kinds:
+    'event_changed' (data: event_id), and 'registration_added',
+    'status_changed' and 'admin_changed' (data: event_id, user_ids).
+    """
+    _listeners.append(callback)
+
+def remove_listener(callback):
+    if callback in _listeners:
+        _listeners.remove(callback)
+
+def _notify(kind, **data):
+    # Called inside transaction(); delivered once the transaction commits
+    _local.pending_notifications.append((kind, data))
+
+def _dispatch(kind, data):
+    for callback in list(_listeners):
+        try:
+            callback(kind, data)
+        except Exception:
+            logging.exception(f"Database listener failed for {kind}")
+
+# --- Schema ---
+#
+# The schema is built by numbered migrations. init_db() applies the ones a
+# database has not seen yet and records them in schema_version, so restarts
+# keep all data. Never edit a migration that has shipped; append a new one.
+
+def _migrate_base_tables(c):
     # Events table
     c.execute('''CREATE TABLE IF NOT EXISTS events (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -25,7 +241,7 @@ def init_db():
         is_open BOOLEAN DEFAULT 0,
         seat_limit INTEGER DEFAULT 35
     )''')
-    
+
     # Users table (global registry of all users who started the bot)
     c.execute('''CREATE TABLE IF NOT EXISTS users (
         user_id INTEGER PRIMARY KEY,
@@ -49,136 +265,671 @@ def init_db():
         FOREIGN KEY(event_id) REFERENCES events(id),
         UNIQUE(user_id, event_id)
     )''')
-    
-    conn.commit()
-    conn.close()
+
+def _migrate_outbox(c):
+    # Outbox of messages waiting to be delivered by outbox.OutboxWorker
+    c.execute('''CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        parse_mode TEXT,
+        status TEXT DEFAULT 'PENDING',
+        attempts INTEGER DEFAULT 0,
+        next_attempt_at REAL DEFAULT 0,
+        last_error TEXT,
+        created_at TIMESTAMP,
+        sent_at TIMESTAMP
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at)")
+
+def _migrate_registration_indexes(c):
+    # Serves get_pending_registrations, get_waiting_list (incl. its ORDER BY)
+    # and get_event_registrations. Lookups by user_id are already served by
+    # the UNIQUE(user_id, event_id) index.
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_registrations_event_status_time
+                 ON registrations(event_id, status, registration_time)''')
+    # Case-insensitive lookup in get_user_by_username
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(LOWER(username))")
+
+def _migrate_offer_expiry(c):
+    # Deadline (unix time) of a waiting-list offer while status is OFFERED
+    c.execute("ALTER TABLE registrations ADD COLUMN offer_expires_at REAL")
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_registrations_open_offers
+                 ON registrations(offer_expires_at) WHERE status = 'OFFERED' ''')
+
+def _migrate_partner_keys(c):
+    # Normalised copies of the names partner matching compares (see
+    # partners.py), so seat counts can resolve partners with indexed SQL
+    c.execute("ALTER TABLE registrations ADD COLUMN name_key TEXT")
+    c.execute("ALTER TABLE registrations ADD COLUMN username_key TEXT")
+    c.execute("ALTER TABLE registrations ADD COLUMN partner_key TEXT")
+    rows = c.execute("SELECT id, username, full_name, partner_name FROM registrations").fetchall()
+    c.executemany(
+        "UPDATE registrations SET name_key = ?, username_key = ?, partner_key = ? WHERE id = ?",
+        (_registration_keys(r['username'], r['full_name'], r['partner_name']) + (r['id'],) for r in rows)
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_registrations_event_name_key ON registrations(event_id, name_key)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_registrations_event_username_key ON registrations(event_id, username_key)")
+    # Per-event listing in id order (keyset pagination of /admin_list)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_registrations_event ON registrations(event_id)")
+
+def _migrate_event_counters(c):
+    # Per-event, per-status totals maintained by the registration writes
+    c.execute('''CREATE TABLE IF NOT EXISTS event_counters (
+        event_id INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        registrations INTEGER NOT NULL DEFAULT 0,
+        partner_seats INTEGER NOT NULL DEFAULT 0,
+        admins INTEGER NOT NULL DEFAULT 0,
+        neulings INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (event_id, status)
+    )''')
+    # Finds the registrations that name a newly registered person as partner
+    c.execute("CREATE INDEX IF NOT EXISTS idx_registrations_event_partner_key ON registrations(event_id, partner_key, status)")
+    c.executemany('''INSERT INTO event_counters (event_id, status, registrations, partner_seats, admins, neulings)
+                     VALUES (?, ?, ?, ?, ?, ?)''',
+                  (tuple(row) for row in _recount_event_counters(c)))
+
+def _migrate_persistence(c):
+    # Handler state of python-telegram-bot (see persistence.py), as JSON
+    c.execute('''CREATE TABLE IF NOT EXISTS user_data (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_data (
+        chat_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS conversations (
+        name TEXT NOT NULL,
+        key TEXT NOT NULL,
+        state TEXT NOT NULL,
+        PRIMARY KEY (name, key)
+    )''')
+
+def _migrate_broadcasts(c):
+    # Admin broadcasts to every known user (see broadcast.py). Recipients are
+    # walked in user_id order; last_user_id and the counts are the checkpoint
+    # a restarted bot resumes from.
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        created_by INTEGER,
+        status TEXT DEFAULT 'RUNNING',
+        last_user_id INTEGER DEFAULT 0,
+        delivered INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        created_at TIMESTAMP,
+        finished_at TIMESTAMP
+    )''')
+
+def _migrate_partner_seat_statuses(c):
+    # Partners whose registration is cancelled, declined or expired count as
+    # not registered since this version; recount the partner seats
+    c.execute("DELETE FROM event_counters")
+    c.executemany('''INSERT INTO event_counters (event_id, status, registrations, partner_seats, admins, neulings)
+                     VALUES (?, ?, ?, ?, ?, ?)''',
+                  (tuple(row) for row in _recount_event_counters(c)))
+
+MIGRATIONS = [
+    _migrate_base_tables,
+    _migrate_outbox,
+    _migrate_registration_indexes,
+    _migrate_offer_expiry,
+    _migrate_partner_keys,
+    _migrate_event_counters,
+    _migrate_persistence,
+    _migrate_broadcasts,
+    _migrate_partner_seat_statuses,
+]
+
+@_timed
+def get_schema_version():
+    row = get_connection().execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+@_timed
+def init_db():
+    """Bring the database schema up to date. Safe to call on every start."""
+    with transaction() as c:
+        c.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            applied_at TIMESTAMP
+        )''')
+        current = get_schema_version()
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            if version <= current:
+                continue
+            migration(c)
+            c.execute("INSERT INTO schema_version (version, applied_at) VALUES (?, ?)",
+                      (version, datetime.datetime.now()))
+    # Refresh the planner's statistics now that indexes may have changed
+    get_connection().execute("PRAGMA optimize")
+
+def explain_query_plan(sql, params=()):
+    """Return the EXPLAIN QUERY PLAN detail lines for a statement."""
+    rows = get_connection().execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    return [row['detail'] for row in rows]
+
+# --- Event Counters ---
+#
+# event_counters keeps, per event and status, the number of registrations,
+# the extra seats of partners who are not registered themselves, and how many
+# of those registrations are admins and Neulinge. Every write below that adds
+# registrations or changes a status or admin flag updates the counters in the
+# same transaction, so seat usage is a primary-key lookup instead of a pass
+# over all registrations. check_event_counters() verifies them against a
+# full recount.
+
+# Statuses whose registration has given up its seat. A partner whose only
+# registration is in one of them counts as not registered, as in allocation,
+# which resolves partners among the PENDING registrations only.
+_RELEASED_STATUSES = ('CANCELLED', 'DECLINED', 'EXPIRED')
+_RELEASED_SQL = "('CANCELLED', 'DECLINED', 'EXPIRED')"
+
+# 1 if the registration names a partner who holds no registration for the event
+_PARTNER_SEAT_SQL = f'''(COALESCE(r.partner_name, '') != ''
+        AND NOT EXISTS (SELECT 1 FROM registrations p
+                        WHERE p.event_id = r.event_id AND p.name_key = r.partner_key
+                          AND p.status NOT IN {_RELEASED_SQL})
+        AND NOT EXISTS (SELECT 1 FROM registrations p
+                        WHERE p.event_id = r.event_id AND p.username_key = r.partner_key
+                          AND p.status NOT IN {_RELEASED_SQL}))'''
+
+_COUNTED_COLUMNS = (f"r.event_id, r.status, r.is_admin, r.is_neuling, r.name_key, r.username_key, "
+                    f"{_PARTNER_SEAT_SQL} AS partner_seat")
+
+_COUNTER_COLUMNS = ('registrations', 'partner_seats', 'admins', 'neulings')
+
+
+class _CounterChanges:
+    """Counter deltas collected during one write, applied in one upsert."""
+
+    def __init__(self):
+        self._deltas = {}
+
+    def add(self, event_id, status, registrations=0, partner_seats=0, admins=0, neulings=0):
+        delta = self._deltas.setdefault((event_id, status), [0, 0, 0, 0])
+        delta[0] += registrations
+        delta[1] += partner_seats
+        delta[2] += admins
+        delta[3] += neulings
+
+    def add_registration(self, reg, sign=1, status=None):
+        """Count (sign=1) or uncount (sign=-1) a row selected with _COUNTED_COLUMNS."""
+        self.add(reg['event_id'], status or reg['status'], sign, sign * reg['partner_seat'],
+                 sign if reg['is_admin'] else 0, sign if reg['is_neuling'] else 0)
+
+    def move(self, reg, status):
+        if reg['status'] != status:
+            self.add_registration(reg, -1)
+            self.add_registration(reg, 1, status)
+
+    def apply(self, c):
+        rows = [key + tuple(delta) for key, delta in self._deltas.items() if any(delta)]
+        self._deltas.clear()
+        if rows:
+            c.executemany('''INSERT INTO event_counters (event_id, status, registrations, partner_seats, admins, neulings)
+                             VALUES (?, ?, ?, ?, ?, ?)
+                             ON CONFLICT(event_id, status) DO UPDATE SET
+                                 registrations = registrations + excluded.registrations,
+                                 partner_seats = partner_seats + excluded.partner_seats,
+                                 admins = admins + excluded.admins,
+                                 neulings = neulings + excluded.neulings''', rows)
+
+
+def _counted_registration(c, user_id, event_id, status=None):
+    sql = f"SELECT {_COUNTED_COLUMNS} FROM registrations r WHERE r.user_id = ? AND r.event_id = ?"
+    params = (user_id, event_id)
+    if status is not None:
+        sql += " AND r.status = ?"
+        params += (status,)
+    return c.execute(sql, params).fetchone()
+
+def _count_inserted(c, changes, reg_id, event_id, name_key, username_key):
+    reg = c.execute(f"SELECT {_COUNTED_COLUMNS} FROM registrations r WHERE r.id = ?", (reg_id,)).fetchone()
+    changes.add_registration(reg)
+
+    # Registrations naming this person as partner no longer need an extra
+    # seat, unless someone else already matched that name before
+    keys = {name_key, username_key} - {None}
+    _count_rematched(c, changes, event_id, keys, _matched_keys(c, event_id, keys, reg_id), keys, reg_id)
+
+def _matched_keys(c, event_id, keys, exclude_id=None):
+    """The keys some seat-holding registration has as its name_key or username_key."""
+    matched = set()
+    for key in keys:
+        if c.execute(f'''
+                SELECT EXISTS (SELECT 1 FROM registrations WHERE event_id = ? AND name_key = ? AND id IS NOT ?
+                                                             AND status NOT IN {_RELEASED_SQL})
+                    OR EXISTS (SELECT 1 FROM registrations WHERE event_id = ? AND username_key = ? AND id IS NOT ?
+                                                             AND status NOT IN {_RELEASED_SQL})
+                ''', (event_id, key, exclude_id, event_id, key, exclude_id)).fetchone()[0]:
+            matched.add(key)
+    return matched
+
+def _count_rematched(c, changes, event_id, keys, matched_before, matched_after, exclude_id=None):
+    # A partner name that now resolves to a seat-holder takes the extra seat
+    # from every registration naming it; one that no longer does gives it back
+    for key in keys:
+        if (key in matched_before) == (key in matched_after):
+            continue
+        sign = -1 if key in matched_after else 1
+        for status, count in c.execute('''SELECT status, COUNT(*) FROM registrations
+                                          WHERE event_id = ? AND partner_key = ? AND id IS NOT ?
+                                          GROUP BY status''', (event_id, key, exclude_id)):
+            changes.add(event_id, status, partner_seats=sign * count)
+
+def _released_keys(regs):
+    """name_key and username_key of registrations that give up or take back their seat."""
+    return {key for reg in regs for key in (reg['name_key'], reg['username_key'])} - {None}
+
+def _recount_event_counters(c, event_id=None):
+    where, params = ("WHERE r.event_id = ?", (event_id,)) if event_id is not None else ("", ())
+    return c.execute(f'''
+        SELECT r.event_id, r.status, COUNT(*) AS registrations,
+               SUM({_PARTNER_SEAT_SQL}) AS partner_seats,
+               SUM(CASE WHEN r.is_admin THEN 1 ELSE 0 END) AS admins,
+               SUM(CASE WHEN r.is_neuling THEN 1 ELSE 0 END) AS neulings
+        FROM registrations r
+        {where}
+        GROUP BY r.event_id, r.status
+    ''', params).fetchall()
+
+@_timed
+def rebuild_event_counters(event_id=None):
+    """Recompute the counters of one event (or all events) from the registrations."""
+    with transaction() as c:
+        if event_id is None:
+            c.execute("DELETE FROM event_counters")
+        else:
+            c.execute("DELETE FROM event_counters WHERE event_id = ?", (event_id,))
+        c.executemany('''INSERT INTO event_counters (event_id, status, registrations, partner_seats, admins, neulings)
+                         VALUES (?, ?, ?, ?, ?, ?)''',
+                      (tuple(row) for row in _recount_event_counters(c, event_id)))
+
+@_timed
+def check_event_counters(event_id=None, repair=False):
+    """
+    Compare the stored counters with a full recount.
+
+    Returns a list of (event_id, status, stored, expected) mismatches, where
+    stored and expected are (registrations, partner_seats, admins, neulings)
+    tuples. With repair=True the affected events are rebuilt.
+    """
+    with transaction() as c:
+        expected = {(row['event_id'], row['status']): tuple(row[name] for name in _COUNTER_COLUMNS)
+                    for row in _recount_event_counters(c, event_id)}
+        where, params = ("WHERE event_id = ?", (event_id,)) if event_id is not None else ("", ())
+        stored = {(row['event_id'], row['status']): tuple(row[name] for name in _COUNTER_COLUMNS)
+                  for row in c.execute(f"SELECT * FROM event_counters {where}", params)}
+
+        empty = (0, 0, 0, 0)
+        mismatches = []
+        for key in sorted(expected.keys() | stored.keys()):
+            if stored.get(key, empty) != expected.get(key, empty):
+                mismatches.append(key + (stored.get(key, empty), expected.get(key, empty)))
+
+        if repair:
+            for affected in sorted({m[0] for m in mismatches}):
+                rebuild_event_counters(affected)
+    return mismatches
+
+@_timed
+def get_event_counters(event_id=None):
+    """Counter rows (event_id, status, registrations, partner_seats, admins, neulings)."""
+    if event_id is None:
+        return get_connection().execute(
+            "SELECT * FROM event_counters WHERE registrations > 0 ORDER BY event_id, status"
+        ).fetchall()
+    return get_connection().execute(
+        "SELECT * FROM event_counters WHERE event_id = ? AND registrations > 0 ORDER BY status", (event_id,)
+    ).fetchall()
+
+@_timed
+def get_seats_taken(event_id, statuses=('ACCEPTED', 'OFFERED')):
+    """Seats held by registrations in `statuses`, unregistered partners included."""
+    placeholders = ", ".join("?" for _ in statuses)
+    row = get_connection().execute(
+        f'''SELECT COALESCE(SUM(registrations + partner_seats), 0) FROM event_counters
+            WHERE event_id = ? AND status IN ({placeholders})''', (event_id,) + tuple(statuses)
+    ).fetchone()
+    return row[0]
 
 # --- Event Operations ---
 
-def create_event(name, seat_limit=35):
-    conn = get_connection()
-    c = conn.cursor()
-    try:
-        c.execute("INSERT INTO events (name, seat_limit) VALUES (?, ?)", (name, seat_limit))
-        event_id = c.lastrowid
-        conn.commit()
-        return event_id
-    finally:
-        conn.close()
+@_timed
+def create_event(name, seat_limit=35, event_id=None):
+    """Create a closed event; event_id picks its id (e.g. replaying a recording), else the next one."""
+    with transaction() as c:
+        c.execute("INSERT INTO events (id, name, seat_limit) VALUES (?, ?, ?)", (event_id, name, seat_limit))
+        _notify('event_changed', event_id=c.lastrowid)
+        return c.lastrowid
 
+@_timed
 def get_events():
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM events")
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return get_connection().execute("SELECT * FROM events").fetchall()
 
+@_timed
 def get_event(event_id):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM events WHERE id = ?", (event_id,))
-    row = c.fetchone()
-    conn.close()
-    return row
+    return get_connection().execute("SELECT * FROM events WHERE id = ?", (event_id,)).fetchone()
 
+@_timed
 def set_event_open(event_id, is_open):
-    conn = get_connection()
-    c = conn.cursor()
     val = 1 if is_open else 0
-    c.execute("UPDATE events SET is_open = ? WHERE id = ?", (val, event_id))
-    conn.commit()
-    conn.close()
+    with transaction() as c:
+        c.execute("UPDATE events SET is_open = ? WHERE id = ?", (val, event_id))
+        _notify('event_changed', event_id=event_id)
 
 # --- Registration Operations ---
 
+def _registration_keys(username, full_name, partner_name):
+    return (normalize_name(full_name), normalize_name(username), normalize_partner_name(partner_name))
+
+@_timed
 def add_registration(user_id, event_id, username, full_name, is_neuling, partner_name):
-    conn = get_connection()
-    c = conn.cursor()
+    keys = _registration_keys(username, full_name, partner_name)
     try:
-        c.execute('''INSERT INTO registrations 
-                     (user_id, event_id, username, full_name, is_neuling, partner_name, registration_time, status)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, 'PENDING')''',
-                  (user_id, event_id, username, full_name, is_neuling, partner_name, datetime.datetime.now()))
-        conn.commit()
+        with transaction() as c:
+            c.execute('''INSERT INTO registrations 
+                         (user_id, event_id, username, full_name, is_neuling, partner_name, registration_time, status,
+                          name_key, username_key, partner_key)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, 'PENDING', ?, ?, ?)''',
+                      (user_id, event_id, username, full_name, is_neuling, partner_name, datetime.datetime.now())
+                      + keys)
+            changes = _CounterChanges()
+            _count_inserted(c, changes, c.lastrowid, event_id, keys[0], keys[1])
+            changes.apply(c)
+            _notify('registration_added', event_id=event_id, user_ids=[user_id])
         return True
     except sqlite3.IntegrityError:
         return False
-    finally:
-        conn.close()
 
+@_timed
+def add_registrations(rows):
+    """
+    Insert many registrations in one transaction (bulk mock-user seeding).
+
+    rows is an iterable of (user_id, event_id, username, full_name,
+    is_neuling, partner_name, registration_time) tuples. Rows that would
+    duplicate an existing (user_id, event_id) are skipped. Returns the number
+    of rows inserted.
+    """
+    inserted = 0
+    changes = _CounterChanges()
+    added = {}
+    with transaction() as c:
+        for row in rows:
+            keys = _registration_keys(row[2], row[3], row[5])
+            c.execute('''INSERT OR IGNORE INTO registrations
+                         (user_id, event_id, username, full_name, is_neuling, partner_name, registration_time, status,
+                          name_key, username_key, partner_key)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, 'PENDING', ?, ?, ?)''',
+                      tuple(row) + keys)
+            if c.rowcount == 1:
+                inserted += 1
+                _count_inserted(c, changes, c.lastrowid, row[1], keys[0], keys[1])
+                added.setdefault(row[1], []).append(row[0])
+        changes.apply(c)
+        for event_id, user_ids in added.items():
+            _notify('registration_added', event_id=event_id, user_ids=user_ids)
+    return inserted
+
+@_timed
+def get_max_user_id(min_user_id=0):
+    """Highest registered user_id that is >= min_user_id, or None."""
+    row = get_connection().execute(
+        "SELECT MAX(user_id) FROM registrations WHERE user_id >= ?", (min_user_id,)
+    ).fetchone()
+    return row[0]
+
+@_timed
 def get_registration(user_id, event_id):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM registrations WHERE user_id = ? AND event_id = ?", (user_id, event_id))
-    row = c.fetchone()
-    conn.close()
-    return row
+    return get_connection().execute(
+        "SELECT * FROM registrations WHERE user_id = ? AND event_id = ?", (user_id, event_id)
+    ).fetchone()
 
+@_timed
 def get_user_registrations(user_id):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute('''
+    return get_connection().execute('''
         SELECT r.*, e.name as event_name 
         FROM registrations r 
         JOIN events e ON r.event_id = e.id 
         WHERE r.user_id = ?
-    ''', (user_id,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    ''', (user_id,)).fetchall()
 
+@_timed
 def update_status(user_id, event_id, status):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("UPDATE registrations SET status = ? WHERE user_id = ? AND event_id = ?", (status, user_id, event_id))
-    conn.commit()
-    conn.close()
+    update_statuses(event_id, [(user_id, status)])
+
+@_timed
+def update_statuses(event_id, statuses, from_status=None):
+    """
+    Apply many status changes for one event atomically.
+
+    statuses is an iterable of (user_id, status) pairs; all rows and their
+    counters are written in one transaction, so either every change lands or
+    none does. With from_status only registrations still in that status are
+    changed. Returns the user ids whose status changed.
+    """
+    changes = _CounterChanges()
+    with transaction() as c:
+        # The changes go into a temp table, trimmed to the rows whose status
+        # really changes; the counter deltas then come from one aggregate
+        # over it and the write is one UPDATE, instead of a SELECT and an
+        # UPDATE per row. CROSS JOIN keeps the (unanalyzed) temp table as
+        # the outer loop, so a single change stays a single index lookup.
+        c.execute("CREATE TEMP TABLE IF NOT EXISTS status_changes (user_id INTEGER PRIMARY KEY, status TEXT NOT NULL)")
+        c.execute("DELETE FROM status_changes")
+        c.executemany("INSERT OR REPLACE INTO status_changes (user_id, status) VALUES (?, ?)", statuses)
+        c.execute('''DELETE FROM status_changes WHERE NOT EXISTS (
+                         SELECT 1 FROM registrations r
+                         WHERE r.user_id = status_changes.user_id AND r.event_id = ? AND r.status != status_changes.status
+                           AND r.status = COALESCE(?, r.status))''',
+                  (event_id, from_status))
+        for row in c.execute(f'''
+                SELECT r.status AS old_status, s.status AS new_status, COUNT(*) AS registrations,
+                       SUM({_PARTNER_SEAT_SQL}) AS partner_seats,
+                       SUM(CASE WHEN r.is_admin THEN 1 ELSE 0 END) AS admins,
+                       SUM(CASE WHEN r.is_neuling THEN 1 ELSE 0 END) AS neulings
+                FROM status_changes s CROSS JOIN registrations r ON r.user_id = s.user_id AND r.event_id = ?
+                GROUP BY r.status, s.status''', (event_id,)).fetchall():
+            counts = tuple(row[name] for name in _COUNTER_COLUMNS)
+            changes.add(event_id, row['old_status'], *(-count for count in counts))
+            changes.add(event_id, row['new_status'], *counts)
+        # Registrations giving up their seat (or taking one back) change the
+        # partner seats of everyone naming them
+        keys = _released_keys(c.execute(f'''
+                SELECT r.name_key, r.username_key
+                FROM status_changes s CROSS JOIN registrations r ON r.user_id = s.user_id AND r.event_id = ?
+                WHERE (r.status IN {_RELEASED_SQL}) != (s.status IN {_RELEASED_SQL})''', (event_id,)))
+        matched_before = _matched_keys(c, event_id, keys)
+        ids = get_connection().cursor()
+        ids.row_factory = None
+        changed = [row[0] for row in ids.execute("SELECT user_id FROM status_changes")]
+        if changed:
+            c.execute('''UPDATE registrations
+                         SET status = (SELECT s.status FROM status_changes s WHERE s.user_id = registrations.user_id)
+                         WHERE event_id = ? AND user_id IN (SELECT user_id FROM status_changes)''', (event_id,))
+        _count_rematched(c, changes, event_id, keys, matched_before, _matched_keys(c, event_id, keys))
+        c.execute("DELETE FROM status_changes")
+        changes.apply(c)
+        if changed:
+            _notify('status_changed', event_id=event_id, user_ids=changed)
+    return changed
+
+@_timed
+def apply_allocation(event_id, statuses, messages):
+    """
+    Write an allocation's status changes and its notifications atomically.
 
+    Only registrations that are still PENDING are written: one cancelled
+    (or otherwise changed) while the allocation ran keeps its status, and
+    its user gets no message. Returns the number of registrations written.
+    """
+    with transaction():
+        written = set(update_statuses(event_id, statuses, from_status='PENDING'))
+        enqueue_messages(message for message in messages if message[0] in written)
+    return len(written)
+
+@_timed
 def get_event_registrations(event_id):
+    return get_connection().execute("SELECT * FROM registrations WHERE event_id = ?", (event_id,)).fetchall()
+
+def iter_event_registrations(event_id, after_id=None, before_id=None, batch_size=200):
+    """
+    Stream an event's registrations in id order straight from the cursor.
+
+    With before_id the rows before it are yielded in descending id order
+    (for paging backwards); otherwise rows after after_id in ascending order.
+    """
+    if before_id is not None:
+        cursor = get_connection().execute(
+            "SELECT * FROM registrations WHERE event_id = ? AND id < ? ORDER BY id DESC", (event_id, before_id)
+        )
+    else:
+        cursor = get_connection().execute(
+            "SELECT * FROM registrations WHERE event_id = ? AND id > ? ORDER BY id", (event_id, after_id or 0)
+        )
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        cursor.close()
+
+@_timed
+def has_registrations_before(event_id, reg_id):
+    return get_connection().execute(
+        "SELECT EXISTS(SELECT 1 FROM registrations WHERE event_id = ? AND id < ?)", (event_id, reg_id)
+    ).fetchone()[0] == 1
+
+@_timed
+def get_registrations_by_users(event_id, user_ids, batch_size=500):
+    """The registrations of the given users for one event."""
+    user_ids = list(user_ids)
+    rows = []
     conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM registrations WHERE event_id = ?", (event_id,))
-    rows = c.fetchall()
-    conn.close()
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        placeholders = ", ".join("?" * len(batch))
+        rows += conn.execute(f"SELECT * FROM registrations WHERE event_id = ? AND user_id IN ({placeholders})",
+                             (event_id, *batch)).fetchall()
     return rows
 
+@_timed
 def get_pending_registrations(event_id):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM registrations WHERE event_id = ? AND status = 'PENDING'", (event_id,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return get_connection().execute(
+        "SELECT * FROM registrations WHERE event_id = ? AND status = 'PENDING'", (event_id,)
+    ).fetchall()
+
+@_timed
+def get_allocation_snapshot(event_id):
+    """
+    PENDING registrations as plain tuples in allocation.SNAPSHOT_COLUMNS order.
+
+    Tuples instead of sqlite3.Row objects: they are smaller, faster to
+    build, and can be pickled to a worker process.
+    """
+    c = get_connection().cursor()
+    c.row_factory = None
+    return c.execute('''SELECT user_id, name_key, username_key, is_admin, is_neuling, partner_key, partner_name
+                        FROM registrations WHERE event_id = ? AND status = 'PENDING' ORDER BY id''',
+                     (event_id,)).fetchall()
 
+@_timed
 def get_waiting_list(event_id):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM registrations WHERE event_id = ? AND status = 'WAITING' ORDER BY registration_time ASC", (event_id,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    """WAITING registrations in registration order, with their partner_seat (0 or 1)."""
+    # registration_time is not unique (datetime.now() can repeat, and
+    # add_registrations takes times from the caller), so id makes the order
+    # of equal times stable; the index yields that order without sorting
+    return get_connection().execute(
+        f'''SELECT r.*, {_PARTNER_SEAT_SQL} AS partner_seat FROM registrations r
+            WHERE r.event_id = ? AND r.status = 'WAITING' ORDER BY r.registration_time, r.id''', (event_id,)
+    ).fetchall()
+
+@_timed
+def get_waiting_order(event_id):
+    """User ids of the WAITING registrations, in the order of get_waiting_list."""
+    c = get_connection().cursor()
+    c.row_factory = None
+    rows = c.execute('''SELECT user_id FROM registrations WHERE event_id = ? AND status = 'WAITING'
+                         ORDER BY registration_time, id''', (event_id,)).fetchall()
+    return [row[0] for row in rows]
+
+@_timed
+def offer_seats(event_id, user_ids, expires_at):
+    """Move WAITING registrations to OFFERED with an offer deadline (unix time)."""
+    changes = _CounterChanges()
+    offered = []
+    with transaction() as c:
+        for user_id in user_ids:
+            reg = _counted_registration(c, user_id, event_id, 'WAITING')
+            if reg is None:
+                continue
+            changes.move(reg, 'OFFERED')
+            c.execute('''UPDATE registrations SET status = 'OFFERED', offer_expires_at = ?
+                         WHERE user_id = ? AND event_id = ?''', (expires_at, user_id, event_id))
+            offered.append(user_id)
+        changes.apply(c)
+        if offered:
+            _notify('status_changed', event_id=event_id, user_ids=offered)
+
+@_timed
+def resolve_offer(user_id, event_id, status):
+    """
+    Close an open offer by moving it to `status` (ACCEPTED, DECLINED, EXPIRED).
+
+    Returns False if the registration is no longer OFFERED, e.g. because the
+    offer already expired or was answered.
+    """
+    with transaction() as c:
+        reg = _counted_registration(c, user_id, event_id, 'OFFERED')
+        if reg is None:
+            return False
+        keys = _released_keys([reg]) if status in _RELEASED_STATUSES else set()
+        matched_before = _matched_keys(c, event_id, keys)
+        c.execute('''UPDATE registrations SET status = ?, offer_expires_at = NULL
+                     WHERE user_id = ? AND event_id = ?''', (status, user_id, event_id))
+        changes = _CounterChanges()
+        changes.move(reg, status)
+        _count_rematched(c, changes, event_id, keys, matched_before, _matched_keys(c, event_id, keys))
+        changes.apply(c)
+        _notify('status_changed', event_id=event_id, user_ids=[user_id])
+        return True
 
+@_timed
+def get_open_offers():
+    return get_connection().execute(
+        "SELECT user_id, event_id, offer_expires_at FROM registrations WHERE status = 'OFFERED'"
+    ).fetchall()
+
+@_timed
 def set_admin(user_id, event_id, is_admin):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("UPDATE registrations SET is_admin = ? WHERE user_id = ? AND event_id = ?", (is_admin, user_id, event_id))
-    conn.commit()
-    conn.close()
+    with transaction() as c:
+        reg = _counted_registration(c, user_id, event_id)
+        if reg is None:
+            return
+        c.execute("UPDATE registrations SET is_admin = ? WHERE user_id = ? AND event_id = ?", (is_admin, user_id, event_id))
+        if bool(reg['is_admin']) != bool(is_admin):
+            changes = _CounterChanges()
+            changes.add(event_id, reg['status'], admins=1 if is_admin else -1)
+            changes.apply(c)
+            _notify('admin_changed', event_id=event_id, user_ids=[user_id])
 
 # --- User Operations ---
 
+@_timed
 def upsert_user(user_id, username, full_name):
-    conn = get_connection()
-    c = conn.cursor()
-    try:
+    with transaction() as c:
         c.execute('''INSERT OR REPLACE INTO users (user_id, username, full_name, last_seen)
                      VALUES (?, ?, ?, ?)''', 
                   (user_id, username, full_name, datetime.datetime.now()))
-        conn.commit()
-    finally:
-        conn.close()
 
+@_timed
 def get_user_by_username(username):
     if not username:
         return None
@@ -186,10 +937,154 @@ def get_user_by_username(username):
     if username.startswith('@'):
         username = username[1:]
         
-    conn = get_connection()
-    c = conn.cursor()
     # Case insensitive search
-    c.execute("SELECT * FROM users WHERE LOWER(username) = ?", (username.lower(),))
-    row = c.fetchone()
-    conn.close()
-    return row
+    return get_connection().execute(
+        "SELECT * FROM users WHERE LOWER(username) = ?", (username.lower(),)
+    ).fetchone()
+
+@_timed
+def count_users():
+    return get_connection().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+@_timed
+def get_user_ids_after(after_user_id, limit):
+    """The next `limit` user ids above after_user_id, in order (keyset pagination of users)."""
+    rows = get_connection().execute(
+        "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (after_user_id, limit)
+    ).fetchall()
+    return [row[0] for row in rows]
+
+# --- Bot Persistence ---
+#
+# Raw JSON strings; persistence.SQLitePersistence does the (de)serialising.
+
+@_timed
+def get_persisted_user_data(user_id):
+    row = get_connection().execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else None
+
+@_timed
+def get_persisted_chat_data(chat_id):
+    row = get_connection().execute("SELECT data FROM chat_data WHERE chat_id = ?", (chat_id,)).fetchone()
+    return row[0] if row else None
+
+@_timed
+def get_persisted_conversations(name):
+    """(key, state) pairs of every stored conversation of a handler."""
+    return get_connection().execute(
+        "SELECT key, state FROM conversations WHERE name = ?", (name,)
+    ).fetchall()
+
+@_timed
+def save_persisted_data(user_rows=(), chat_rows=(), conversation_rows=()):
+    """
+    Write changed persistence rows in one transaction.
+
+    user_rows and chat_rows are (id, data) pairs, conversation_rows are
+    (name, key, state) triples. A data or state of None deletes the row.
+    """
+    with transaction() as c:
+        for table, column, rows in (('user_data', 'user_id', user_rows), ('chat_data', 'chat_id', chat_rows)):
+            c.executemany(f"DELETE FROM {table} WHERE {column} = ?",
+                          ((key,) for key, data in rows if data is None))
+            c.executemany(f"INSERT OR REPLACE INTO {table} ({column}, data) VALUES (?, ?)",
+                          ((key, data) for key, data in rows if data is not None))
+        c.executemany("DELETE FROM conversations WHERE name = ? AND key = ?",
+                      ((name, key) for name, key, state in conversation_rows if state is None))
+        c.executemany("INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                      ((name, key, state) for name, key, state in conversation_rows if state is not None))
+
+# --- Outbox Operations ---
+
+@_timed
+def enqueue_messages(messages):
+    """
+    Queue messages for delivery by the outbox worker.
+
+    messages is an iterable of (chat_id, text, parse_mode) tuples.
+    """
+    now = datetime.datetime.now()
+    with transaction() as c:
+        c.executemany(
+            "INSERT INTO outbox (chat_id, text, parse_mode, created_at) VALUES (?, ?, ?, ?)",
+            ((chat_id, text, parse_mode, now) for chat_id, text, parse_mode in messages)
+        )
+
+@_timed
+def claim_due_messages(limit, now):
+    """Mark up to `limit` messages due at unix time `now` as SENDING and return them."""
+    with transaction() as c:
+        c.execute('''SELECT * FROM outbox
+                     WHERE status = 'PENDING' AND next_attempt_at <= ?
+                     ORDER BY next_attempt_at, id LIMIT ?''', (now, limit))
+        rows = c.fetchall()
+        c.executemany("UPDATE outbox SET status = 'SENDING' WHERE id = ?", ((r['id'],) for r in rows))
+        return rows
+
+@_timed
+def release_claimed_messages():
+    """Return messages claimed by a previous run that never finished to PENDING."""
+    with transaction() as c:
+        c.execute("UPDATE outbox SET status = 'PENDING' WHERE status = 'SENDING'")
+        return c.rowcount
+
+@_timed
+def get_next_message_time():
+    """Unix time at which the next pending message becomes due, or None."""
+    row = get_connection().execute(
+        "SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'PENDING'"
+    ).fetchone()
+    return row[0]
+
+@_timed
+def mark_message_sent(message_id):
+    with transaction() as c:
+        c.execute("UPDATE outbox SET status = 'SENT', sent_at = ? WHERE id = ?",
+                  (datetime.datetime.now(), message_id))
+
+@_timed
+def mark_message_failed(message_id, error):
+    with transaction() as c:
+        c.execute("UPDATE outbox SET status = 'FAILED', attempts = attempts + 1, last_error = ? WHERE id = ?",
+                  (error, message_id))
+
+@_timed
+def reschedule_message(message_id, next_attempt_at, error, count_attempt=True):
+    with transaction() as c:
+        c.execute('''UPDATE outbox
+                     SET status = 'PENDING', next_attempt_at = ?, last_error = ?, attempts = attempts + ?
+                     WHERE id = ?''',
+                  (next_attempt_at, error, 1 if count_attempt else 0, message_id))
+
+# --- Broadcast Operations ---
+
+@_timed
+def create_broadcast(text, created_by):
+    with transaction() as c:
+        c.execute("INSERT INTO broadcasts (text, created_by, created_at) VALUES (?, ?, ?)",
+                  (text, created_by, datetime.datetime.now()))
+        return c.lastrowid
+
+@_timed
+def get_broadcast(broadcast_id):
+    return get_connection().execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+
+@_timed
+def get_running_broadcasts():
+    return get_connection().execute(
+        "SELECT * FROM broadcasts WHERE status = 'RUNNING' ORDER BY id"
+    ).fetchall()
+
+@_timed
+def save_broadcast_progress(broadcast_id, last_user_id, delivered, blocked, failed, finished=False):
+    """
+    Checkpoint a broadcast: every user up to last_user_id has been handled,
+    with the given totals. finished=True marks it DONE.
+    """
+    with transaction() as c:
+        c.execute('''UPDATE broadcasts
+                     SET last_user_id = ?, delivered = ?, blocked = ?, failed = ?,
+                         status = ?, finished_at = ?
+                     WHERE id = ?''',
+                  (last_user_id, delivered, blocked, failed, 'DONE' if finished else 'RUNNING',
+                   datetime.datetime.now() if finished else None, broadcast_id))
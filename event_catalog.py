@@ -0,0 +1,89 @@
+"""
+Process-local cache of the events table.
+
+Events change only through database.create_event and database.set_event_open,
+and both report their commits to database listeners. The catalog rebuilds an
+immutable EventSnapshot on each such write, so the read-heavy commands
+(/start, /register, /events and the admin pickers) never touch the database.
+"""
+from typing import Optional
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import async_db as adb
+import database as db
+from formatting import escape_md
+
+
+class EventSnapshot:
+    """Immutable view of all events with pre-computed views for handlers."""
+
+    # Callback data prefixes used by the event pickers in main.py
+    OPEN_KEYBOARD_PREFIXES = ("event_", "admin_close_", "admin_preview_")
+    CLOSED_KEYBOARD_PREFIXES = ("admin_open_",)
+    ALL_KEYBOARD_PREFIXES = ("admin_list_",)
+
+    def __init__(self, rows):
+        self.events = tuple(rows)
+        self.by_id = {e['id']: e for e in self.events}
+        self.open_events = tuple(e for e in self.events if e['is_open'])
+        self.closed_events = tuple(e for e in self.events if not e['is_open'])
+        self.safe_names = {e['id']: escape_md(e['name']) for e in self.events}
+
+        self._keyboards = {}
+        for prefix in self.OPEN_KEYBOARD_PREFIXES:
+            self._keyboards[prefix] = self._build_keyboard(self.open_events, prefix)
+        for prefix in self.CLOSED_KEYBOARD_PREFIXES:
+            self._keyboards[prefix] = self._build_keyboard(self.closed_events, prefix)
+        for prefix in self.ALL_KEYBOARD_PREFIXES:
+            self._keyboards[prefix] = self._build_keyboard(self.events, prefix)
+
+    @staticmethod
+    def _build_keyboard(events, prefix):
+        if not events:
+            return None
+        return InlineKeyboardMarkup(
+            [[InlineKeyboardButton(e['name'], callback_data=f"{prefix}{e['id']}")] for e in events]
+        )
+
+    def get(self, event_id):
+        return self.by_id.get(event_id)
+
+    def safe_name(self, event_id):
+        return self.safe_names.get(event_id, "")
+
+    def keyboard(self, prefix):
+        """The event picker for a callback prefix, e.g. keyboard('event_')."""
+        return self._keyboards[prefix]
+
+
+_snapshot: Optional[EventSnapshot] = None
+
+
+def _load():
+    global _snapshot
+    _snapshot = EventSnapshot(db.get_events())
+    return _snapshot
+
+
+async def snapshot() -> EventSnapshot:
+    """The current catalog, loading it on the database thread on first use."""
+    current = _snapshot
+    if current is not None:
+        return current
+    return await adb.run(_load)
+
+
+def invalidate():
+    global _snapshot
+    _snapshot = None
+
+
+def _on_database_change(kind, data):
+    # Runs on the writing thread right after the commit, so reloading here
+    # reads the new state on the same connection
+    if kind == 'event_changed':
+        _load()
+
+
+db.add_listener(_on_database_change)
@@ -0,0 +1,469 @@
+"""
+Local stand-in for the Telegram Bot API, for benchmarks and manual testing.
+
+FakeBotAPI is a small threaded HTTP server that answers the Bot API methods
+the bot uses (getMe, getUpdates, setWebhook, sendMessage, ...) and records
+every message the bot sends. Point an Application at it with
+ApplicationBuilder().base_url(api.base_url). Updates queued with
+push_update() are handed out through getUpdates (polling), or POSTed to the
+webhook the bot registered with setWebhook, including its secret token.
+
+Network and flood control:
+- `latency` delays every answer except getUpdates, like the round trip to
+  Telegram's servers would, plus a random `jitter` of up to that many seconds
+- `flood_probability` answers that share of sendMessage/editMessageText
+  calls with 429 Too Many Requests (retry after `flood_retry_after` seconds)
+- `send_rate` answers 429 to sends beyond that many messages per second
+  across all chats, like Telegram's global limit
+- sends to a chat in `blocked_chats` are answered with 403 Forbidden, like
+  for a user who blocked the bot
+
+Scripted users: play() takes one list of steps per user, e.g. from
+registration_script(). A user's next update is pushed once the bot has sent
+them the replies to the previous one (after an optional think time), so the
+bot is driven like by people tapping through its questions.
+
+Usage:
+    api = FakeBotAPI()
+    api.start()
+    application = main.build_application(FakeBotAPI.TOKEN, base_url=api.base_url)
+    ...
+    api.push_update(message_update(1001, "/events"))
+    api.wait_for_messages(1)
+    api.play({user_id: registration_script(user_id) for user_id in range(1000, 1100)})
+    api.wait_for_scripts()
+    api.stop()
+"""
+import heapq
+import http.client
+import itertools
+import json
+import logging
+import math
+import queue
+import random
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Fake Bot', 'username': 'fake_bot'}
+
+
+def message_update(user_id: int, text: str, chat_type: str = 'private') -> dict:
+    """An update carrying a text message (a command if it starts with '/')."""
+    user = {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}", 'username': f"user{user_id}"}
+    message = {
+        'message_id': user_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': chat_type},
+        'from': user,
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'message': message}
+
+
+def callback_update(user_id: int, data: str) -> dict:
+    """An update carrying an inline button press."""
+    user = {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}", 'username': f"user{user_id}"}
+    return {'callback_query': {
+        'id': str(user_id),
+        'from': user,
+        'chat_instance': str(user_id),
+        'data': data,
+        'message': {
+            'message_id': user_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': BOT_USER,
+            'text': '…',
+        },
+    }}
+
+
+def registration_script(user_id: int, event_id: int = None, is_neuling: bool = False,
+                        partner_name: str = None) -> list:
+    """
+    The steps of one user registering through /register, as (update, replies)
+    pairs: replies is how many messages the bot sends back to the step.
+
+    Pass event_id when several events are open and the bot asks for one.
+    """
+    steps = [(message_update(user_id, "/register"), 1)]
+    if event_id is not None:
+        # "Ausgewählt: ..." and the Neuling question
+        steps.append((callback_update(user_id, f"event_{event_id}"), 2))
+    steps.append((callback_update(user_id, 'neuling_yes' if is_neuling else 'neuling_no'), 2))
+    if partner_name:
+        steps.append((callback_update(user_id, 'partner_yes'), 2))
+        steps.append((message_update(user_id, partner_name), 1))
+    else:
+        steps.append((callback_update(user_id, 'partner_no'), 2))
+    return steps
+
+
+class BotAPIError(Exception):
+    """An error answer ({'ok': false, ...}) to a Bot API call."""
+
+    def __init__(self, error_code: int, description: str, parameters: dict = None):
+        super().__init__(description)
+        self.error_code = error_code
+        self.description = description
+        self.parameters = parameters
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without this every reply
+    # waits for the client's delayed ACK (~40 ms)
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self._handle()
+
+    def do_GET(self):
+        self._handle()
+
+    def _handle(self):
+        # Paths look like /bot<token>/<method>
+        method = urlsplit(self.path).path.rsplit('/', 1)[-1]
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        params = self._parse_params(body)
+        try:
+            payload = {'ok': True, 'result': self.server.api.call(method, params)}
+            status = 200
+        except BotAPIError as e:
+            payload = {'ok': False, 'error_code': e.error_code, 'description': e.description}
+            if e.parameters:
+                payload['parameters'] = e.parameters
+            status = e.error_code
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        try:
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # The bot gave up on the request (e.g. a send cancelled on shutdown)
+            pass
+
+    def _parse_params(self, body):
+        content_type = self.headers.get('Content-Type', '')
+        if not body:
+            return {}
+        if 'application/json' in content_type:
+            return json.loads(body)
+        params = {}
+        for key, values in parse_qs(body.decode(), keep_blank_values=True).items():
+            try:
+                params[key] = json.loads(values[-1])
+            except ValueError:
+                params[key] = values[-1]
+        return params
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connections when many handlers send at once
+    request_queue_size = 1024
+
+
+class FakeBotAPI:
+    """A threaded local HTTP server speaking enough of the Bot API for the bot."""
+
+    TOKEN = "123456:FAKE-TOKEN"
+    # Methods flood control applies to
+    SEND_METHODS = frozenset({'sendMessage', 'editMessageText'})
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+                 flood_probability: float = 0.0, flood_retry_after: int = 1, send_rate: float = None,
+                 seed: int = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_probability = flood_probability
+        self.flood_retry_after = flood_retry_after
+        self.send_rate = send_rate
+        # Chats whose user blocked the bot: sends to them are answered with 403
+        self.blocked_chats = set()
+        self._random = random.Random(seed)
+        self._server = _Server((host, port), _Handler)
+        self._server.api = self
+        self._thread = None
+
+        self._lock = threading.Condition()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._updates = []
+        self.sent_messages = []
+        self.calls = {}
+        # Sends answered with 429, and the sends of the current second for send_rate
+        self.floods = 0
+        self._send_window = (0, 0)
+
+        # play(): chat id -> [remaining steps, messages to wait for]
+        self._scripts = {}
+        self._chat_messages = defaultdict(int)
+        self._due = []
+        self._step_sent = {}
+        self.step_seconds = []
+        self.think_time = 0.0
+        self._script_thread = None
+        self._stopping = False
+
+        self.webhook_url = None
+        self.webhook_secret = None
+        self._webhook_queue = None
+        self._webhook_threads = []
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-bot-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_webhook()
+        with self._lock:
+            self._stopping = True
+            self._lock.notify_all()
+        if self._script_thread is not None:
+            self._script_thread.join(timeout=5)
+        self._server.shutdown()
+        self._server.server_close()
+
+    # --- Updates ---
+
+    def push_update(self, update: dict) -> int:
+        """Queue an update for the bot; returns its update_id."""
+        update = dict(update, update_id=next(self._update_ids))
+        with self._lock:
+            if self._webhook_queue is not None:
+                self._webhook_queue.put(update)
+            else:
+                self._updates.append(update)
+                self._lock.notify_all()
+        return update['update_id']
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+        with self._lock:
+            # The offset confirms every update before it
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._lock.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+
+    # --- Scripted users ---
+
+    def play(self, scripts: dict, think_time: float = 0.0):
+        """
+        Start scripted users: {chat id: [(update, replies), ...]}.
+
+        Each user's first update is pushed at once, every further one when
+        the bot has sent the replies to the previous step plus a random think
+        time of up to think_time seconds. The time from pushing a step to its
+        last reply is collected in step_seconds.
+        """
+        with self._lock:
+            self.think_time = think_time
+            for chat_id, steps in scripts.items():
+                self._scripts[chat_id] = [list(steps), None]
+                heapq.heappush(self._due, (time.monotonic(), chat_id))
+            if self._script_thread is None:
+                self._script_thread = threading.Thread(target=self._run_scripts, name="fake-bot-api-scripts",
+                                                       daemon=True)
+                self._script_thread.start()
+            self._lock.notify_all()
+
+    def scripts_running(self) -> int:
+        with self._lock:
+            return len(self._scripts)
+
+    def wait_for_scripts(self, timeout: Optional[float] = 60.0) -> bool:
+        """Block until every scripted user got the replies to their last step."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._scripts:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+            return True
+
+    def _run_scripts(self):
+        with self._lock:
+            while not self._stopping:
+                now = time.monotonic()
+                if not self._due or self._due[0][0] > now:
+                    self._lock.wait(self._due[0][0] - now if self._due else None)
+                    continue
+                _, chat_id = heapq.heappop(self._due)
+                script = self._scripts[chat_id]
+                update, replies = script[0].pop(0)
+                script[1] = self._chat_messages[chat_id] + replies
+                self._step_sent[chat_id] = now
+                self.push_update(update)
+
+    def _script_reply(self, chat_id):
+        # Called with the lock held for every message sent to chat_id
+        self._chat_messages[chat_id] += 1
+        script = self._scripts.get(chat_id)
+        if script is None or script[1] is None or self._chat_messages[chat_id] < script[1]:
+            return
+        now = time.monotonic()
+        self.step_seconds.append(now - self._step_sent.pop(chat_id))
+        script[1] = None
+        if script[0]:
+            think = self._random.uniform(0, self.think_time) if self.think_time else 0.0
+            heapq.heappush(self._due, (now + think, chat_id))
+        else:
+            del self._scripts[chat_id]
+
+    # --- Webhook delivery ---
+
+    def _set_webhook(self, params):
+        self._stop_webhook()
+        self.webhook_url = params['url']
+        self.webhook_secret = params.get('secret_token')
+        workers = int(params.get('max_connections') or 40)
+        with self._lock:
+            self._webhook_queue = queue.Queue()
+            for update in self._updates:
+                self._webhook_queue.put(update)
+            self._updates = []
+        self._webhook_threads = [
+            threading.Thread(target=self._deliver_webhooks, args=(self._webhook_queue,), daemon=True)
+            for _ in range(workers)
+        ]
+        for thread in self._webhook_threads:
+            thread.start()
+        return True
+
+    def _stop_webhook(self):
+        with self._lock:
+            pending = self._webhook_queue
+            self._webhook_queue = None
+        if pending is not None:
+            for _ in self._webhook_threads:
+                pending.put(None)
+            for thread in self._webhook_threads:
+                thread.join(timeout=5)
+        self._webhook_threads = []
+        self.webhook_url = None
+        self.webhook_secret = None
+
+    def _deliver_webhooks(self, updates):
+        # Like Telegram: one persistent connection per worker, one update per request
+        url = urlsplit(self.webhook_url)
+        headers = {'Content-Type': 'application/json'}
+        if self.webhook_secret:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = self.webhook_secret
+        connection = http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+        while True:
+            update = updates.get()
+            if update is None:
+                break
+            try:
+                connection.request('POST', url.path, json.dumps(update), headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    logger.warning(f"Webhook answered {response.status} for update {update['update_id']}")
+            except (OSError, http.client.HTTPException) as e:
+                logger.warning(f"Webhook delivery of update {update['update_id']} failed: {e}")
+                connection.close()
+                connection = http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+        connection.close()
+
+    # --- Bot API methods ---
+
+    def call(self, method: str, params: dict):
+        """Answer one API call; returns its result or raises BotAPIError."""
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+        if (self.latency or self.jitter) and method != 'getUpdates':
+            time.sleep(self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0))
+
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            return self._get_updates(params)
+        if method == 'setWebhook':
+            return self._set_webhook(params)
+        if method == 'deleteWebhook':
+            self._stop_webhook()
+            return True
+        if method == 'getWebhookInfo':
+            return {'url': self.webhook_url or '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        if method in self.SEND_METHODS:
+            self._check_flood()
+            if params.get('chat_id') in self.blocked_chats:
+                raise BotAPIError(403, "Forbidden: bot was blocked by the user")
+            return self._record_message(method, params)
+        # answerCallbackQuery, close, logOut, ...
+        return True
+
+    def _check_flood(self):
+        retry_after = None
+        with self._lock:
+            if self.flood_probability and self._random.random() < self.flood_probability:
+                retry_after = self.flood_retry_after
+            elif self.send_rate:
+                now = time.monotonic()
+                second, sends = self._send_window
+                if now - second >= 1.0:
+                    second, sends = now, 0
+                if sends >= self.send_rate:
+                    retry_after = max(1, math.ceil(second + 1.0 - now))
+                else:
+                    sends += 1
+                self._send_window = (second, sends)
+            if retry_after is not None:
+                self.floods += 1
+        if retry_after is not None:
+            raise BotAPIError(429, f"Too Many Requests: retry after {retry_after}", {'retry_after': retry_after})
+
+    def _record_message(self, method, params):
+        chat_id = params.get('chat_id')
+        message = {
+            'message_id': params.get('message_id') or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            'text': params.get('text', ''),
+        }
+        with self._lock:
+            self.sent_messages.append((method, chat_id, params.get('text', '')))
+            if self._scripts:
+                self._script_reply(chat_id)
+            self._lock.notify_all()
+        return message
+
+    def wait_for_messages(self, count: int, timeout: Optional[float] = 30.0) -> bool:
+        """Block until the bot has sent at least `count` messages in total."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while len(self.sent_messages) < count:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+            return True
@@ -0,0 +1,4 @@
+def escape_md(text):
+    if not text:
+        return ""
+    return text.replace("_", "\\_").replace("*", "\\*").replace("`", "\\`").replace("[", "\\[")
@@ -0,0 +1,318 @@
+"""
+Concurrent registration load harness.
+
+Runs N simulated users through the real registration handlers at the same
+time, each with its own isolated MockContext, and reports per-step latency
+percentiles plus database contention. Runs against a throwaway database
+unless --db is given.
+
+--flood-taps instead checks per-user ordering: every user taps each button
+of /register, an admin taps "close" and every user taps "cancel" several
+times at once, through the real Application and update processor against
+fake_bot_api. Each user must still get exactly one answer per step.
+
+Usage:
+    python load_harness.py --users 2000 --concurrency 500
+    python load_harness.py --users 200 --concurrency 256 --flood-taps 10 [--unkeyed]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Optional
+
+from telegram.ext import ConversationHandler, SimpleUpdateProcessor
+
+import async_db as adb
+import database as db
+import event_catalog
+import main
+import mock_users
+from fake_bot_api import FakeBotAPI, callback_update, message_update
+from mock_users import MockContext, MockUpdate, MockUser
+
+logger = logging.getLogger(__name__)
+
+STEPS = ('register', 'event_response', 'neuling_response', 'partner_confirm_response',
+         'partner_name_response', 'finish_registration')
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class LoadRun:
+    """Latency samples of one harness run, per registration step."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.completed = 0
+        self.failed = 0
+
+    async def timed(self, step, coro):
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.samples[step].append(time.perf_counter() - start)
+
+    def summary(self):
+        report = {}
+        for step in STEPS:
+            values = sorted(self.samples.get(step, ()))
+            if not values:
+                continue
+            report[step] = {
+                'count': len(values),
+                'p50_ms': percentile(values, 50) * 1000,
+                'p95_ms': percentile(values, 95) * 1000,
+                'p99_ms': percentile(values, 99) * 1000,
+                'max_ms': values[-1] * 1000,
+            }
+        return report
+
+
+async def simulate_user(run: LoadRun, mock_user: MockUser, event_id: int) -> bool:
+    """Drive one user through /register with their own context."""
+    context = MockContext()
+    result = await run.timed('register', main.register(MockUpdate(mock_user, message_text="/register"), context))
+
+    if result == main.ASK_EVENT:
+        update = MockUpdate(mock_user, callback_data=f"event_{event_id}")
+        result = await run.timed('event_response', main.event_response(update, context))
+
+    if result == main.ASK_NEULING:
+        update = MockUpdate(mock_user, callback_data='neuling_yes' if mock_user.is_neuling else 'neuling_no')
+        result = await run.timed('neuling_response', main.neuling_response(update, context))
+
+    if result == main.ASK_PARTNER_CONFIRM:
+        update = MockUpdate(mock_user, callback_data='partner_yes' if mock_user.partner_name else 'partner_no')
+        result = await run.timed('partner_confirm_response', main.partner_confirm_response(update, context))
+
+    if result == main.ASK_PARTNER_NAME:
+        update = MockUpdate(mock_user, message_text=mock_user.partner_name or "")
+        result = await run.timed('partner_name_response', main.partner_name_response(update, context))
+
+    return result == ConversationHandler.END and context.user_data.get('event_id') == event_id
+
+
+async def run_load(users: int, concurrency: int, event_id: Optional[int] = None,
+                   neuling_probability: float = 0.3, partner_probability: float = 0.4,
+                   seed: Optional[int] = None) -> dict:
+    """
+    Register `users` mock users concurrently, at most `concurrency` at a time.
+
+    Returns a report with throughput, per-step latency percentiles and
+    database contention counters.
+    """
+    if event_id is None:
+        open_events = (await event_catalog.snapshot()).open_events
+        if not open_events:
+            raise ValueError("No open event to register for")
+        event_id = open_events[0]['id']
+
+    rng = random.Random(seed)
+    start_index = await mock_users._next_mock_index()
+    run = LoadRun()
+    gate = asyncio.Semaphore(concurrency)
+
+    # finish_registration is reached through other handlers; time it on its own
+    original_finish = main.finish_registration
+
+    async def timed_finish(update, context, partner_name):
+        return await run.timed('finish_registration', original_finish(update, context, partner_name))
+
+    async def one(index):
+        mock_user = MockUser.create_random(start_index + index, neuling_probability, partner_probability, rng)
+        async with gate:
+            try:
+                ok = await simulate_user(run, mock_user, event_id)
+            except Exception as e:
+                logger.error(f"Mock user {mock_user.user_id} failed: {e}", exc_info=True)
+                ok = False
+        if ok:
+            run.completed += 1
+        else:
+            run.failed += 1
+
+    db.reset_lock_stats()
+    adb.reset_queue_stats()
+    main.finish_registration = timed_finish
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(one(i) for i in range(users)))
+    finally:
+        main.finish_registration = original_finish
+    elapsed = time.perf_counter() - started
+
+    return {
+        'users': users,
+        'concurrency': concurrency,
+        'completed': run.completed,
+        'failed': run.failed,
+        'seconds': elapsed,
+        'registrations_per_second': run.completed / elapsed if elapsed else float('inf'),
+        'steps': run.summary(),
+        'db_locks': db.lock_stats(),
+        'db_queue': adb.queue_stats(),
+    }
+
+
+def print_report(report: dict):
+    print(f"users={report['users']} concurrency={report['concurrency']} "
+          f"completed={report['completed']} failed={report['failed']} "
+          f"time={report['seconds']:.2f}s ({report['registrations_per_second']:.0f} registrations/s)")
+    print(f"{'step':<26}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for step, stats in report['steps'].items():
+        print(f"{step:<26}{stats['count']:>8}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}"
+              f"{stats['p99_ms']:>10.2f}{stats['max_ms']:>10.2f}")
+    locks = report['db_locks']
+    queue = report['db_queue']
+    print(f"db: {locks['transactions']} transactions, {locks['lock_waits']} waited for the write lock "
+          f"({locks['lock_wait_seconds']:.3f}s), {locks['lock_errors']} 'database is locked' errors")
+    print(f"db thread: {queue['calls']} calls, {queue['queued']} queued behind others "
+          f"({queue['queue_wait_seconds']:.3f}s total)")
+
+
+# Flood check: each of these replies must reach every user exactly once
+FLOOD_EXPECTATIONS = (
+    ('partner_question', 'sendMessage', "Bringst du eine weitere Person mit?"),
+    ('registered', 'sendMessage', "✅ *Registrierung erfolgreich!*"),
+    ('cancelled', 'editMessageText', "Registrierung storniert."),
+)
+FLOOD_ADMIN_ID = 999
+
+
+async def _settle(application, api, quiet=0.5):
+    """Wait until the bot has processed everything and stopped talking."""
+    seen = -1
+    while True:
+        await asyncio.sleep(quiet)
+        busy = (application.update_queue.qsize()
+                or application.update_processor.current_concurrent_updates)
+        if not busy and len(api.sent_messages) == seen:
+            return
+        seen = len(api.sent_messages)
+
+
+async def run_flood(users: int, taps: int, concurrency: int, event_id: int, keyed: bool = True) -> dict:
+    """
+    Flood every user (and one admin) with duplicate taps and count replies.
+
+    Returns per-step violations: users who got a reply other than exactly
+    once, plus allocation runs and counter mismatches.
+    """
+    main.ADMIN_IDS = [FLOOD_ADMIN_ID]
+    api = FakeBotAPI().start()
+    processor = concurrency if keyed else SimpleUpdateProcessor(concurrency)
+    application = main.build_application(FakeBotAPI.TOKEN, base_url=api.base_url, concurrent_updates=processor)
+    await application.initialize()
+    await application.updater.start_polling(poll_interval=0.0, timeout=5)
+    await application.start()
+
+    user_ids = [2000000 + i for i in range(users)]
+    started = time.perf_counter()
+    try:
+        for user_id in user_ids:
+            api.push_update(message_update(user_id, "/register"))
+            for _ in range(taps):
+                api.push_update(callback_update(user_id, "neuling_no"))
+            for _ in range(taps):
+                api.push_update(callback_update(user_id, "partner_no"))
+        await _settle(application, api)
+
+        for _ in range(taps):
+            api.push_update(callback_update(FLOOD_ADMIN_ID, f"admin_close_{event_id}"))
+        await _settle(application, api)
+
+        for user_id in user_ids:
+            for _ in range(taps):
+                api.push_update(callback_update(user_id, f"cancel_{event_id}"))
+        await _settle(application, api)
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        api.stop()
+    elapsed = time.perf_counter() - started
+
+    received = defaultdict(lambda: defaultdict(int))
+    for method, chat_id, text in api.sent_messages:
+        for step, expected_method, prefix in FLOOD_EXPECTATIONS:
+            if method == expected_method and text.startswith(prefix):
+                received[step][int(chat_id)] += 1
+
+    violations = {step: sum(1 for user_id in user_ids if received[step][user_id] != 1)
+                  for step, _, _ in FLOOD_EXPECTATIONS}
+    violations['allocations'] = abs(sum(1 for _, chat_id, text in api.sent_messages
+                                        if text.startswith("Zuteilung für")) - 1)
+    violations['counter_mismatches'] = len(await adb.check_event_counters(event_id))
+    return {
+        'users': users,
+        'taps': taps,
+        'keyed': keyed,
+        'updates': users * taps * 3 + users + taps,
+        'seconds': elapsed,
+        'violations': violations,
+    }
+
+
+def print_flood_report(report: dict):
+    processor = "KeyedUpdateProcessor" if report['keyed'] else "SimpleUpdateProcessor"
+    print(f"flood: {report['users']} users x {report['taps']} taps, {report['updates']} updates "
+          f"in {report['seconds']:.2f}s with {processor}")
+    for step, count in report['violations'].items():
+        print(f"  {step:<20}{'ok' if count == 0 else f'{count} inconsistent'}")
+
+
+async def _main(args):
+    if args.db:
+        db.DB_NAME = args.db
+    else:
+        db.DB_NAME = os.path.join(tempfile.mkdtemp(prefix="whipbot_load_"), "load.db")
+    await adb.run(db.init_db)
+    event_catalog.invalidate()
+
+    event_id = args.event_id
+    if event_id is None and not (await event_catalog.snapshot()).open_events:
+        event_id = await adb.create_event("Load Test", seat_limit=35)
+        await adb.set_event_open(event_id, True)
+
+    if args.flood_taps:
+        if event_id is None:
+            event_id = (await event_catalog.snapshot()).open_events[0]['id']
+        report = await run_flood(args.users, args.flood_taps, args.concurrency, event_id, not args.unkeyed)
+        print_flood_report(report)
+        if any(report['violations'].values()):
+            sys.exit(1)
+        return
+
+    report = await run_load(args.users, args.concurrency, event_id, args.neuling_prob,
+                            args.partner_prob, args.seed)
+    print_report(report)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Concurrent registration load harness")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--event-id", type=int, default=None)
+    parser.add_argument("--neuling-prob", type=float, default=0.3)
+    parser.add_argument("--partner-prob", type=float, default=0.4)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--db", default=None, help="Database file (default: a fresh temporary one)")
+    parser.add_argument("--flood-taps", type=int, default=0,
+                        help="Run the duplicate-tap flood check with this many taps per button")
+    parser.add_argument("--unkeyed", action="store_true",
+                        help="Flood check with PTB's plain concurrent processor, for comparison")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(_main(args))
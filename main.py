@@ -1,17 +1,81 @@
 import os
 import logging
-import random
+import secrets
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, ConversationHandler, CallbackQueryHandler, MessageHandler, filters
+from telegram.ext import ApplicationBuilder, BaseUpdateProcessor, ContextTypes, CommandHandler, ConversationHandler, CallbackQueryHandler, MessageHandler, filters
 import database as db
+import async_db as adb
 import mock_users
+import event_catalog
+from formatting import escape_md
+import outbox
+import broadcast
+import waitlist
+import waiting_positions
+import registration_list
+import metrics
+import projection
+import allocation
+import allocation_pool
+from update_processor import KeyedUpdateProcessor
+from update_recorder import UpdateRecorder
+from persistence import SQLitePersistence, DEFAULT_UPDATE_INTERVAL
 
 # Load environment variables
 load_dotenv()
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x]
 
+# Outbox delivery (allocation notifications)
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", outbox.DEFAULT_CONCURRENCY))
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE", outbox.DEFAULT_RATE))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", outbox.DEFAULT_CHAT_RATE))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", outbox.DEFAULT_MAX_ATTEMPTS))
+
+# /admin_broadcast delivery; broadcasts share OUTBOX_RATE with the outbox
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", broadcast.DEFAULT_CONCURRENCY))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", broadcast.DEFAULT_PAGE_SIZE))
+
+# Upper bound for /mock_users ... bulk
+MOCK_USERS_BULK_MAX = 500000
+
+# How long a waiting-list offer stays open before it passes to the next person
+OFFER_TIMEOUT_MINUTES = float(os.getenv("OFFER_TIMEOUT_MINUTES", waitlist.DEFAULT_OFFER_TIMEOUT_MINUTES))
+waitlist.offer_timeout_seconds = OFFER_TIMEOUT_MINUTES * 60
+
+# Update delivery: 'polling' (default) or 'webhook'
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+# Public HTTPS URL Telegram posts updates to (the reverse proxy in front of WEBHOOK_PORT)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Telegram sends this back with every update; requests without it are rejected
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+
+# How many updates are handled at the same time (1 = strictly one after another).
+# Updates of one user (and admin actions on one event) always run in order.
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+
+# Seconds between writes of changed registration state (user_data, conversations)
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", DEFAULT_UPDATE_INTERVAL))
+
+# Allocation of large events in worker processes (0 workers: on the event loop)
+allocation_pool.workers = int(os.getenv("ALLOCATION_WORKERS", allocation_pool.DEFAULT_WORKERS))
+allocation_pool.process_threshold = int(os.getenv("ALLOCATION_PROCESS_THRESHOLD", allocation_pool.DEFAULT_PROCESS_THRESHOLD))
+# Seconds between progress updates of a running allocation in the admin chat
+ALLOCATION_PROGRESS_INTERVAL = float(os.getenv("ALLOCATION_PROGRESS_INTERVAL", allocation_pool.DEFAULT_PROGRESS_INTERVAL))
+
+# Anonymized log of every handled update for replay benchmarks (update_recorder.py); off unless a file is set
+UPDATE_RECORD_FILE = os.getenv("UPDATE_RECORD_FILE")
+# Key for the user id pseudonyms; without it they only match within one run
+UPDATE_RECORD_SALT = os.getenv("UPDATE_RECORD_SALT")
+
+# Prometheus metrics endpoint (http://METRICS_LISTEN:METRICS_PORT/metrics); off unless a port is set
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0)
+
 # Logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -21,26 +85,6 @@ logging.basicConfig(
 # States for Registration Conversation
 ASK_EVENT, ASK_NEULING, ASK_PARTNER_CONFIRM, ASK_PARTNER_NAME = range(4)
 
-def find_partner(partner_name, all_registrations):
-    if not partner_name:
-        return None
-    partner_name = partner_name.lower().strip()
-    # Remove @ if present
-    if partner_name.startswith('@'):
-        partner_name = partner_name[1:]
-        
-    for reg in all_registrations:
-        if reg['full_name'].lower().strip() == partner_name:
-            return reg
-        if reg['username'] and reg['username'].lower().strip() == partner_name:
-            return reg
-    return None
-
-def escape_md(text):
-    if not text:
-        return ""
-    return text.replace("_", "\\_").replace("*", "\\*").replace("`", "\\`").replace("[", "\\[")
-
 async def create_event(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if user.id not in ADMIN_IDS:
@@ -56,7 +100,7 @@ async def create_event(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     name = " ".join(context.args)
     # Default seat limit is 35
-    event_id = db.create_event(name, seat_limit=35)
+    event_id = await adb.create_event(name, seat_limit=35)
     await update.message.reply_text(f"Event '{name}' erstellt mit ID {event_id}. Sitzplatzlimit: 35")
 
 async def admin_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -68,19 +112,13 @@ async def admin_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Bitte führe Admin-Aktionen im privaten Chat aus.")
         return
     
-    events = db.get_events()
-    # Filter for closed events
-    closed_events = [e for e in events if not e['is_open']]
+    catalog = await event_catalog.snapshot()
     
-    if not closed_events:
+    if not catalog.closed_events:
         await update.message.reply_text("Keine geschlossenen Events zum Öffnen gefunden.")
         return
         
-    keyboard = []
-    for e in closed_events:
-        keyboard.append([InlineKeyboardButton(e['name'], callback_data=f"admin_open_{e['id']}")])
-        
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = catalog.keyboard("admin_open_")
     await update.message.reply_text("Wähle ein Event zum ÖFFNEN:", reply_markup=reply_markup)
 
 async def admin_close(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -92,220 +130,149 @@ async def admin_close(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Bitte führe Admin-Aktionen im privaten Chat aus.")
         return
     
-    events = db.get_events()
-    # Filter for open events
-    open_events = [e for e in events if e['is_open']]
+    catalog = await event_catalog.snapshot()
     
-    if not open_events:
+    if not catalog.open_events:
         await update.message.reply_text("Keine offenen Events zum Schließen gefunden.")
         return
         
-    keyboard = []
-    for e in open_events:
-        keyboard.append([InlineKeyboardButton(e['name'], callback_data=f"admin_close_{e['id']}")])
-        
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = catalog.keyboard("admin_close_")
     await update.message.reply_text("Wähle ein Event zum SCHLIESSEN:", reply_markup=reply_markup)
 
 async def admin_event_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    # Callback data can be forged by any client, not just sent by our buttons
+    if update.effective_user.id not in ADMIN_IDS:
+        return
     
     data = query.data
     action, event_id = data.rsplit('_', 1)
     event_id = int(event_id)
-    event = db.get_event(event_id)
+    catalog = await event_catalog.snapshot()
+    event = catalog.get(event_id)
     
     if not event:
         await query.edit_message_text("Event nicht gefunden.")
         return
 
     if action == 'admin_open':
-        db.set_event_open(event_id, True)
+        await adb.set_event_open(event_id, True)
         await query.edit_message_text(f"Registrierung für '{event['name']}' ist jetzt GEÖFFNET.")
         
     elif action == 'admin_close':
-        db.set_event_open(event_id, False)
+        if not event['is_open']:
+            # A second tap on the same button; the first one already allocated
+            await query.edit_message_text(f"Registrierung für '{event['name']}' ist bereits geschlossen.")
+            return
+        await adb.set_event_open(event_id, False)
         await query.edit_message_text(f"Registrierung für '{event['name']}' GESCHLOSSEN. Berechne Plätze...")
         await perform_allocation(update, context, event_id)
         
+    elif action == 'admin_preview':
+        preview = await adb.run(projection.preview, event_id)
+        await query.edit_message_text(projection.render(preview, event['name']), parse_mode='Markdown')
+
     elif action == 'admin_list':
-        registrations = db.get_event_registrations(event_id)
-        if not registrations:
+        page = await adb.run(registration_list.render_page, event_id, catalog.safe_name(event_id))
+        if page is None:
             await query.edit_message_text(f"Keine Registrierungen für '{event['name']}' gefunden.")
             return
+        await show_registration_page(update, context, page)
 
-        count = 0
-        for reg in registrations:
-            count += 1
-            if reg['partner_name']:
-                # Check if partner is registered separately to avoid double counting
-                partner_reg = find_partner(reg['partner_name'], registrations)
-                if not partner_reg:
-                    count += 1
-                # If partner IS registered, they will be counted when their own entry is processed
-                # However, we need to be careful not to double count if we iterate all.
-                # Actually, if both registered, they are 2 entries = 2 count.
-                # If only one registered + partner name, that is 1 entry but should be 2 count.
-                # Correct logic:
-                # If partner_name is present AND partner is NOT in the list as a separate user, add +1.
-        
-        safe_event_name = escape_md(event['name'])
-        msg = f"📋 *Registrierungen für {safe_event_name} ({count} Plätze):*\n\n"
-        for reg in registrations:
-            icon = "✅" if reg['status'] == 'ACCEPTED' else "⏳" if reg['status'] == 'PENDING' else "❌" if reg['status'] == 'CANCELLED' else "📝"
-            safe_name = escape_md(reg['full_name'])
-            safe_username = escape_md(reg['username'])
-            safe_partner = escape_md(reg['partner_name'])
-            
-            partner_str = f" (Begleitung: {safe_partner})" if safe_partner else ""
-            neuling = " [Neuling]" if reg['is_neuling'] else ""
-            admin = " [Admin]" if reg['is_admin'] else ""
-            
-            line = f"{icon} {safe_name} (@{safe_username}){partner_str}{neuling}{admin} - {reg['status']}\n"
-            if len(msg) + len(line) > 4000:
-                logging.info(f"Sending chunk: {msg}")
-                await context.bot.send_message(chat_id=query.message.chat_id, text=msg, parse_mode='Markdown')
-                msg = ""
-            msg += line
-            
-        if msg:
-            logging.info(f"Sending final chunk: {msg}")
-            try:
-                await query.edit_message_text(msg, parse_mode='Markdown')
-            except Exception as e:
-                logging.error(f"Edit failed: {e}")
-                # Fallback to send if edit fails (e.g. message too long or same content)
-                await context.bot.send_message(chat_id=query.message.chat_id, text=msg, parse_mode='Markdown')
+async def show_registration_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page):
+    query = update.callback_query
+    text, reply_markup = page
+    try:
+        await query.edit_message_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+    except Exception as e:
+        logging.error(f"Edit failed: {e}")
+        # Fallback to send if edit fails (e.g. same content)
+        await context.bot.send_message(chat_id=query.message.chat_id, text=text, parse_mode='Markdown', reply_markup=reply_markup)
 
-async def perform_allocation(update: Update, context: ContextTypes.DEFAULT_TYPE, event_id):
-    # Allocation Logic
-    all_regs = db.get_pending_registrations(event_id)
-    # Convert to list of dicts for easier handling
-    pending = [dict(r) for r in all_regs]
-    
-    accepted_ids = set()
-    event = db.get_event(event_id)
-    seats_limit = event['seat_limit']
-    seats_taken = 0
-    
-    def accept(reg):
-        nonlocal seats_taken
-        if reg['user_id'] in accepted_ids:
-            return
-        accepted_ids.add(reg['user_id'])
-        seats_taken += 1
-        db.update_status(reg['user_id'], event_id, 'ACCEPTED')
-    
-    # 1. Admins
-    admins = [r for r in pending if r['is_admin']]
-    for r in admins:
-        if r['user_id'] in accepted_ids:
-            continue
-            
-        partner_reg = find_partner(r['partner_name'], pending)
-        if r['partner_name'] and not partner_reg:
-             # Partner not registered, but counts as seat
-             accept(r)
-             seats_taken += 1
-        elif partner_reg:
-             accept(r)
-             accept(partner_reg)
-        else:
-             accept(r)
-            
-    # 2. Neulings
-    neulings = [r for r in pending if r['is_neuling'] and r['user_id'] not in accepted_ids]
-    for r in neulings:
-        if r['user_id'] in accepted_ids:
-            continue
+async def admin_list_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """◀️/▶️ pager of the /admin_list registration view."""
+    query = update.callback_query
+    await query.answer()
+    if update.effective_user.id not in ADMIN_IDS:
+        return
 
-        partner_reg = find_partner(r['partner_name'], pending)
-        if r['partner_name'] and not partner_reg:
-             # Partner not registered, but counts as seat
-             accept(r)
-             seats_taken += 1
-        elif partner_reg:
-             accept(r)
-             accept(partner_reg)
-        else:
-             accept(r)
-            
-    # 3. Random
-    remaining = [r for r in pending if r['user_id'] not in accepted_ids]
-    random.shuffle(remaining)
-    
-    for r in remaining:
-        if seats_taken >= seats_limit:
-            break
-        
-        if r['user_id'] in accepted_ids:
+    event_id, direction, anchor = registration_list.parse_callback(query.data)
+    safe_event_name = (await event_catalog.snapshot()).safe_name(event_id)
+    if direction == 'p':
+        page = await adb.run(registration_list.render_page, event_id, safe_event_name, before_id=anchor)
+    else:
+        page = await adb.run(registration_list.render_page, event_id, safe_event_name, after_id=anchor)
+    if page is None:
+        await query.edit_message_text("Keine Registrierungen gefunden.")
+        return
+    await show_registration_page(update, context, page)
+
+def _write_allocation(event_id, rows, result, safe_event_name):
+    # Runs on the database thread: builds every status change and
+    # notification of an allocation and commits them together. rows are the
+    # snapshot the allocation ran on, so result.outcome[i] belongs to rows[i].
+    waiting_msg = f"⏳ Registrierung für '{safe_event_name}' geschlossen.\n\nDu bist auf der *WARTELISTE*. Wir benachrichtigen dich, falls ein Platz frei wird! 🤞"
+    accepted_msg = f"🎉 *Glückwunsch!* 🎉\n\nDu hast einen Platz für '{safe_event_name}'! Wir freuen uns auf dich! 🙌"
+    waiting_statuses, waiting_messages = [], []
+    accepted_statuses, accepted_messages = [], []
+    for row, outcome in zip(rows, result.outcome):
+        user_id = row[0]
+        if outcome == allocation.WAITING:
+            waiting_statuses.append((user_id, 'WAITING'))
+            waiting_messages.append((user_id, waiting_msg, 'Markdown'))
             continue
-            
-        # Check if user has a partner (registered or just named)
-        has_partner = bool(r['partner_name'])
-        
-        if has_partner:
-            # Check if partner is also registered
-            partner_reg = find_partner(r['partner_name'], pending)
-            
-            if partner_reg:
-                # Partner is registered separately
-                if partner_reg['user_id'] in accepted_ids:
-                    # Partner already accepted, just accept this one
-                    if seats_taken + 1 <= seats_limit:
-                        accept(r)
-                else:
-                    # Both need acceptance
-                    if seats_taken + 2 <= seats_limit:
-                        accept(r)
-                        accept(partner_reg)
-            else:
-                # Partner is NOT registered (just a name)
-                # We still count them as a seat!
-                if seats_taken + 2 <= seats_limit:
-                    accept(r)
-                    seats_taken += 1 # Extra seat for the non-registered partner
-        else:
-            # Single user
-            if seats_taken + 1 <= seats_limit:
-                accept(r)
-    
-    # 4. Waiting List
-    for r in pending:
-        if r['user_id'] not in accepted_ids:
-            db.update_status(r['user_id'], event_id, 'WAITING')
-            try:
-                safe_event_name = escape_md(event['name'])
-                await context.bot.send_message(chat_id=r['user_id'], text=f"⏳ Registrierung für '{safe_event_name}' geschlossen.\n\nDu bist auf der *WARTELISTE*. Wir benachrichtigen dich, falls ein Platz frei wird! 🤞", parse_mode='Markdown')
-            except Exception as e:
-                logging.error(f"Failed to send message to {r['user_id']}: {e}")
-
-    # Notify Accepted
-    for uid in accepted_ids:
+        accepted_statuses.append((user_id, 'ACCEPTED'))
+        msg = accepted_msg
+        if outcome == allocation.ACCEPTED_WITH_GUEST:
+            # Partner was not registered, so we inform the user they are both in
+            safe_partner = escape_md(row[6])  # partner_name, see allocation.SNAPSHOT_COLUMNS
+            msg += f"\n\n👥 Deine Begleitung ({safe_partner}) ist auch dabei!"
+        accepted_messages.append((user_id, msg, 'Markdown'))
+
+    # Registrations that changed since the snapshot (e.g. cancelled) are skipped
+    written = db.apply_allocation(event_id, waiting_statuses + accepted_statuses, waiting_messages + accepted_messages)
+    if written < len(rows):
+        logging.info(f"Allocation of event {event_id}: {len(rows) - written} registrations changed meanwhile, left as they are")
+
+async def perform_allocation(update: Update, context: ContextTypes.DEFAULT_TYPE, event_id):
+    catalog = await event_catalog.snapshot()
+    event = catalog.get(event_id)
+    safe_event_name = catalog.safe_name(event_id)
+
+    # Reading, allocating and writing all happen off the event loop, the
+    # allocation of large events in a worker process (allocation_pool)
+    progress = allocation_pool.ProgressMessage(update.callback_query.edit_message_text, ALLOCATION_PROGRESS_INTERVAL)
+    async with progress:
+        progress.step(f"Registrierung für '{event['name']}' GESCHLOSSEN. Lade Anmeldungen...")
+        rows = await adb.get_allocation_snapshot(event_id)
+
+        # Seats are assigned in memory first; every status change is written in
+        # one transaction afterwards so a crash never leaves a half-allocated event
+        progress.step(f"Registrierung für '{event['name']}' GESCHLOSSEN. Verteile Plätze an {len(rows)} Anmeldungen...")
+        result = await allocation_pool.allocate(rows, event['seat_limit'])
+        seats_taken = result.seats_taken
+        logging.info(f"Allocated event {event_id} with seed {result.seed}: {seats_taken} seats, {result.accepted_count} accepted")
+
+        progress.step(f"Registrierung für '{event['name']}' GESCHLOSSEN. Speichere Ergebnis...")
+        # Statuses and notifications are committed together; the outbox worker
+        # delivers the messages in the background so allocation returns at once
+        await adb.run(_write_allocation, event_id, rows, result, safe_event_name)
+    if progress.edits:
         try:
-            # Find registration to check for partner
-            reg = next((r for r in pending if r['user_id'] == uid), None)
-            safe_event_name = escape_md(event['name'])
-            msg = f"🎉 *Glückwunsch!* 🎉\n\nDu hast einen Platz für '{safe_event_name}'! Wir freuen uns auf dich! 🙌"
-            
-            if reg and reg['partner_name']:
-                partner_reg = find_partner(reg['partner_name'], pending)
-                if not partner_reg:
-                    # Partner was not registered, so we inform the user they are both in
-                    safe_partner = escape_md(reg['partner_name'])
-                    msg += f"\n\n👥 Deine Begleitung ({safe_partner}) ist auch dabei!"
-            
-            await context.bot.send_message(chat_id=uid, text=msg, parse_mode='Markdown')
+            await update.callback_query.edit_message_text(f"Registrierung für '{event['name']}' GESCHLOSSEN.")
         except Exception as e:
-            logging.error(f"Failed to send message to {uid}: {e}")
+            logging.warning(f"Failed to reset progress message: {e}")
+    outbox.wake()
+    metrics.ALLOCATIONS.inc()
+    seats_in_use = await adb.get_seats_taken(event_id)
     
     # Notify admin that allocation is complete
     try:
-        safe_event_name = escape_md(event['name'])
         await context.bot.send_message(
             chat_id=update.effective_chat.id, 
-            text=f"Zuteilung für '{safe_event_name}' abgeschlossen. {seats_taken} Plätze vergeben.",
+            text=f"Zuteilung für '{safe_event_name}' abgeschlossen. {seats_taken} Plätze vergeben "
+                 f"({seats_in_use}/{event['seat_limit']} belegt).",
             parse_mode='Markdown'
         )
     except Exception as e:
@@ -320,18 +287,31 @@ async def admin_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Please perform admin actions in a private chat.")
         return
 
-    events = db.get_events()
-    if not events:
+    catalog = await event_catalog.snapshot()
+    if not catalog.events:
         await update.message.reply_text("Keine Events gefunden.")
         return
 
-    keyboard = []
-    for e in events:
-        keyboard.append([InlineKeyboardButton(e['name'], callback_data=f"admin_list_{e['id']}")])
-        
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = catalog.keyboard("admin_list_")
     await update.message.reply_text("Wähle ein Event, um die Registrierungen zu sehen:", reply_markup=reply_markup)
 
+async def admin_preview(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user.id not in ADMIN_IDS:
+        return
+
+    if update.effective_chat.type != 'private':
+        await update.message.reply_text("Bitte führe Admin-Aktionen im privaten Chat aus.")
+        return
+
+    catalog = await event_catalog.snapshot()
+    if not catalog.open_events:
+        await update.message.reply_text("Keine offenen Events gefunden.")
+        return
+
+    reply_markup = catalog.keyboard("admin_preview_")
+    await update.message.reply_text("Wähle ein Event für die Zuteilungsvorschau:", reply_markup=reply_markup)
+
 async def mock_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin command to create mock users for testing."""
     user = update.effective_user
@@ -342,44 +322,49 @@ async def mock_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("Please perform admin actions in a private chat.")
         return
     
-    # Parse arguments: /mock_users <count> [event_id] [neuling_prob] [partner_prob]
-    if not context.args:
+    # Parse arguments: /mock_users <count> [event_id] [neuling_prob] [partner_prob] [bulk]
+    # 'bulk' inserts straight into the database instead of running the handlers
+    args = [a for a in (context.args or []) if a.lower() != 'bulk']
+    bulk = len(args) != len(context.args or [])
+    if not args:
         await update.message.reply_text(
-            "Verwendung: /mock_users <anzahl> [event_id] [neuling_wahrscheinlichkeit] [partner_wahrscheinlichkeit]\n\n"
+            "Verwendung: /mock_users <anzahl> [event_id] [neuling_wahrscheinlichkeit] [partner_wahrscheinlichkeit] [bulk]\n\n"
             "Beispiele:\n"
             "/mock_users 10 - Erstellt 10 Mock-User für das erste offene Event\n"
             "/mock_users 5 1 - Erstellt 5 Mock-User für Event ID 1\n"
-            "/mock_users 10 1 0.5 0.3 - 10 User, Event 1, 50% Neulings, 30% mit Partner"
+            "/mock_users 10 1 0.5 0.3 - 10 User, Event 1, 50% Neulings, 30% mit Partner\n"
+            f"/mock_users 50000 1 bulk - 50000 User direkt in die Datenbank (max. {MOCK_USERS_BULK_MAX})"
         )
         return
     
     try:
-        count = int(context.args[0])
-        if count < 1 or count > 100:
-            await update.message.reply_text("Anzahl muss zwischen 1 und 100 liegen.")
+        count = int(args[0])
+        max_count = MOCK_USERS_BULK_MAX if bulk else 100
+        if count < 1 or count > max_count:
+            await update.message.reply_text(f"Anzahl muss zwischen 1 und {max_count} liegen.")
             return
         
         event_id = None
-        if len(context.args) > 1:
-            event_id = int(context.args[1])
+        if len(args) > 1:
+            event_id = int(args[1])
         
         neuling_prob = 0.3
-        if len(context.args) > 2:
-            neuling_prob = float(context.args[2])
+        if len(args) > 2:
+            neuling_prob = float(args[2])
             if not 0 <= neuling_prob <= 1:
                 await update.message.reply_text("Neuling-Wahrscheinlichkeit muss zwischen 0 und 1 liegen.")
                 return
         
         partner_prob = 0.4
-        if len(context.args) > 3:
-            partner_prob = float(context.args[3])
+        if len(args) > 3:
+            partner_prob = float(args[3])
             if not 0 <= partner_prob <= 1:
                 await update.message.reply_text("Partner-Wahrscheinlichkeit muss zwischen 0 und 1 liegen.")
                 return
         
         # Check if event exists and is open (if specified)
         if event_id:
-            event = db.get_event(event_id)
+            event = (await event_catalog.snapshot()).get(event_id)
             if not event:
                 await update.message.reply_text(f"Event mit ID {event_id} nicht gefunden.")
                 return
@@ -389,20 +374,28 @@ async def mock_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
         # Send status message
         status_msg = await update.message.reply_text(
-            f"Erstelle {count} Mock-User...\n"
+            f"Erstelle {count} Mock-User{' (Bulk)' if bulk else ''}...\n"
             f"Event ID: {event_id if event_id else 'Auto'}\n"
             f"Neuling-Wahrscheinlichkeit: {neuling_prob*100:.0f}%\n"
             f"Partner-Wahrscheinlichkeit: {partner_prob*100:.0f}%"
         )
         
         # Create mock users
-        results = await mock_users.create_mock_users(
-            count=count,
-            context=context,
-            event_id=event_id,
-            neuling_probability=neuling_prob,
-            partner_probability=partner_prob
-        )
+        if bulk:
+            results = await mock_users.create_mock_users_bulk(
+                count=count,
+                event_id=event_id,
+                neuling_probability=neuling_prob,
+                partner_probability=partner_prob
+            )
+        else:
+            results = await mock_users.create_mock_users(
+                count=count,
+                context=context,
+                event_id=event_id,
+                neuling_probability=neuling_prob,
+                partner_probability=partner_prob
+            )
         
         # Report results
         success_count = results['success']
@@ -429,9 +422,14 @@ async def mock_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text(f"Fehler beim Erstellen der Mock-User: {e}")
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if update.effective_chat.type == 'private':
+        # Known users are the recipients of /admin_broadcast
+        await adb.upsert_user(user.id, user.username, user.full_name)
+
     # Check for open events
-    events = db.get_events()
-    open_events = [e for e in events if e['is_open']]
+    catalog = await event_catalog.snapshot()
+    open_events = catalog.open_events
     
     welcome_text = (
         "Willkommen beim WHIP Wizard Bot! 🧙‍♂️\n\n"
@@ -444,7 +442,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if open_events:
         welcome_text += "📅 **Aktuell offene Events:**\n"
         for e in open_events:
-            safe_name = escape_md(e['name'])
+            safe_name = catalog.safe_name(e['id'])
             welcome_text += f"  • {safe_name}\n"
         welcome_text += "\nNutze /register, um dich anzumelden!"
     else:
@@ -460,8 +458,10 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"Bitte registriere dich privat bei mir: t.me/{bot_username}?start=register")
         return ConversationHandler.END
 
-    events = db.get_events()
-    open_events = [e for e in events if e['is_open']]
+    await adb.upsert_user(user.id, user.username, user.full_name)
+
+    catalog = await event_catalog.snapshot()
+    open_events = catalog.open_events
     
     if not open_events:
         await update.message.reply_text("Aktuell sind keine Events für die Registrierung geöffnet.")
@@ -473,10 +473,7 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await ask_neuling(update, context)
     
     # Multiple events
-    keyboard = []
-    for e in open_events:
-        keyboard.append([InlineKeyboardButton(e['name'], callback_data=f"event_{e['id']}")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = catalog.keyboard("event_")
     await update.message.reply_text("Bitte wähle ein Event für die Registrierung:", reply_markup=reply_markup)
     return ASK_EVENT
 
@@ -485,7 +482,7 @@ async def event_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     event_id = int(query.data.split('_')[1])
-    event = db.get_event(event_id)
+    event = (await event_catalog.snapshot()).get(event_id)
     
     if not event or not event['is_open']:
         await query.edit_message_text("Dieses Event ist nicht mehr geöffnet.")
@@ -501,7 +498,7 @@ async def ask_neuling(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     event_id = context.user_data['event_id']
     
-    existing = db.get_registration(user.id, event_id)
+    existing = await adb.get_registration(user.id, event_id)
     if existing:
         msg = "Du bist bereits für dieses Event registriert."
         if update.callback_query:
@@ -581,7 +578,7 @@ async def finish_registration(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     # Save to DB
     try:
-        success = db.add_registration(user.id, event_id, user.username, user.full_name, is_neuling, partner_name)
+        success = await adb.add_registration(user.id, event_id, user.username, user.full_name, is_neuling, partner_name)
     except Exception as e:
         logging.error(f"DB Error: {e}")
         success = False
@@ -589,7 +586,7 @@ async def finish_registration(update: Update, context: ContextTypes.DEFAULT_TYPE
     if success:
         # Check if user is admin
         if user.id in ADMIN_IDS:
-            db.set_admin(user.id, event_id, True)
+            await adb.set_admin(user.id, event_id, True)
             
         msg = (
             "✅ *Registrierung erfolgreich!* ✅\n\n"
@@ -611,31 +608,6 @@ async def finish_registration(update: Update, context: ContextTypes.DEFAULT_TYPE
         
     return ConversationHandler.END
 
-async def notify_next_waiting(context: ContextTypes.DEFAULT_TYPE, event_id):
-    waiting_list = db.get_waiting_list(event_id)
-    if not waiting_list:
-        return
-
-    next_person = waiting_list[0]
-    db.update_status(next_person['user_id'], event_id, 'OFFERED')
-    
-    event = db.get_event(event_id)
-    
-    keyboard = [
-        [InlineKeyboardButton("Annehmen", callback_data=f'offer_accept_{event_id}')],
-        [InlineKeyboardButton("Ablehnen", callback_data=f'offer_deny_{event_id}')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    try:
-        await context.bot.send_message(
-            chat_id=next_person['user_id'],
-            text=f"Ein Platz für '{event['name']}' ist frei geworden! Möchtest du ihn annehmen?",
-            reply_markup=reply_markup
-        )
-    except Exception as e:
-        logging.error(f"Failed to notify {next_person['user_id']}: {e}")
-
 async def offer_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -645,45 +617,55 @@ async def offer_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
     event_id = int(event_id)
     
     user = update.effective_user
-    reg = db.get_registration(user.id, event_id)
-    
-    if not reg or reg['status'] != 'OFFERED':
+    new_status = 'ACCEPTED' if action == 'offer_accept' else 'DECLINED'
+    # Only succeeds while the offer is still open (not expired or answered)
+    if not await adb.resolve_offer(user.id, event_id, new_status):
         await query.edit_message_text("Dieses Angebot ist nicht mehr gültig.")
         return
+    waitlist.cancel_expiry(context.job_queue, user.id, event_id)
 
-    if action == 'offer_accept':
-        db.update_status(user.id, event_id, 'ACCEPTED')
+    if new_status == 'ACCEPTED':
         await query.edit_message_text("Du hast den Platz angenommen! Wir sehen uns.")
     else:
-        db.update_status(user.id, event_id, 'DECLINED')
         await query.edit_message_text("Du hast den Platz abgelehnt.")
-        # Notify next
-        await notify_next_waiting(context, event_id)
+        # Offer the freed seat(s) to the next people
+        await waitlist.fill_free_seats(context, event_id)
 
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    regs = db.get_user_registrations(user.id)
+    regs = await adb.get_user_registrations(user.id)
     if not regs:
         await update.message.reply_text("Du bist für keine Events registriert.")
     else:
+        waiting = [r['event_id'] for r in regs if r['status'] == 'WAITING']
+        positions = await adb.run(waiting_positions.get_positions, user.id, waiting) if waiting else {}
         msg = "*Deine Registrierungen:*\n"
         for r in regs:
-            msg += f"- {r['event_name']}: {r['status']}\n"
+            msg += f"- {r['event_name']}: {r['status']}"
+            if positions.get(r['event_id']):
+                msg += f" (Platz {positions[r['event_id']]} auf der Warteliste)"
+            msg += "\n"
         await update.message.reply_text(msg, parse_mode='Markdown')
 
 async def list_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """List all open events."""
-    events = db.get_events()
-    open_events = [e for e in events if e['is_open']]
-    closed_events = [e for e in events if not e['is_open']]
+    catalog = await event_catalog.snapshot()
+    open_events = catalog.open_events
+    closed_events = catalog.closed_events
+
+    # Seats per event and status, straight from the maintained counters
+    seats = {}
+    for row in await adb.get_event_counters():
+        seats.setdefault(row['event_id'], {})[row['status']] = row['registrations'] + row['partner_seats']
     
     msg = "📅 *Events:*\n\n"
     
     if open_events:
         msg += "✅ *Offene Events:*\n"
         for e in open_events:
-            safe_name = escape_md(e['name'])
-            msg += f"  • {safe_name}\n"
+            safe_name = catalog.safe_name(e['id'])
+            requested = seats.get(e['id'], {}).get('PENDING', 0)
+            msg += f"  • {safe_name} ({requested} angefragt / {e['seat_limit']} Plätze)\n"
         msg += "\nNutze /register, um dich anzumelden!\n\n"
     else:
         msg += "Aktuell sind keine Events für die Registrierung geöffnet.\n\n"
@@ -691,16 +673,18 @@ async def list_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if closed_events:
         msg += "❌ *Geschlossene Events:*\n"
         for e in closed_events:
-            safe_name = escape_md(e['name'])
-            msg += f"  • {safe_name}\n"
+            safe_name = catalog.safe_name(e['id'])
+            event_seats = seats.get(e['id'], {})
+            taken = event_seats.get('ACCEPTED', 0) + event_seats.get('OFFERED', 0)
+            msg += f"  • {safe_name} ({taken}/{e['seat_limit']} Plätze belegt)\n"
     
     await update.message.reply_text(msg, parse_mode='Markdown')
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    regs = db.get_user_registrations(user.id)
+    regs = await adb.get_user_registrations(user.id)
     # Filter for active registrations (not cancelled or declined)
-    active_regs = [r for r in regs if r['status'] not in ['CANCELLED', 'DECLINED']]
+    active_regs = [r for r in regs if r['status'] not in ['CANCELLED', 'DECLINED', 'EXPIRED']]
     
     if not active_regs:
         await update.message.reply_text("Du hast keine aktiven Registrierungen zum Stornieren.")
@@ -721,7 +705,7 @@ async def cancel_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     event_id = int(query.data.split('_')[1])
     user = update.effective_user
-    reg = db.get_registration(user.id, event_id)
+    reg = await adb.get_registration(user.id, event_id)
     
     if not reg:
         await query.edit_message_text("Registrierung nicht gefunden.")
@@ -741,8 +725,12 @@ async def perform_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, reg
             await update.message.reply_text(msg)
         return
 
-    was_accepted = (reg['status'] == 'ACCEPTED')
-    db.update_status(user_id, event_id, 'CANCELLED')
+    # Accepted users and open offers hold seats that are freed by cancelling
+    frees_seat = reg['status'] in ('ACCEPTED', 'OFFERED')
+    await adb.update_status(user_id, event_id, 'CANCELLED')
+    metrics.CANCELLATIONS.inc()
+    if reg['status'] == 'OFFERED':
+        waitlist.cancel_expiry(context.job_queue, user_id, event_id)
     
     msg = "Registrierung storniert."
     if update.callback_query:
@@ -750,31 +738,141 @@ async def perform_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, reg
     else:
         await update.message.reply_text(msg)
     
-    if was_accepted:
-        await notify_next_waiting(context, event_id)
+    if frees_seat:
+        await waitlist.fill_free_seats(context, event_id)
+
+async def admin_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user.id not in ADMIN_IDS:
+        return
+    await update.message.reply_text(metrics.summary())
+
+async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user.id not in ADMIN_IDS:
+        return
+
+    if update.effective_chat.type != 'private':
+        await update.message.reply_text("Please perform admin actions in a private chat.")
+        return
+
+    # Everything after the command, line breaks included
+    parts = update.message.text.split(None, 1)
+    if len(parts) < 2:
+        msg = "Verwendung: /admin_broadcast <Nachricht>\nDie Nachricht geht an alle, die den Bot gestartet haben."
+        for row in await adb.get_running_broadcasts():
+            msg += (f"\n\n📣 Rundnachricht #{row['id']} läuft: {row['delivered']} zugestellt, "
+                    f"{row['blocked']} blockiert, {row['failed']} fehlgeschlagen")
+        await update.message.reply_text(msg)
+        return
+
+    recipients = await adb.count_users()
+    broadcast_id = await broadcast.begin(parts[1], user.id)
+    await update.message.reply_text(
+        f"📣 Rundnachricht #{broadcast_id} wird an {recipients} Nutzer gesendet. "
+        "Du bekommst eine Nachricht, sobald sie fertig ist."
+    )
 
 async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Registrierung abgebrochen.")
     return ConversationHandler.END
 
-if __name__ == '__main__':
-    db.init_db()
-    
-    if not TOKEN:
-        print("Error: TELEGRAM_TOKEN not found in .env")
-        exit(1)
-        
-    application = ApplicationBuilder().token(TOKEN).build()
+async def post_init(application):
+    # Resume delivering any messages left in the outbox by a previous run
+    worker = outbox.start(
+        application.bot,
+        concurrency=OUTBOX_CONCURRENCY,
+        rate=OUTBOX_RATE,
+        chat_rate=OUTBOX_CHAT_RATE,
+        max_attempts=OUTBOX_MAX_ATTEMPTS
+    )
+    # Continue broadcasts a previous run left unfinished
+    broadcast.start(
+        application.bot,
+        rate_limiter=worker.rate_limiter,
+        concurrency=BROADCAST_CONCURRENCY,
+        page_size=BROADCAST_PAGE_SIZE
+    )
+    resumed = await broadcast.resume_broadcasts()
+    if resumed:
+        logging.info(f"Resuming {resumed} unfinished broadcasts")
+    # Re-arm the deadlines of waiting-list offers that were open at shutdown
+    await waitlist.restore_offers(application)
+    # The seat counters are kept in step with every write; a mismatch means
+    # the database was edited by hand, so repair it from a full recount
+    mismatches = await adb.check_event_counters(repair=True)
+    for event_id, status, stored, expected in mismatches:
+        logging.warning(f"Rebuilt event counters for event {event_id} {status}: {stored} -> {expected}")
+    # Allocation previews of open events are kept up to date from here on
+    await adb.run(projection.load_open_events)
+    if METRICS_PORT:
+        try:
+            metrics.start_server(METRICS_LISTEN, METRICS_PORT)
+        except OSError as e:
+            logging.error(f"Could not start metrics endpoint on {METRICS_LISTEN}:{METRICS_PORT}: {e}")
+
+async def post_stop(application):
+    await broadcast.stop()
+    await outbox.stop()
+
+async def post_shutdown(application):
+    recorder = getattr(application.update_processor, 'recorder', None)
+    if recorder is not None:
+        recorder.close()
+    metrics.stop_server()
+    allocation_pool.shutdown()
+    # Release the database thread and its SQLite connection
+    adb.shutdown()
+
+def build_application(token, base_url=None, concurrent_updates=CONCURRENT_UPDATES):
+    """
+    Build the Application with all handlers registered.
+
+    base_url points the bot at another Bot API server (e.g. fake_bot_api
+    in benchmarks); concurrent_updates is how many updates are processed
+    at the same time, see update_processor.KeyedUpdateProcessor (or a
+    ready-made BaseUpdateProcessor to use instead). Concurrency is only
+    safe with the per-user and per-event ordering KeyedUpdateProcessor
+    adds; a plain processor above 1 is logged as a warning.
+    """
+    if not isinstance(concurrent_updates, BaseUpdateProcessor):
+        recorder = None
+        if UPDATE_RECORD_FILE:
+            recorder = UpdateRecorder(UPDATE_RECORD_FILE, ADMIN_IDS, UPDATE_RECORD_SALT, db.get_events())
+        concurrent_updates = KeyedUpdateProcessor(concurrent_updates, recorder=recorder)
+    elif concurrent_updates.max_concurrent_updates > 1 and not isinstance(concurrent_updates, KeyedUpdateProcessor):
+        # Double taps and two admins closing one event then race each other
+        # (see load_harness.py --flood-taps --unkeyed)
+        logging.warning(f"{type(concurrent_updates).__name__} runs {concurrent_updates.max_concurrent_updates} "
+                        f"updates at once without per-user ordering")
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .concurrent_updates(concurrent_updates)
+        # Times every Bot API call (getUpdates has its own request object)
+        .request(metrics.InstrumentedRequest(connection_pool_size=256))
+        .persistence(SQLitePersistence(update_interval=PERSISTENCE_INTERVAL))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
     
     reg_handler = ConversationHandler(
         entry_points=[CommandHandler('register', register)],
         states={
             ASK_EVENT: [CallbackQueryHandler(event_response, pattern='^event_')],
-            ASK_NEULING: [CallbackQueryHandler(neuling_response)],
-            ASK_PARTNER_CONFIRM: [CallbackQueryHandler(partner_confirm_response)],
+            # Patterns keep a repeated tap on an old button from answering the next question
+            ASK_NEULING: [CallbackQueryHandler(neuling_response, pattern='^neuling_')],
+            ASK_PARTNER_CONFIRM: [CallbackQueryHandler(partner_confirm_response, pattern='^partner_')],
             ASK_PARTNER_NAME: [MessageHandler(filters.TEXT, partner_name_response)]
         },
-        fallbacks=[CommandHandler('cancel', cancel_conversation)]
+        fallbacks=[CommandHandler('cancel', cancel_conversation)],
+        # Survives restarts together with user_data, see persistence.py
+        name='registration',
+        persistent=True
     )
     
     application.add_handler(CommandHandler('start', start))
@@ -785,11 +883,40 @@ if __name__ == '__main__':
     application.add_handler(CommandHandler('admin_open', admin_open))
     application.add_handler(CommandHandler('admin_close', admin_close))
     application.add_handler(CommandHandler('admin_list', admin_list))
+    application.add_handler(CommandHandler('admin_preview', admin_preview))
     application.add_handler(CommandHandler('mock_users', mock_users_command))
     application.add_handler(CommandHandler('create_event', create_event))
+    application.add_handler(CommandHandler('admin_metrics', admin_metrics))
+    application.add_handler(CommandHandler('admin_broadcast', admin_broadcast))
     application.add_handler(CallbackQueryHandler(admin_event_response, pattern='^admin_'))
+    application.add_handler(CallbackQueryHandler(admin_list_page, pattern=f'^{registration_list.CALLBACK_PREFIX}'))
     application.add_handler(CallbackQueryHandler(offer_response, pattern='^offer_'))
     application.add_handler(CallbackQueryHandler(cancel_response, pattern='^cancel_'))
+    metrics.instrument_handlers(application)
+    return application
+
+if __name__ == '__main__':
+    db.init_db()
     
-    print("Bot is running...")
-    application.run_polling()
+    if not TOKEN:
+        print("Error: TELEGRAM_TOKEN not found in .env")
+        exit(1)
+        
+    application = build_application(TOKEN)
+    
+    if BOT_MODE == 'webhook':
+        if not WEBHOOK_URL:
+            print("Error: BOT_MODE=webhook needs WEBHOOK_URL")
+            exit(1)
+        print(f"Bot is running (webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH})...")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        print("Bot is running...")
+        application.run_polling()
@@ -0,0 +1,313 @@
+"""
+In-process metrics: latency histograms and counters.
+
+Recorded all the time, cheap enough for production (one perf_counter pair
+and a short lock per observation):
+
+- eventbot_handler_seconds{handler}: every handler callback registered in
+  main.build_application (see instrument_handlers)
+- eventbot_db_seconds{function}: every database.py function, timed inside
+  database.py whichever thread calls it (async_db's database thread, commit
+  listeners, allocation), plus other callables run through async_db.run;
+  nested calls are counted once, in the outermost one. The time spent
+  waiting for the database thread is in eventbot_db_queue_wait_seconds
+- eventbot_bot_api_seconds{method}: every Bot API call made through
+  context.bot (InstrumentedRequest; long-polling getUpdates is not included)
+- eventbot_allocations_total, eventbot_offers_total,
+  eventbot_cancellations_total and eventbot_send_failures_total{method,reason}
+
+render() returns everything in the Prometheus text format; start_server()
+serves it on a local HTTP port (METRICS_PORT in main.py), and summary() is
+the short overview behind /admin_metrics.
+"""
+import bisect
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from telegram.ext import ConversationHandler
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+def _format_labels(names, values, extra=""):
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing count per combination of label values."""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *label_values, amount: int = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def values(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    def total(self) -> int:
+        return sum(self.values().values())
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        values = self.values()
+        if not values and not self.labels:
+            values = {(): 0}
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram:
+    """Observations sorted into fixed buckets, per value of one label."""
+
+    def __init__(self, name: str, help: str, label: Optional[str] = None, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        # label value -> [count per bucket (last one is +Inf), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, label_value=None):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def stats(self) -> dict:
+        """label value -> (count, sum, p50, p95), percentiles estimated from the buckets."""
+        with self._lock:
+            series = {label: (list(counts), total) for label, (counts, total) in self._series.items()}
+        result = {}
+        for label, (counts, total) in series.items():
+            count = sum(counts)
+            result[label] = (count, total, self._quantile(counts, count, 0.5), self._quantile(counts, count, 0.95))
+        return result
+
+    def _quantile(self, counts, count, q):
+        # Linear interpolation inside the bucket the q-th observation falls in
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count and seen + bucket_count >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return 0.0
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {label: (list(counts), total) for label, (counts, total) in self._series.items()}
+        names = (self.label,) if self.label else ()
+        for label, (counts, total) in sorted(series.items(), key=lambda item: str(item[0])):
+            values = (label,) if self.label else ()
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (None,), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound is None else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(names, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(names, values)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(names, values)} {cumulative}")
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+HANDLER_SECONDS = Histogram("eventbot_handler_seconds", "Time spent in update handlers.", "handler")
+DB_SECONDS = Histogram("eventbot_db_seconds", "Time spent in database functions.", "function")
+DB_QUEUE_WAIT_SECONDS = Histogram("eventbot_db_queue_wait_seconds", "Time database calls waited for the database thread.")
+BOT_API_SECONDS = Histogram("eventbot_bot_api_seconds", "Duration of Bot API requests.", "method")
+
+ALLOCATIONS = Counter("eventbot_allocations_total", "Seat allocations run on closing an event.")
+OFFERS = Counter("eventbot_offers_total", "Waiting-list offers made.")
+CANCELLATIONS = Counter("eventbot_cancellations_total", "Registrations cancelled by their user.")
+SEND_FAILURES = Counter("eventbot_send_failures_total", "Failed Bot API requests that send or edit a message.",
+                        ("method", "reason"))
+BROADCAST_MESSAGES = Counter("eventbot_broadcast_messages_total", "Broadcast sends by outcome (delivered, blocked, failed).",
+                             ("outcome",))
+
+_SEND_METHODS = frozenset({'sendMessage', 'editMessageText', 'editMessageReplyMarkup'})
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    for metric in _registry:
+        metric.reset()
+
+
+# --- Instrumentation ---
+
+def timed_handler(callback, name: Optional[str] = None):
+    """Wrap a handler callback so every call is recorded in HANDLER_SECONDS."""
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+    wrapper.__wrapped_metrics__ = True
+    return wrapper
+
+
+def _instrument(handler):
+    if isinstance(handler, ConversationHandler):
+        for inner in handler.entry_points + handler.fallbacks:
+            _instrument(inner)
+        for state_handlers in handler.states.values():
+            for inner in state_handlers:
+                _instrument(inner)
+    elif getattr(handler, 'callback', None) is not None and not hasattr(handler.callback, '__wrapped_metrics__'):
+        handler.callback = timed_handler(handler.callback)
+
+
+def instrument_handlers(application):
+    """Time every handler (including conversation states) of an Application."""
+    for group in application.handlers.values():
+        for handler in group:
+            _instrument(handler)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records the duration and failures of every Bot API call."""
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            status_code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception as e:
+            if api_method in _SEND_METHODS:
+                SEND_FAILURES.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            BOT_API_SECONDS.observe(time.perf_counter() - started, api_method)
+        if status_code >= 300 and api_method in _SEND_METHODS:
+            SEND_FAILURES.inc(api_method, str(status_code))
+        return status_code, payload
+
+
+# --- Reports ---
+
+def _top(histogram, limit):
+    stats = sorted(histogram.stats().items(), key=lambda item: item[1][1], reverse=True)
+    lines = []
+    for label, (count, total, p50, p95) in stats[:limit]:
+        lines.append(f"  {label}: {count}× ⌀ {total / count * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms")
+    return lines or ["  –"]
+
+
+def summary(limit: int = 5) -> str:
+    """Short plain-text overview for /admin_metrics: the most expensive entries by total time."""
+    lines = ["📊 Metriken seit dem Start", "", "Handler:"]
+    lines += _top(HANDLER_SECONDS, limit)
+    lines += ["", "Datenbank:"]
+    lines += _top(DB_SECONDS, limit)
+    waits = DB_QUEUE_WAIT_SECONDS.stats().get(None)
+    if waits:
+        lines.append(f"  Wartezeit auf den DB-Thread: p95 {waits[3] * 1000:.1f} ms")
+    lines += ["", "Telegram-API:"]
+    lines += _top(BOT_API_SECONDS, limit)
+    lines += [
+        "",
+        f"Zuteilungen: {ALLOCATIONS.total()}",
+        f"Angebote: {OFFERS.total()}",
+        f"Stornierungen: {CANCELLATIONS.total()}",
+        f"Fehlgeschlagene Sendungen: {SEND_FAILURES.total()}",
+        f"Rundnachrichten: {BROADCAST_MESSAGES.total()}",
+    ]
+    return "\n".join(lines)
+
+
+# --- HTTP endpoint ---
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        data = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+_server: Optional[_Server] = None
+
+
+def start_server(host: str, port: int):
+    """Serve render() at http://host:port/metrics from a background thread."""
+    global _server
+    if _server is not None:
+        return _server
+    _server = _Server((host, port), _Handler)
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{_server.server_address[1]}/metrics")
+    return _server
+
+
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
@@ -1,9 +1,11 @@
 import random
 import logging
+import datetime
 from typing import Optional
 from telegram.ext import ContextTypes
 from telegram.ext import ConversationHandler
-import database as db
+import async_db as adb
+import event_catalog
 
 logger = logging.getLogger(__name__)
 
@@ -41,25 +43,26 @@ class MockUser:
     
     @classmethod
     def create_random(cls, index: int, neuling_probability: float = 0.3, 
-                     partner_probability: float = 0.4):
+                     partner_probability: float = 0.4, rng: Optional[random.Random] = None):
         """Create a random mock user with realistic name."""
         global _MOCK_USER_ID_COUNTER
+        rng = rng or random
         user_id = _MOCK_USER_ID_COUNTER + index
         
         # Generate realistic name
-        first_name = random.choice(_FIRST_NAMES)
-        last_name = random.choice(_LAST_NAMES)
+        first_name = rng.choice(_FIRST_NAMES)
+        last_name = rng.choice(_LAST_NAMES)
         full_name = f"{first_name} {last_name}"
         username = f"{first_name.lower()}_{last_name.lower()}_{index}"
         
-        is_neuling = random.random() < neuling_probability
+        is_neuling = rng.random() < neuling_probability
         partner_name = None
-        if random.random() < partner_probability:
+        if rng.random() < partner_probability:
             # Generate realistic partner name
-            partner_first = random.choice(_FIRST_NAMES)
-            partner_last = random.choice(_LAST_NAMES)
+            partner_first = rng.choice(_FIRST_NAMES)
+            partner_last = rng.choice(_LAST_NAMES)
             # Sometimes use same last name (couple), sometimes different
-            if random.random() < 0.5:
+            if rng.random() < 0.5:
                 partner_name = f"{partner_first} {last_name}"  # Same last name
             else:
                 partner_name = f"{partner_first} {partner_last}"  # Different last name
@@ -155,6 +158,37 @@ class MockUpdate:
         return self._effective_chat
 
 
+class MockBot:
+    """Stand-in for telegram.Bot that records instead of sending."""
+
+    def __init__(self, username: str = "mock_bot"):
+        self.username = username
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        logger.debug(f"Mock send to {chat_id}: {text}")
+        self.sent.append((chat_id, text))
+        return None
+
+
+class MockContext:
+    """
+    Isolated handler context for one mock user.
+
+    Unlike reusing a real CallbackContext, every MockContext has its own
+    user_data, so any number of simulated conversations can run concurrently.
+    """
+
+    def __init__(self, bot: Optional[MockBot] = None, args: Optional[list] = None):
+        self.bot = bot or MockBot()
+        self.args = args or []
+        self.user_data = {}
+        self.chat_data = {}
+        self.bot_data = {}
+        self.job_queue = None
+        self.application = None
+
+
 def _ensure_user_data_initialized(context: ContextTypes.DEFAULT_TYPE, mock_user: MockUser):
     """
     Ensure that context._user_data has an entry for the mock user before calling handlers.
@@ -216,7 +250,7 @@ async def simulate_registration(mock_user: MockUser, context: ContextTypes.DEFAU
         
         # Verify event_id if provided
         if event_id:
-            event = db.get_event(event_id)
+            event = (await event_catalog.snapshot()).get(event_id)
             if not event or not event['is_open']:
                 logger.error(f"Event {event_id} not found or not open for mock user {mock_user.user_id}")
                 return False
@@ -268,8 +302,7 @@ async def simulate_registration(mock_user: MockUser, context: ContextTypes.DEFAU
         # Check if we need to select an event
         if result == ASK_EVENT:
             # Multiple events - need to select one
-            events = db.get_events()
-            open_events = [e for e in events if e['is_open']]
+            open_events = (await event_catalog.snapshot()).open_events
             
             if not open_events:
                 logger.error(f"No open events for mock user {mock_user.user_id}")
@@ -332,7 +365,7 @@ async def simulate_registration(mock_user: MockUser, context: ContextTypes.DEFAU
             mock_user_data = _get_mock_user_data(context, mock_user)
             event_id_used = mock_user_data.get('event_id')
             if event_id_used:
-                reg = db.get_registration(mock_user.user_id, event_id_used)
+                reg = await adb.get_registration(mock_user.user_id, event_id_used)
                 if reg:
                     logger.info(f"Mock user {mock_user.user_id} ({mock_user.full_name}) registered successfully")
                     return True
@@ -345,6 +378,20 @@ async def simulate_registration(mock_user: MockUser, context: ContextTypes.DEFAU
         return False
 
 
+async def _next_mock_index() -> int:
+    """
+    Index of the next unused mock user ID.
+
+    Looks at mock users in ALL events, not only the one being filled, so IDs
+    never collide when mock users exist in different events. A single
+    MAX(user_id) query served by the (user_id, event_id) index.
+    """
+    max_mock_id = await adb.get_max_user_id(_MOCK_USER_ID_COUNTER)
+    if max_mock_id is None:
+        return 0
+    return max_mock_id - _MOCK_USER_ID_COUNTER + 1
+
+
 async def create_mock_users(count: int, context: ContextTypes.DEFAULT_TYPE,
                            event_id: Optional[int] = None,
                            neuling_probability: float = 0.3,
@@ -362,24 +409,7 @@ async def create_mock_users(count: int, context: ContextTypes.DEFAULT_TYPE,
     Returns:
         Dictionary with success count, failure count, and details
     """
-    # Find the highest existing mock user ID to avoid duplicates
-    # IMPORTANT: Always check ALL events, regardless of event_id parameter.
-    # The event_id parameter only determines which event to register new users for,
-    # not which events to search for existing mock user IDs. This prevents duplicate
-    # IDs when mock users exist in different events.
-    all_regs = []
-    all_events = db.get_events()
-    for event in all_events:
-        regs = db.get_event_registrations(event['id'])
-        all_regs.extend(regs)
-    
-    max_mock_id = _MOCK_USER_ID_COUNTER - 1  # Start from base - 1
-    for reg in all_regs:
-        if reg['user_id'] >= _MOCK_USER_ID_COUNTER:
-            max_mock_id = max(max_mock_id, reg['user_id'])
-    
-    # Calculate starting index (how many mock users already exist)
-    start_index = max_mock_id - _MOCK_USER_ID_COUNTER + 1
+    start_index = await _next_mock_index()
     
     results = {
         'success': 0,
@@ -408,3 +438,59 @@ async def create_mock_users(count: int, context: ContextTypes.DEFAULT_TYPE,
     
     return results
 
+
+
+async def create_mock_users_bulk(count: int, event_id: Optional[int] = None,
+                                 neuling_probability: float = 0.3,
+                                 partner_probability: float = 0.4,
+                                 batch_size: int = 5000,
+                                 seed: Optional[int] = None) -> dict:
+    """
+    Insert mock registrations directly into the database, bypassing the handlers.
+
+    Meant for seeding production-sized events (50k-500k registrations) for
+    allocation and load tests; use create_mock_users to exercise the real
+    conversation flow. Users are generated and inserted batch_size at a time,
+    one transaction per batch, so memory stays flat regardless of count.
+    
+    Args:
+        count: Number of mock users to create
+        event_id: Optional event ID. If None, uses the first open event
+        neuling_probability: Probability that a mock user is a neuling (0.0-1.0)
+        partner_probability: Probability that a mock user has a partner (0.0-1.0)
+        batch_size: Registrations inserted per transaction
+        seed: Optional seed for reproducible users
+    
+    Returns:
+        Dictionary with success and failure counts and the event ID used
+    """
+    if event_id is None:
+        open_events = (await event_catalog.snapshot()).open_events
+        if not open_events:
+            raise ValueError("No open event to register mock users for")
+        event_id = open_events[0]['id']
+
+    rng = random.Random(seed)
+    start_index = await _next_mock_index()
+    base_time = datetime.datetime.now()
+    inserted = 0
+
+    for batch_start in range(0, count, batch_size):
+        rows = []
+        for i in range(batch_start, min(batch_start + batch_size, count)):
+            mock_user = MockUser.create_random(start_index + i, neuling_probability, partner_probability, rng)
+            rows.append((
+                mock_user.user_id, event_id, mock_user.username, mock_user.full_name,
+                mock_user.is_neuling, mock_user.partner_name,
+                # Distinct, increasing times keep the waiting-list order stable
+                base_time + datetime.timedelta(microseconds=i)
+            ))
+        inserted += await adb.add_registrations(rows)
+        logger.info(f"Inserted mock users {batch_start + 1}-{batch_start + len(rows)} of {count} for event {event_id}")
+
+    return {
+        'success': inserted,
+        'failed': count - inserted,
+        'event_id': event_id,
+        'details': []
+    }
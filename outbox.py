@@ -0,0 +1,198 @@
+"""
+Durable, rate-limited delivery of queued bot messages.
+
+Messages are written to the `outbox` table (see database.enqueue_messages),
+usually in the same transaction as the state change they announce. The
+OutboxWorker claims due rows and sends them concurrently while staying within
+a global and a per-chat send rate. Flood-control errors (RetryAfter) pause
+sending and re-queue the message; transient errors are retried with
+exponential backoff. Rows a crashed run had claimed are re-queued on start,
+so nothing is dropped across restarts (delivery is at-least-once).
+"""
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+import async_db as adb
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows roughly 30 messages/second overall and 1/second per chat
+DEFAULT_CONCURRENCY = 8
+DEFAULT_RATE = 25.0
+DEFAULT_CHAT_RATE = 1.0
+DEFAULT_MAX_ATTEMPTS = 5
+MAX_BACKOFF_SECONDS = 300
+
+
+class RateLimiter:
+    """Spaces out acquisitions so that at most `rate` happen per second."""
+
+    def __init__(self, rate: float):
+        self._interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_slot = 0.0
+
+    def pause(self, seconds: float):
+        """Hold back every acquisition for at least `seconds` from now."""
+        self._next_slot = max(self._next_slot, time.monotonic() + seconds)
+
+    async def acquire(self):
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self._interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class KeyedRateLimiter:
+    """A RateLimiter per key (e.g. chat id), created on demand."""
+
+    def __init__(self, rate: float, max_keys: int = 10000):
+        self._interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_slots = {}
+        self._max_keys = max_keys
+
+    async def acquire(self, key):
+        now = time.monotonic()
+        if len(self._next_slots) > self._max_keys:
+            # Forget keys whose slot is already in the past
+            self._next_slots = {k: v for k, v in self._next_slots.items() if v > now}
+        slot = max(now, self._next_slots.get(key, 0.0))
+        self._next_slots[key] = slot + self._interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class OutboxWorker:
+    """Background task that drains the outbox table."""
+
+    def __init__(self, bot, concurrency: int = DEFAULT_CONCURRENCY, rate: float = DEFAULT_RATE,
+                 chat_rate: float = DEFAULT_CHAT_RATE, max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 poll_interval: float = 5.0):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._rate = RateLimiter(rate)
+        self._chat_rate = KeyedRateLimiter(chat_rate)
+        self._slots = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._in_flight = set()
+
+    @property
+    def rate_limiter(self) -> RateLimiter:
+        """The global send rate, for other senders that must stay within it (see broadcast.py)."""
+        return self._rate
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="outbox-worker")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+    def wake(self):
+        """Tell the worker new messages were queued."""
+        self._wakeup.set()
+
+    async def _run(self):
+        released = await adb.release_claimed_messages()
+        if released:
+            logger.info(f"Re-queued {released} outbox messages from a previous run")
+
+        while True:
+            self._wakeup.clear()
+            # Claim at most as many rows as there are free send slots
+            free = self.concurrency * 2 - len(self._in_flight)
+            rows = await adb.claim_due_messages(free, time.time()) if free > 0 else []
+            for row in rows:
+                task = asyncio.create_task(self._deliver(row))
+                self._in_flight.add(task)
+                task.add_done_callback(self._delivered)
+
+            if rows and len(rows) == free:
+                # More may be due; wait only for a send slot to free up
+                await asyncio.wait(set(self._in_flight), return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            timeout = self.poll_interval
+            next_due = await adb.get_next_message_time()
+            if next_due is not None:
+                timeout = min(timeout, max(0.0, next_due - time.time()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _delivered(self, task):
+        self._in_flight.discard(task)
+        # Nothing awaits the delivery tasks, so their errors end up here;
+        # the row stays SENDING and is re-queued on the next start
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Outbox delivery failed: {task.exception()!r}", exc_info=task.exception())
+
+    async def _deliver(self, row):
+        async with self._slots:
+            await self._rate.acquire()
+            await self._chat_rate.acquire(row['chat_id'])
+            try:
+                await self.bot.send_message(chat_id=row['chat_id'], text=row['text'], parse_mode=row['parse_mode'])
+            except RetryAfter as e:
+                # Flood control is global to the bot: slow everything down
+                logger.warning(f"Flood control hit, pausing outbox for {e.retry_after}s")
+                self._rate.pause(e.retry_after)
+                await adb.reschedule_message(row['id'], time.time() + e.retry_after, str(e), count_attempt=False)
+            except (Forbidden, BadRequest) as e:
+                # Blocked bot, deleted account, unknown chat: retrying will not help
+                logger.error(f"Failed to send message to {row['chat_id']}: {e}")
+                await adb.mark_message_failed(row['id'], str(e))
+            except Exception as e:
+                attempts = row['attempts'] + 1
+                if attempts >= self.max_attempts:
+                    logger.error(f"Giving up on message to {row['chat_id']} after {attempts} attempts: {e}")
+                    await adb.mark_message_failed(row['id'], str(e))
+                else:
+                    backoff = min(2 ** attempts, MAX_BACKOFF_SECONDS)
+                    logger.warning(f"Failed to send message to {row['chat_id']} (attempt {attempts}), retrying in {backoff}s: {e}")
+                    await adb.reschedule_message(row['id'], time.time() + backoff, str(e))
+            else:
+                await adb.mark_message_sent(row['id'])
+        self.wake()
+
+
+_worker: Optional[OutboxWorker] = None
+
+
+def start(bot, **config) -> OutboxWorker:
+    """Start the process-wide outbox worker (call from Application.post_init)."""
+    global _worker
+    if _worker is None:
+        _worker = OutboxWorker(bot, **config)
+        _worker.start()
+    return _worker
+
+
+async def stop():
+    global _worker
+    if _worker is not None:
+        await _worker.stop()
+        _worker = None
+
+
+def wake():
+    """Nudge the worker after queueing messages; a no-op if it is not running."""
+    if _worker is not None:
+        _worker.wake()
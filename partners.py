@@ -0,0 +1,95 @@
+"""
+Partner-name resolution for registrations.
+
+A registration's partner_name is free text: either the partner's full name or
+their Telegram @username. PartnerIndex maps both forms to the registration
+they refer to, so resolving a partner is a dict lookup instead of a scan over
+every registration of the event.
+
+Matching rules:
+- partner names are lower-cased and stripped, and a leading '@' is dropped
+- registration full names and usernames are lower-cased and stripped
+- if several registrations share a name, the earliest one in the list wins
+- if the name matches one registration's full name and another's username,
+  the one that comes first in the list wins
+
+resolve_positions() applies the same rules to whole columns of normalized
+keys at once and only indexes the names someone actually named (used by
+allocation).
+"""
+from typing import Iterable, Optional, Sequence
+
+
+def normalize_partner_name(partner_name: Optional[str]) -> Optional[str]:
+    """Normalise a partner name as typed by the user into a lookup key."""
+    if not partner_name:
+        return None
+    key = partner_name.lower().strip()
+    # Remove @ if present
+    if key.startswith('@'):
+        key = key[1:]
+    return key or None
+
+
+def normalize_name(name: Optional[str]) -> Optional[str]:
+    """Normalise a stored full name or username into a lookup key."""
+    if not name:
+        return None
+    return name.lower().strip() or None
+
+
+class PartnerIndex:
+    """Resolve partner names against one event's registrations in O(1)."""
+
+    def __init__(self, registrations: Iterable):
+        self.registrations = list(registrations)
+        self._by_name = {}
+        self._by_username = {}
+        for pos, reg in enumerate(self.registrations):
+            name_key = normalize_name(reg['full_name'])
+            if name_key is not None:
+                self._by_name.setdefault(name_key, pos)
+            username_key = normalize_name(reg['username'])
+            if username_key is not None:
+                self._by_username.setdefault(username_key, pos)
+
+    def find(self, partner_name: Optional[str]):
+        """Return the registration partner_name refers to, or None."""
+        key = normalize_partner_name(partner_name)
+        if key is None:
+            return None
+        by_name = self._by_name.get(key)
+        by_username = self._by_username.get(key)
+        if by_name is None and by_username is None:
+            return None
+        if by_name is None:
+            pos = by_username
+        elif by_username is None:
+            pos = by_name
+        else:
+            pos = min(by_name, by_username)
+        return self.registrations[pos]
+
+
+def resolve_positions(name_keys: Sequence, username_keys: Sequence, partner_keys: Sequence) -> list:
+    """
+    For each partner key, the position of the registration it refers to
+    (same rules as PartnerIndex), or None if it names nobody registered.
+
+    The sequences are columns of the same registrations, already normalized
+    (normalize_name / normalize_partner_name, i.e. the *_key columns of the
+    registrations table).
+    """
+    wanted = set(partner_keys)
+    wanted.discard(None)
+    if not wanted:
+        return [None] * len(partner_keys)
+    # Walking backwards, the earliest position of a key is written last
+    last = len(name_keys) - 1
+    by_name = {key: pos for pos, key in zip(range(last, -1, -1), reversed(name_keys)) if key in wanted}
+    by_username = {key: pos for pos, key in zip(range(last, -1, -1), reversed(username_keys)) if key in wanted}
+    resolved = dict(by_username)
+    for key, pos in by_name.items():
+        other = resolved.get(key)
+        resolved[key] = pos if other is None else min(pos, other)
+    return [resolved.get(key) for key in partner_keys]
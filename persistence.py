@@ -0,0 +1,183 @@
+"""
+python-telegram-bot persistence in the bot's own SQLite database.
+
+SQLitePersistence keeps user_data, chat_data and ConversationHandler states
+in the user_data, chat_data and conversations tables (as JSON), so a restart
+in the middle of /register resumes where each user left off.
+
+- Lazy loading: on start only the stored conversations are read (a row
+  exists only while a conversation is in progress). A user's or chat's data
+  is read the first time one of their updates arrives, through PTB's
+  refresh_user_data/refresh_chat_data hooks, so start-up time does not grow
+  with the number of users.
+- Write-behind: PTB hands over the data of users and chats that had updates
+  every `update_interval` seconds. Rows whose JSON did not change since the
+  last write are skipped (only a digest of each written row is kept to tell);
+  the rest are written in one transaction.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import async_db as adb
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_UPDATE_INTERVAL = 5
+
+
+def _digest(data):
+    # Stands in for a row's JSON when checking for changes; None is a deleted row
+    return hashlib.blake2b(data.encode(), digest_size=16).digest() if data is not None else None
+
+
+class SQLitePersistence(BasePersistence):
+    """BasePersistence for user_data, chat_data and conversations (no bot/callback data)."""
+
+    def __init__(self, update_interval: float = DEFAULT_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._loaded_users = set()
+        self._loaded_chats = set()
+        # Digest of the last JSON written (or read) per row, to skip
+        # unchanged ones; deleted rows are forgotten
+        self._written = {}
+        # Rows waiting for the next write: key -> JSON, or None to delete
+        self._pending = {}
+        self._write_scheduled = False
+        self._writes = set()
+        self.rows_written = 0
+        self.rows_skipped = 0
+
+    # --- Write-behind ---
+
+    def _queue(self, key, data):
+        if data is not None:
+            try:
+                data = json.dumps(data, sort_keys=True)
+            except (TypeError, ValueError) as e:
+                logger.error(f"Cannot persist {key}: {e}")
+                return
+        if key not in self._pending and self._written.get(key) == _digest(data):
+            self.rows_skipped += 1
+            return
+        self._pending[key] = data
+        if not self._write_scheduled:
+            self._write_scheduled = True
+            task = asyncio.get_running_loop().create_task(self._write_pending())
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    async def _write_pending(self):
+        # PTB queues all changes of one persistence run at once; let them all
+        # arrive before writing
+        await asyncio.sleep(0)
+        self._write_scheduled = False
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        user_rows, chat_rows, conversation_rows = [], [], []
+        for key, data in pending.items():
+            if key[0] == 'user':
+                user_rows.append((key[1], data))
+            elif key[0] == 'chat':
+                chat_rows.append((key[1], data))
+            else:
+                conversation_rows.append((key[1], key[2], data))
+
+        try:
+            await adb.save_persisted_data(user_rows, chat_rows, conversation_rows)
+        except Exception as e:
+            logger.error(f"Persisting {len(pending)} rows failed, retrying with the next run: {e}")
+            # Keep anything that changed again in the meantime
+            self._pending = {**pending, **self._pending}
+            return
+        for key, data in pending.items():
+            if data is None:
+                self._written.pop(key, None)
+            else:
+                self._written[key] = _digest(data)
+        self.rows_written += len(pending)
+
+    async def flush(self) -> None:
+        """Write everything still pending (called on shutdown)."""
+        while self._writes:
+            await asyncio.gather(*self._writes)
+        if self._pending:
+            await self._write_pending()
+
+    # --- User and chat data ---
+
+    async def get_user_data(self):
+        # Loaded per user in refresh_user_data
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data) -> None:
+        if user_id in self._loaded_users:
+            return
+        self._loaded_users.add(user_id)
+        stored = await adb.get_persisted_user_data(user_id)
+        if stored is not None:
+            self._written[('user', user_id)] = _digest(stored)
+            for key, value in json.loads(stored).items():
+                user_data.setdefault(key, value)
+
+    async def refresh_chat_data(self, chat_id, chat_data) -> None:
+        if chat_id in self._loaded_chats:
+            return
+        self._loaded_chats.add(chat_id)
+        stored = await adb.get_persisted_chat_data(chat_id)
+        if stored is not None:
+            self._written[('chat', chat_id)] = _digest(stored)
+            for key, value in json.loads(stored).items():
+                chat_data.setdefault(key, value)
+
+    async def update_user_data(self, user_id, data) -> None:
+        self._queue(('user', user_id), data or None)
+
+    async def update_chat_data(self, chat_id, data) -> None:
+        self._queue(('chat', chat_id), data or None)
+
+    async def drop_user_data(self, user_id) -> None:
+        self._queue(('user', user_id), None)
+
+    async def drop_chat_data(self, chat_id) -> None:
+        self._queue(('chat', chat_id), None)
+
+    # --- Conversations ---
+
+    async def get_conversations(self, name):
+        conversations = {}
+        for row in await adb.get_persisted_conversations(name):
+            self._written[('conversation', name, row['key'])] = _digest(row['state'])
+            conversations[tuple(json.loads(row['key']))] = json.loads(row['state'])
+        return conversations
+
+    async def update_conversation(self, name, key, new_state) -> None:
+        self._queue(('conversation', name, json.dumps(list(key))), new_state)
+
+    # --- Not stored ---
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data) -> None:
+        pass
@@ -0,0 +1,338 @@
+"""
+Live preview of the allocation an open event would get if it closed now.
+
+For every open event the projection keeps its PENDING registrations in
+memory, indexed by name and partner name, and updates them from the
+database listeners: registrations added, status changes (cancellations) and
+admin flag changes. Each change only touches the registration itself, the
+registrations naming it as partner and their partners, so the preview is
+kept current in O(1) per write instead of re-running allocation over the
+whole event.
+
+The preview mirrors allocation.allocate():
+- guaranteed seats: admins and Neulinge, each with their partner (a
+  registered partner is counted once, an unregistered one as an extra seat)
+- random pool: everyone else, and the seats they need (1, or 2 with an
+  unregistered partner)
+- free seats for the random pool and the oversubscription ratio
+  (seats needed in the pool / seats left for it)
+
+An admin or Neuling who is named as partner by another one is taken along
+by whichever of the two comes first (admins first, then registration
+order) and then does not bring their own partner. Only these few
+"contested" registrations are replayed in that order when a preview is read.
+
+Closed events are dropped; their registrations are read again when the
+event is reopened.
+"""
+import logging
+import threading
+from typing import Optional
+
+import database as db
+from formatting import escape_md
+
+logger = logging.getLogger(__name__)
+
+
+class _Registration:
+    __slots__ = ('user_id', 'priority', 'is_admin', 'is_neuling', 'name_key', 'username_key', 'partner_key',
+                 'has_partner', 'partner')
+
+    def __init__(self, row):
+        self.user_id = row['user_id']
+        self.is_admin = bool(row['is_admin'])
+        self.is_neuling = bool(row['is_neuling'])
+        self.priority = self.is_admin or self.is_neuling
+        self.name_key = row['name_key']
+        self.username_key = row['username_key']
+        self.partner_key = row['partner_key']
+        # Any partner name counts, like in allocation: one that normalizes
+        # to nothing (e.g. "@") has no partner_key but still brings a guest
+        self.has_partner = bool(row['partner_name'])
+        # id of the registration partner_key resolves to, if any
+        self.partner = None
+
+    @property
+    def guest_seats(self) -> int:
+        """1 if the named partner is not registered and needs a seat of their own."""
+        return 1 if self.has_partner and self.partner is None else 0
+
+
+class Preview:
+    """The projected outcome of closing an event now."""
+
+    def __init__(self, seat_limit, registrations, admins, neulings, guaranteed, pool_people, pool_seats):
+        self.seat_limit = seat_limit
+        self.registrations = registrations
+        self.admins = admins
+        self.neulings = neulings
+        self.guaranteed_seats = guaranteed
+        self.pool_people = pool_people
+        self.pool_seats_needed = pool_seats
+        self.pool_capacity = max(0, seat_limit - guaranteed)
+
+    @property
+    def oversubscription(self) -> Optional[float]:
+        """Seats needed by the random pool per seat left for it (None: no seat left)."""
+        if not self.pool_seats_needed:
+            return 0.0
+        if not self.pool_capacity:
+            return None
+        return self.pool_seats_needed / self.pool_capacity
+
+
+class EventProjection:
+    """PENDING registrations of one event and the aggregates of its preview."""
+
+    def __init__(self, event_id):
+        self.event_id = event_id
+        self._regs = {}
+        # name_key/username_key -> ids of registrations with that name
+        self._by_key = {}
+        # partner_key -> ids of registrations naming that partner
+        self._referrers = {}
+        # id -> ids of the priority registrations that bring it along as partner
+        self._dragged_by = {}
+        # Priority registrations brought along by another priority registration
+        self._contested = set()
+        # id -> (guaranteed seats, pool people, pool seats) it is counted with
+        self._counted = {}
+        self.registrations = 0
+        self.admins = 0
+        self.neulings = 0
+        self.guaranteed = 0
+        self.pool_people = 0
+        self.pool_seats = 0
+
+    def preview(self, seat_limit) -> Preview:
+        guaranteed, pool_people, pool_seats = self.guaranteed, self.pool_people, self.pool_seats
+        if self._contested:
+            delta = self._contested_correction()
+            guaranteed += delta[0]
+            pool_people += delta[1]
+            pool_seats += delta[2]
+        return Preview(seat_limit, self.registrations, self.admins, self.neulings,
+                       guaranteed, pool_people, pool_seats)
+
+    def _order(self, reg_id):
+        # allocate() seats admins first, then Neulinge, each in registration order
+        return (not self._regs[reg_id].is_admin, reg_id)
+
+    def _contested_correction(self):
+        # The running totals assume every admin and Neuling brings their
+        # partner. One already taken along by an earlier one does not.
+        skipped = set()
+        for reg_id in sorted(self._contested, key=self._order):
+            order = self._order(reg_id)
+            for other in self._dragged_by[reg_id]:
+                if other != reg_id and other not in skipped and self._order(other) < order:
+                    skipped.add(reg_id)
+                    break
+
+        guaranteed = pool_people = pool_seats = 0
+        left_behind = set()
+        for reg_id in skipped:
+            reg = self._regs[reg_id]
+            if reg.partner is None:
+                guaranteed -= reg.guest_seats
+            elif reg.partner != reg_id:
+                left_behind.add(reg.partner)
+        for reg_id in left_behind:
+            reg = self._regs[reg_id]
+            if reg.priority or self._dragged_by[reg_id] - skipped:
+                continue
+            # Back in the random pool
+            guaranteed -= 1
+            pool_people += 1
+            pool_seats += 1 + reg.guest_seats
+        return guaranteed, pool_people, pool_seats
+
+    def apply(self, reg_id, row):
+        """Set a registration's current row, or None if it is no longer PENDING."""
+        old = self._regs.get(reg_id)
+        if old is None and row is None:
+            return
+        new = _Registration(row) if row is not None else None
+
+        # Registrations whose partner may resolve differently now
+        keys = set()
+        for reg in (old, new):
+            if reg is not None:
+                keys.update((reg.name_key, reg.username_key))
+        keys.discard(None)
+        affected = {reg_id}
+        for key in keys:
+            affected.update(self._referrers.get(key, ()))
+
+        # ... and everyone whose seat count may change with them
+        refresh = set(affected)
+        for rid in affected:
+            reg = self._regs.get(rid)
+            if reg is not None:
+                self._drag(rid, reg, -1)
+                if reg.partner is not None:
+                    refresh.add(reg.partner)
+
+        if old is not None:
+            self._unindex(reg_id, old)
+            self._tally(old, -1)
+        if new is not None:
+            self._regs[reg_id] = new
+            self._index(reg_id, new)
+            self._tally(new, 1)
+
+        for rid in affected:
+            reg = self._regs.get(rid)
+            if reg is None:
+                continue
+            reg.partner = self._resolve(reg.partner_key)
+            self._drag(rid, reg, 1)
+            if reg.partner is not None:
+                refresh.add(reg.partner)
+
+        for rid in refresh:
+            self._recount(rid)
+
+    def _resolve(self, partner_key):
+        # Like PartnerIndex: the earliest registration with that name wins
+        ids = self._by_key.get(partner_key) if partner_key is not None else None
+        return min(ids) if ids else None
+
+    def _index(self, reg_id, reg):
+        for key in {reg.name_key, reg.username_key} - {None}:
+            self._by_key.setdefault(key, set()).add(reg_id)
+        if reg.partner_key is not None:
+            self._referrers.setdefault(reg.partner_key, set()).add(reg_id)
+
+    def _unindex(self, reg_id, reg):
+        del self._regs[reg_id]
+        for key in {reg.name_key, reg.username_key} - {None}:
+            self._discard(self._by_key, key, reg_id)
+        if reg.partner_key is not None:
+            self._discard(self._referrers, reg.partner_key, reg_id)
+
+    @staticmethod
+    def _discard(index, key, reg_id):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(reg_id)
+            if not ids:
+                del index[key]
+
+    def _tally(self, reg, sign):
+        self.registrations += sign
+        self.admins += sign if reg.is_admin else 0
+        self.neulings += sign if reg.is_neuling else 0
+
+    def _drag(self, reg_id, reg, sign):
+        if reg.priority and reg.partner is not None:
+            if sign > 0:
+                self._dragged_by.setdefault(reg.partner, set()).add(reg_id)
+            else:
+                self._discard(self._dragged_by, reg.partner, reg_id)
+
+    def _recount(self, reg_id):
+        guaranteed, people, seats = self._counted.pop(reg_id, (0, 0, 0))
+        self.guaranteed -= guaranteed
+        self.pool_people -= people
+        self.pool_seats -= seats
+
+        reg = self._regs.get(reg_id)
+        if reg is None:
+            self._contested.discard(reg_id)
+            return
+        if reg.priority and self._dragged_by.get(reg_id, set()) - {reg_id}:
+            self._contested.add(reg_id)
+        else:
+            self._contested.discard(reg_id)
+        if reg.priority:
+            counted = (1 + reg.guest_seats, 0, 0)
+        elif reg_id in self._dragged_by:
+            # Brought along by an admin or Neuling; their own partner is not
+            counted = (1, 0, 0)
+        else:
+            counted = (0, 1, 1 + reg.guest_seats)
+        self._counted[reg_id] = counted
+        self.guaranteed += counted[0]
+        self.pool_people += counted[1]
+        self.pool_seats += counted[2]
+
+
+_projections = {}
+# Listeners run on whichever thread wrote; previews are read on the database thread
+_lock = threading.Lock()
+
+
+def load(event_id) -> EventProjection:
+    """Build an event's projection from its PENDING registrations."""
+    with _lock:
+        projection = EventProjection(event_id)
+        for row in db.get_pending_registrations(event_id):
+            projection.apply(row['id'], row)
+        _projections[event_id] = projection
+    return projection
+
+
+def load_open_events():
+    """Build the projections of all open events (on start)."""
+    for event in db.get_events():
+        if event['is_open']:
+            load(event['id'])
+
+
+def preview(event_id) -> Optional[Preview]:
+    """The preview of an event, or None if it does not exist. Runs on the database thread."""
+    event = db.get_event(event_id)
+    if event is None:
+        return None
+    with _lock:
+        projection = _projections.get(event_id)
+        if projection is not None:
+            return projection.preview(event['seat_limit'])
+    return load(event_id).preview(event['seat_limit'])
+
+
+def _apply_changes(event_id, user_ids):
+    with _lock:
+        projection = _projections.get(event_id)
+        if projection is None:
+            return
+        for row in db.get_registrations_by_users(event_id, user_ids):
+            projection.apply(row['id'], row if row['status'] == 'PENDING' else None)
+
+
+def _on_database_change(kind, data):
+    # Runs right after the commit on the writing thread, which reads the new
+    # rows on its own connection
+    if kind in ('registration_added', 'status_changed', 'admin_changed'):
+        _apply_changes(data['event_id'], data['user_ids'])
+    elif kind == 'event_changed':
+        event = db.get_event(data['event_id'])
+        if event is None or not event['is_open']:
+            with _lock:
+                _projections.pop(data['event_id'], None)
+        elif data['event_id'] not in _projections:
+            load(data['event_id'])
+
+
+db.add_listener(_on_database_change)
+
+
+def render(preview: Preview, event_name: str) -> str:
+    """The /admin_preview message (Markdown)."""
+    text = (f"🔮 *Vorschau für '{escape_md(event_name)}'* ({preview.seat_limit} Plätze)\n\n"
+            f"Anmeldungen: {preview.registrations} (Admins: {preview.admins}, Neulinge: {preview.neulings})\n"
+            f"Garantierte Plätze (Admins, Neulinge und Begleitung): {preview.guaranteed_seats}\n"
+            f"Freie Plätze für die Verlosung: {preview.pool_capacity}\n"
+            f"In der Verlosung: {preview.pool_people} Personen, {preview.pool_seats_needed} Plätze benötigt\n")
+    ratio = preview.oversubscription
+    if preview.guaranteed_seats > preview.seat_limit:
+        text += f"\n⚠️ Schon die garantierten Plätze überschreiten das Limit um {preview.guaranteed_seats - preview.seat_limit}."
+    elif ratio is None:
+        text += "\n⚠️ Keine Plätze mehr für die Verlosung."
+    elif ratio > 1:
+        text += f"\nÜberbuchung: {ratio:.1f}×"
+    else:
+        text += "\nKeine Überbuchung: alle bekommen einen Platz."
+    return text
@@ -0,0 +1,265 @@
+"""
+Opt-in statement profiler for the SQLite layer.
+
+With DB_PROFILE=1 every connection database.py opens is a ProfilingConnection:
+each executed statement is timed (including fetching its rows), counted per
+statement text, and statements slower than DB_SLOW_QUERY_MS (default 50) are
+logged with their bound parameters and EXPLAIN QUERY PLAN output. At exit the
+per-statement totals are written to DB_PROFILE_FILE (default
+query_profile.json).
+
+Profiling wraps every execute and fetch in Python, so it is meant for load
+tests and debugging, not for production; metrics.py covers that.
+
+Usage:
+    python query_profiler.py run load_harness.py --users 2000 --concurrency 500
+    python query_profiler.py run benchmark.py db --ops 10000 --top 10
+    DB_PROFILE=1 python main.py        # then /mock_users ..., stop the bot, and
+    python query_profiler.py report --top 20
+"""
+import argparse
+import atexit
+import json
+import logging
+import os
+import re
+import runpy
+import sqlite3
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SLOW_QUERY_MS = 50.0
+DEFAULT_PROFILE_FILE = "query_profile.json"
+
+enabled = os.getenv("DB_PROFILE", "") not in ("", "0")
+slow_query_seconds = float(os.getenv("DB_SLOW_QUERY_MS") or DEFAULT_SLOW_QUERY_MS) / 1000
+profile_file = os.getenv("DB_PROFILE_FILE") or DEFAULT_PROFILE_FILE
+
+# Only these can be prefixed with EXPLAIN QUERY PLAN usefully
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+_WHITESPACE = re.compile(r'\s+')
+# IN (?, ?, ?) lists of different lengths are the same statement
+_PLACEHOLDER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+
+# statement -> [executions, total seconds, max seconds, slow executions]
+_stats = {}
+_stats_lock = threading.Lock()
+_normalized = {}
+
+
+def normalize(sql: str) -> str:
+    """The statement text stats are grouped by: whitespace and IN lists collapsed."""
+    key = _normalized.get(sql)
+    if key is None:
+        key = _PLACEHOLDER_LIST.sub('?, …', _WHITESPACE.sub(' ', sql).strip())
+        if len(_normalized) < 10000:
+            _normalized[sql] = key
+    return key
+
+
+def enable(slow_ms: float = None):
+    """Profile connections opened from now on (database.py checks `enabled`)."""
+    global enabled, slow_query_seconds
+    enabled = True
+    if slow_ms is not None:
+        slow_query_seconds = slow_ms / 1000
+
+
+def reset():
+    with _stats_lock:
+        _stats.clear()
+
+
+def stats() -> dict:
+    with _stats_lock:
+        return {sql: list(values) for sql, values in _stats.items()}
+
+
+class _Execution:
+    """One execution of a statement, whose time grows while its rows are fetched."""
+
+    __slots__ = ('connection', 'sql', 'key', 'params', 'elapsed', 'logged')
+
+    def __init__(self, connection, sql, params):
+        self.connection = connection
+        self.sql = sql
+        self.key = normalize(sql)
+        self.params = params
+        self.elapsed = 0.0
+        self.logged = False
+
+    def add(self, seconds, first=False):
+        self.elapsed += seconds
+        with _stats_lock:
+            entry = _stats.get(self.key)
+            if entry is None:
+                entry = _stats[self.key] = [0, 0.0, 0.0, 0]
+            if first:
+                entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], self.elapsed)
+            if not self.logged and self.elapsed >= slow_query_seconds:
+                entry[3] += 1
+        if not self.logged and self.elapsed >= slow_query_seconds:
+            self.logged = True
+            self._log_slow()
+
+    def _log_slow(self):
+        plan = ""
+        if self.sql.lstrip().upper().startswith(_EXPLAINABLE):
+            try:
+                # The base class method, so the EXPLAIN itself is not profiled
+                rows = sqlite3.Connection.execute(self.connection, f"EXPLAIN QUERY PLAN {self.sql}", self.params)
+                plan = "".join(f"\n    {row[3]}" for row in rows)
+            except sqlite3.Error as e:
+                plan = f"\n    (no plan: {e})"
+        logger.warning(f"Slow query ({self.elapsed * 1000:.1f} ms): {self.key} params={self.params!r}{plan}")
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """Cursor that times execute/executemany and the fetching of their rows."""
+
+    _execution = None
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        rows = list(seq_of_parameters)
+        # Logged and explained with the first row of the batch
+        return self._timed(super().executemany, sql, rows, rows[0] if rows else ())
+
+    def _timed(self, method, sql, parameters, logged_params):
+        self._execution = _Execution(self.connection, sql, logged_params)
+        started = time.perf_counter()
+        try:
+            return method(sql, parameters)
+        finally:
+            self._execution.add(time.perf_counter() - started, first=True)
+
+    def _fetch(self, method, *args):
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            if self._execution is not None:
+                self._execution.add(time.perf_counter() - started)
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._fetch(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+    def __next__(self):
+        return self._fetch(super().__next__)
+
+
+class ProfilingConnection(sqlite3.Connection):
+    """Connection whose cursors (including the execute() shortcuts) are profiled."""
+
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute creates its cursor in C, bypassing cursor()
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+# --- Reports ---
+
+def save(path: str = None):
+    """Write the per-statement totals of this process as JSON."""
+    path = path or profile_file
+    rows = [
+        {'sql': sql, 'count': count, 'total_seconds': total, 'max_seconds': longest, 'slow': slow}
+        for sql, (count, total, longest, slow) in stats().items()
+    ]
+    with open(path, 'w') as f:
+        json.dump({'slow_query_ms': slow_query_seconds * 1000, 'statements': rows}, f, indent=1)
+    return path
+
+
+def load(path: str = None) -> list:
+    with open(path or profile_file) as f:
+        return json.load(f)['statements']
+
+
+def _save_at_exit():
+    if enabled and _stats:
+        path = save()
+        logger.info(f"Query profile of {len(_stats)} statements written to {path}")
+
+
+atexit.register(_save_at_exit)
+
+SORT_KEYS = {
+    'total': lambda row: row['total_seconds'],
+    'mean': lambda row: row['total_seconds'] / max(row['count'], 1),
+    'max': lambda row: row['max_seconds'],
+    'count': lambda row: row['count'],
+}
+
+
+def print_report(rows: list, top: int = 20, sort: str = 'total', width: int = 110):
+    rows = sorted(rows, key=SORT_KEYS[sort], reverse=True)
+    grand_total = sum(row['total_seconds'] for row in rows) or 1.0
+    print(f"{len(rows)} statements, {sum(row['count'] for row in rows)} executions, "
+          f"{grand_total:.3f}s in SQLite; top {min(top, len(rows))} by {sort}:")
+    print(f"{'count':>8} {'total ms':>10} {'%':>5} {'mean ms':>9} {'max ms':>9} {'slow':>5}  statement")
+    for row in rows[:top]:
+        mean = row['total_seconds'] / max(row['count'], 1)
+        sql = row['sql'] if len(row['sql']) <= width else row['sql'][:width - 1] + "…"
+        print(f"{row['count']:>8} {row['total_seconds'] * 1000:>10.1f} {row['total_seconds'] / grand_total * 100:>5.1f} "
+              f"{mean * 1000:>9.3f} {row['max_seconds'] * 1000:>9.1f} {row['slow']:>5}  {sql}")
+
+
+def _run_script(argv, slow_ms):
+    """Run a Python script (e.g. load_harness.py) in this process with profiling on."""
+    enable(slow_ms)
+    script = argv[0]
+    sys.argv = list(argv)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            print(f"{script} exited with status {e.code}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="SQLite statement profiler")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('run', help="Run a script with profiling and print the most expensive statements")
+    p.add_argument("--top", type=int, default=20)
+    p.add_argument("--sort", choices=sorted(SORT_KEYS), default='total')
+    p.add_argument("--slow-ms", type=float, default=None, help=f"Slow query threshold (default {DEFAULT_SLOW_QUERY_MS})")
+    p.add_argument("script", help="e.g. load_harness.py")
+    p.add_argument("args", nargs=argparse.REMAINDER)
+
+    p = sub.add_parser('report', help="Print the most expensive statements of a saved profile")
+    p.add_argument("--file", default=None, help=f"Profile written at exit (default {DEFAULT_PROFILE_FILE})")
+    p.add_argument("--top", type=int, default=20)
+    p.add_argument("--sort", choices=sorted(SORT_KEYS), default='total')
+
+    args = parser.parse_args()
+    # database.py imports this file as `query_profiler`, not `__main__`;
+    # the profiled connections record into that module
+    import query_profiler as profiler
+    if args.command == 'run':
+        profiler._run_script([args.script] + args.args, args.slow_ms)
+        print()
+        profiler.print_report([{'sql': sql, 'count': c, 'total_seconds': t, 'max_seconds': m, 'slow': s}
+                               for sql, (c, t, m, s) in profiler.stats().items()], args.top, args.sort)
+    else:
+        profiler.print_report(profiler.load(args.file), args.top, args.sort)
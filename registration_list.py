@@ -0,0 +1,92 @@
+"""
+Paged rendering of an event's registrations for /admin_list.
+
+Seat and status totals come from the event's counters
+(database.get_event_counters); the rows of a page are streamed from a cursor
+until the page is full, so an event of any size costs one Telegram-sized
+page per request. Pages are linked with keyset (id-anchored) ◀️/▶️ buttons.
+
+render_page runs on the database thread: call it through async_db.run.
+"""
+from contextlib import closing
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import database as db
+from formatting import escape_md
+
+# Telegram allows 4096 characters per message; leave room for the header
+PAGE_CHAR_BUDGET = 3500
+
+CALLBACK_PREFIX = "listpage_"
+
+
+def format_registration(reg) -> str:
+    icon = "✅" if reg['status'] == 'ACCEPTED' else "⏳" if reg['status'] == 'PENDING' else "❌" if reg['status'] == 'CANCELLED' else "📝"
+    safe_name = escape_md(reg['full_name'])
+    safe_username = escape_md(reg['username'])
+    safe_partner = escape_md(reg['partner_name'])
+
+    partner_str = f" (Begleitung: {safe_partner})" if safe_partner else ""
+    neuling = " [Neuling]" if reg['is_neuling'] else ""
+    admin = " [Admin]" if reg['is_admin'] else ""
+
+    return f"{icon} {safe_name} (@{safe_username}){partner_str}{neuling}{admin} - {reg['status']}\n"
+
+
+def _header(event_id, safe_event_name):
+    counts = db.get_event_counters(event_id)
+    if not counts:
+        return None
+    seats = sum(row['registrations'] + row['partner_seats'] for row in counts)
+    per_status = " · ".join(f"{row['status']}: {row['registrations']}" for row in counts)
+    return f"📋 *Registrierungen für {safe_event_name} ({seats} Plätze):*\n{per_status}\n\n"
+
+
+def render_page(event_id, safe_event_name, after_id=None, before_id=None):
+    """
+    Render one page of registrations.
+
+    Without anchors this is the first page. after_id renders the page
+    following that registration, before_id the page preceding it.
+
+    Returns (text, reply_markup), or None if the event has no registrations.
+    """
+    header = _header(event_id, safe_event_name)
+    if header is None:
+        return None
+
+    lines = []
+    used = len(header)
+    more = False
+    with closing(db.iter_event_registrations(event_id, after_id=after_id, before_id=before_id)) as rows:
+        for reg in rows:
+            line = format_registration(reg)
+            if lines and used + len(line) > PAGE_CHAR_BUDGET:
+                more = True
+                break
+            lines.append((reg['id'], line))
+            used += len(line)
+
+    if before_id is not None:
+        # Rows came newest-first; the anchor itself proves a next page exists
+        lines.reverse()
+        has_prev, has_next = more, True
+    else:
+        has_next = more
+        has_prev = bool(lines) and after_id is not None and db.has_registrations_before(event_id, lines[0][0])
+
+    buttons = []
+    if lines and has_prev:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"{CALLBACK_PREFIX}{event_id}_p_{lines[0][0]}"))
+    if lines and has_next:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"{CALLBACK_PREFIX}{event_id}_n_{lines[-1][0]}"))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+
+    return header + "".join(line for _, line in lines), reply_markup
+
+
+def parse_callback(data):
+    """Split 'listpage_<event_id>_<n|p>_<anchor_id>' into its parts."""
+    event_id, direction, anchor = data[len(CALLBACK_PREFIX):].split('_')
+    return int(event_id), direction, int(anchor)
@@ -0,0 +1,125 @@
+"""
+Update processing that is concurrent across users but ordered per user.
+
+With concurrent updates, two quick taps of the same user could run
+neuling_response twice at once or cancel a registration twice.
+KeyedUpdateProcessor runs updates that share a key one after another, in
+arrival order, and everything else in parallel:
+
+- every update from a user is keyed by that user
+- admin event callbacks (admin_open_/admin_close_/admin_list_<event_id>) are
+  keyed by their event instead, so two admins cannot close one event at
+  once, while one admin can close several events in parallel
+
+The concurrency limit is only taken once an update holds its keys, so a flood
+from one user queues behind that user instead of occupying every slot.
+
+An optional recorder (update_recorder.UpdateRecorder) is told about every
+handled update with the time it waited and the time its handler took.
+"""
+import asyncio
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+ADMIN_EVENT_PREFIXES = ("admin_open_", "admin_close_", "admin_list_")
+
+# PTB's own semaphore is taken before do_process_update; keep it out of the way
+_UNBOUNDED = 2 ** 31 - 1
+
+
+def update_keys(update) -> tuple:
+    """The serialization keys of an update (at most one, so no lock-order deadlocks)."""
+    if not isinstance(update, Update):
+        return ()
+    query = update.callback_query
+    if query and query.data and query.data.startswith(ADMIN_EVENT_PREFIXES):
+        event_id = query.data.rsplit('_', 1)[1]
+        if event_id.isdigit():
+            return (('event', int(event_id)),)
+    if update.effective_user:
+        return (('user', update.effective_user.id),)
+    return ()
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Processes at most `max_concurrent_updates` updates at once, one per key."""
+
+    def __init__(self, max_concurrent_updates: int, recorder=None):
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates must be a positive integer")
+        self._limit = max_concurrent_updates
+        self.recorder = recorder
+        super().__init__(_UNBOUNDED)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # key -> [lock, number of updates holding or waiting for it]
+        self._locks = {}
+        self._running = 0
+
+    @property
+    def max_concurrent_updates(self) -> int:
+        return self._limit
+
+    @property
+    def current_concurrent_updates(self) -> int:
+        return self._running
+
+    @property
+    def waiting_keys(self) -> int:
+        """Keys that currently have an update running or queued."""
+        return len(self._locks)
+
+    async def _lock(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._forget(key, entry)
+            raise
+
+    def _unlock(self, key):
+        entry = self._locks[key]
+        entry[0].release()
+        self._forget(key, entry)
+
+    def _forget(self, key, entry):
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[key]
+
+    async def do_process_update(self, update, coroutine) -> None:
+        arrived = time.time()
+        received = time.perf_counter()
+        held = []
+        started = False
+        try:
+            for key in update_keys(update):
+                await self._lock(key)
+                held.append(key)
+            async with self._slots:
+                self._running += 1
+                started = True
+                began = time.perf_counter()
+                try:
+                    await coroutine
+                finally:
+                    self._running -= 1
+                    if self.recorder is not None:
+                        finished = time.perf_counter()
+                        self.recorder.record(update, arrived, began - received, finished - began)
+        finally:
+            for key in reversed(held):
+                self._unlock(key)
+            if not started:
+                # Cancelled while queued: the handler coroutine never ran
+                coroutine.close()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
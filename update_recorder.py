@@ -0,0 +1,407 @@
+"""
+Record-and-replay of real update streams, for regression benchmarks.
+
+Synthetic flows (mock_users, load_harness, fake_bot_api scripts) never
+double-tap, abandon a conversation or /cancel in the middle of one. With
+UPDATE_RECORD_FILE set, the bot appends every update it handles to a JSON
+lines log instead: when it arrived, how long it waited for its turn
+(update_processor), and how long its handler took. Each start of the bot
+begins with a session line listing the events as they were.
+
+The log holds no personal data:
+- user ids are replaced by a keyed hash (UPDATE_RECORD_SALT; without it a
+  random key per start, so a user is only recognisable within one session)
+- names are not recorded at all; the replay uses fake_bot_api's "User <id>"
+- text that is not a command (partner names) becomes "@user<id>" when it
+  names one of the last MAX_NAMES users seen, otherwise "Gast <hash>", so
+  partner matching behaves the same on replay; only keyed hashes of the
+  names are kept in memory for that
+
+Replay feeds a log through the real handlers against fake_bot_api and a
+fresh database, as fast as possible (order is kept per user; admin updates
+wait for everything before them) or with the original timing, and writes a
+report of throughput and handling latency per handler. compare checks two
+reports, e.g. of the same log replayed on two versions of the bot.
+
+Usage:
+    UPDATE_RECORD_FILE=updates.log UPDATE_RECORD_SALT=... python main.py
+    python update_recorder.py report updates.log
+    python update_recorder.py replay updates.log [--timing asap|original] [--speed 1] --out new.json
+    python update_recorder.py compare old.json new.json [--threshold 0.1]
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import re
+import secrets
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from partners import normalize_name, normalize_partner_name
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLD = 0.10
+# Idle time between recorded updates longer than this is skipped on replay
+DEFAULT_MAX_GAP = 10.0
+# Names of recently seen users kept to recognise them as partner names
+MAX_NAMES = 20000
+
+_DIGITS = re.compile(r'\d+')
+
+
+class UpdateRecorder:
+    """
+    Writes one line per handled update (see the module docstring).
+
+    record() runs on the event loop, so it only builds the entry and queues
+    it; a background thread serializes and appends the lines. With
+    path=None the records are kept in `records` instead, which is how
+    replay() measures the handlers.
+    """
+
+    def __init__(self, path: Optional[str] = None, admin_ids=(), salt: Optional[str] = None, events=()):
+        self.path = path
+        self.admin_ids = set(admin_ids)
+        self._key = (salt or secrets.token_hex(16)).encode()
+        # keyed hash of a normalized name or username -> (pseudonym, matched
+        # by username), least recently seen first; no real names are held
+        self._names = OrderedDict()
+        self.records = []
+        self._file = None
+        self._queue = queue.SimpleQueue()
+        self._writer = None
+        if path is not None:
+            self._file = open(path, 'a', encoding='utf-8')
+            self._writer = threading.Thread(target=self._write_lines, name="update-recorder", daemon=True)
+            self._writer.start()
+            self._queue.put({'session': round(time.time(), 3),
+                             'events': [[e['id'], e['name'], e['seat_limit'], e['is_open']] for e in events]})
+
+    def pseudonym(self, user_id: int) -> int:
+        digest = hmac.new(self._key, str(user_id).encode(), hashlib.sha256).digest()
+        # Stays clear of the ids fake_bot_api and the benchmarks use
+        return 10 ** 12 + int.from_bytes(digest[:5], 'big')
+
+    def record(self, update, arrived: float, waited: float, handled: float):
+        """One handled update: arrival (epoch seconds), seconds queued and in the handler."""
+        entry = self._entry(update)
+        if entry is None:
+            return
+        entry.update(t=round(arrived, 3), w=round(waited * 1000, 2), h=round(handled * 1000, 2))
+        if self._writer is not None:
+            self._queue.put(entry)
+        else:
+            self.records.append(entry)
+
+    def _entry(self, update) -> Optional[dict]:
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            return None
+        pseudonym = self.pseudonym(user.id)
+        for key, by_username in ((normalize_name(user.full_name), False), (normalize_name(user.username), True)):
+            if key:
+                name = self._hash(key)
+                self._names[name] = (pseudonym, by_username)
+                self._names.move_to_end(name)
+        while len(self._names) > MAX_NAMES:
+            self._names.popitem(last=False)
+
+        entry = {'u': pseudonym}
+        if user.id in self.admin_ids:
+            entry['a'] = 1
+        if update.callback_query is not None:
+            entry['k'] = 'c'
+            entry['x'] = update.callback_query.data or ''
+            return entry
+        message = update.message
+        if message is None or message.text is None:
+            return None
+        entry['k'] = 'm'
+        entry['x'] = message.text if message.text.startswith('/') else self._anonymize_text(message.text)
+        if message.chat.type != 'private':
+            entry['c'] = message.chat.type
+        return entry
+
+    def _hash(self, name: str) -> str:
+        return hmac.new(self._key, name.encode(), hashlib.sha256).hexdigest()
+
+    def _anonymize_text(self, text: str) -> str:
+        name = self._hash(normalize_partner_name(text) or '')
+        known = self._names.get(name)
+        if known is not None:
+            pseudonym, by_username = known
+            return f"@user{pseudonym}" if by_username else f"User {pseudonym}"
+        return f"Gast {name[:8]}"
+
+    def _write_lines(self):
+        # Runs on the writer thread until close() queues None
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                break
+            try:
+                self._file.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + "\n")
+                if self._queue.empty():
+                    self._file.flush()
+            except Exception:
+                logger.exception("Failed to write update record")
+        self._file.close()
+
+    def close(self):
+        """Write the queued records and close the log."""
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+            self._file = None
+
+
+def read_log(path: str) -> tuple:
+    """The events of the first session and every update record of a log."""
+    events = None
+    records = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if 'session' in entry:
+                if events is None:
+                    events = entry['events']
+            else:
+                records.append(entry)
+    return events or [], records
+
+
+def handler_label(entry: dict) -> str:
+    """What a record is grouped by in reports: the command, or the callback data without ids."""
+    if entry['k'] == 'm':
+        return entry['x'].split()[0].split('@')[0] if entry['x'].startswith('/') else 'text'
+    return _DIGITS.sub('#', entry['x']) or 'callback'
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def summarize(records: list, elapsed: Optional[float] = None) -> dict:
+    """Throughput and handling latency (ms) overall and per handler label."""
+    groups = {'all': []}
+    for entry in records:
+        groups['all'].append(entry['h'])
+        groups.setdefault(handler_label(entry), []).append(entry['h'])
+    handlers = {}
+    for label, values in groups.items():
+        values.sort()
+        handlers[label] = {
+            'count': len(values),
+            'mean_ms': sum(values) / len(values) if values else 0.0,
+            'p50_ms': _percentile(values, 50),
+            'p95_ms': _percentile(values, 95),
+            'p99_ms': _percentile(values, 99),
+        }
+    if elapsed is None and records:
+        elapsed = max(entry['t'] for entry in records) - min(entry['t'] for entry in records)
+    return {
+        'updates': len(records),
+        'seconds': elapsed or 0.0,
+        'updates_per_second': len(records) / elapsed if elapsed else 0.0,
+        'handlers': handlers,
+    }
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# --- Replay ---
+
+async def replay(path: str, timing: str = 'asap', speed: float = 1.0, concurrency: int = 32,
+                 latency: float = 0.0, max_gap: float = DEFAULT_MAX_GAP) -> dict:
+    """
+    Feed a recorded log through the real Application against fake_bot_api
+    and a fresh temporary database; returns a summarize() report.
+
+    timing='asap' pushes updates as fast as they are taken, keeping each
+    user's order; updates of admins wait until everything before them is
+    handled, so e.g. registrations recorded before a close stay before it.
+    timing='original' keeps the recorded gaps (divided by speed, idle time
+    capped at max_gap).
+    """
+    # main pulls in python-telegram-bot; only load it for replays
+    import async_db as adb
+    import database as db
+    import event_catalog
+    import main
+    from fake_bot_api import FakeBotAPI, callback_update, message_update
+    from update_processor import KeyedUpdateProcessor
+
+    events, records = read_log(path)
+    if not records:
+        raise ValueError(f"{path} has no updates")
+
+    db.DB_NAME = os.path.join(tempfile.mkdtemp(prefix="whipbot_replay_"), "replay.db")
+    await adb.run(db.init_db)
+    for event_id, name, seat_limit, is_open in events:
+        await adb.create_event(name, seat_limit=seat_limit, event_id=event_id)
+        if is_open:
+            await adb.set_event_open(event_id, True)
+    event_catalog.invalidate()
+    main.ADMIN_IDS = sorted({entry['u'] for entry in records if entry.get('a')})
+
+    measured = UpdateRecorder()
+    api = FakeBotAPI(latency=latency).start()
+    application = main.build_application(FakeBotAPI.TOKEN, base_url=api.base_url,
+                                         concurrent_updates=KeyedUpdateProcessor(concurrency, recorder=measured))
+    await application.initialize()
+    await application.updater.start_polling(poll_interval=0.0, timeout=5)
+    await application.start()
+    # Only run_polling() calls this; the outbox delivers allocation messages
+    await main.post_init(application)
+
+    async def handled(count):
+        while len(measured.records) < count:
+            await asyncio.sleep(0.005)
+
+    started = time.perf_counter()
+    try:
+        clock = 0.0
+        previous = records[0]['t']
+        for pushed, entry in enumerate(records):
+            if timing == 'original':
+                clock += min(max(entry['t'] - previous, 0.0), max_gap) / speed
+                previous = entry['t']
+                delay = started + clock - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif entry.get('a'):
+                await handled(pushed)
+            if entry['k'] == 'm':
+                update = message_update(entry['u'], entry['x'], entry.get('c', 'private'))
+            else:
+                update = callback_update(entry['u'], entry['x'])
+            api.push_update(update)
+            if timing != 'original' and entry.get('a'):
+                await handled(pushed + 1)
+        await handled(len(records))
+        elapsed = time.perf_counter() - started
+    finally:
+        await application.updater.stop()
+        await main.post_stop(application)
+        await application.stop()
+        await application.shutdown()
+        api.stop()
+        db.close_all_connections()
+
+    report = summarize(measured.records, elapsed)
+    report.update(source=os.path.basename(path), timing=timing, revision=_git_revision(),
+                  concurrency=concurrency, latency_ms=latency * 1000)
+    return report
+
+
+# --- Reports ---
+
+def print_report(report: dict, top: int = 15):
+    print(f"{report['updates']} updates in {report['seconds']:.2f}s, {report['updates_per_second']:,.1f} updates/s")
+    print(f"{'handler':<32}{'count':>7}{'mean ms':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    rows = sorted(report['handlers'].items(), key=lambda item: item[1]['count'] * item[1]['mean_ms'], reverse=True)
+    for label, stats in rows[:top + 1]:
+        print(f"{label:<32}{stats['count']:>7}{stats['mean_ms']:>10.2f}{stats['p50_ms']:>9.2f}"
+              f"{stats['p95_ms']:>9.2f}{stats['p99_ms']:>9.2f}")
+
+
+def compare(old: dict, new: dict, threshold: float = DEFAULT_THRESHOLD) -> list:
+    """
+    Regressions of `new` against `old`: throughput lower, or a handler's p50
+    or p95 higher, by more than `threshold`. Returns (what, old, new) tuples.
+    """
+    regressions = []
+    if old['updates_per_second'] and new['updates_per_second'] < old['updates_per_second'] * (1 - threshold):
+        regressions.append(("updates/s", old['updates_per_second'], new['updates_per_second']))
+    for label, before in old['handlers'].items():
+        after = new['handlers'].get(label)
+        if after is None:
+            continue
+        for stat in ('p50_ms', 'p95_ms'):
+            # Sub-millisecond handlers are all noise
+            if after[stat] > max(before[stat], 1.0) * (1 + threshold):
+                regressions.append((f"{label} {stat}", before[stat], after[stat]))
+    return regressions
+
+
+def print_comparison(old: dict, new: dict, threshold: float = DEFAULT_THRESHOLD) -> list:
+    print(f"{old.get('revision', '?')} -> {new.get('revision', '?')}: updates/s "
+          f"{old['updates_per_second']:,.1f} -> {new['updates_per_second']:,.1f}")
+    print(f"{'handler':<32}{'p50 ms':>18}{'p95 ms':>18}")
+    for label, before in sorted(old['handlers'].items()):
+        after = new['handlers'].get(label)
+        if after is not None:
+            print(f"{label:<32}{before['p50_ms']:>8.2f} -> {after['p50_ms']:<7.2f}"
+                  f"{before['p95_ms']:>8.2f} -> {after['p95_ms']:<7.2f}")
+    regressions = compare(old, new, threshold)
+    if regressions:
+        print(f"\n{len(regressions)} regressions (more than {threshold:.0%}):")
+        for what, before, after in regressions:
+            print(f"  {what}: {before:,.2f} -> {after:,.2f}")
+    else:
+        print(f"\nNo regressions (threshold {threshold:.0%})")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Record-and-replay of update streams")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('report', help="Handling times as recorded")
+    p.add_argument("log")
+
+    p = sub.add_parser('replay', help="Replay a log against a fresh database and report")
+    p.add_argument("log")
+    p.add_argument("--timing", choices=['asap', 'original'], default='asap')
+    p.add_argument("--speed", type=float, default=1.0, help="Speed-up of --timing original")
+    p.add_argument("--max-gap", type=float, default=DEFAULT_MAX_GAP, help="Longest idle time kept (seconds)")
+    p.add_argument("--concurrency", type=int, default=32)
+    p.add_argument("--latency-ms", type=float, default=0.0, help="Simulated Bot API round trip")
+    p.add_argument("--out", default=None, help="Write the report as JSON, for compare")
+
+    p = sub.add_parser('compare', help="Throughput and latency regressions between two replay reports")
+    p.add_argument("old")
+    p.add_argument("new")
+    p.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+
+    args = parser.parse_args()
+    if args.command == 'report':
+        print_report(summarize(read_log(args.log)[1]))
+    elif args.command == 'replay':
+        # Before main.py's basicConfig, which would log every request at INFO
+        logging.basicConfig(level=logging.WARNING)
+        result = asyncio.run(replay(args.log, args.timing, args.speed, args.concurrency,
+                                    args.latency_ms / 1000, args.max_gap))
+        print_report(result)
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump(result, f, indent=1)
+    else:
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        if print_comparison(old, new, args.threshold):
+            sys.exit(1)
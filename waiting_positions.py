@@ -0,0 +1,124 @@
+"""
+Waiting-list positions for /status.
+
+Counting the WAITING registrations ahead of someone walks the index entry by
+entry (about 17 ms at position 66,000), and /status is sent by everyone on
+the waiting list at once right after the allocation notifications go out.
+Instead each event's waiting list is ranked once, in the order offers are
+made (database.get_waiting_order), and kept in memory:
+
+- user_ids: the ranked users sorted by user id, and slots: their rank, so a
+  user's rank is found by bisection without a dict of boxed ints
+- a Fenwick tree over the ranks counting who is still WAITING, so a position
+  is a prefix sum and someone leaving the list (an offer, a cancellation)
+  is an O(log n) update instead of renumbering everyone behind them
+
+The database listener applies small status changes in place. A bulk change
+(an allocation) or someone joining the list who was not ranked drops the
+event's ranking; it is rebuilt on the next lookup.
+"""
+import threading
+from array import array
+from bisect import bisect_left
+from typing import Optional
+
+import database as db
+
+# Status changes beyond this many users at once drop the ranking rather than
+# look every user up again
+MAX_INCREMENTAL_CHANGES = 500
+
+
+class WaitingRanks:
+    """Positions on one event's waiting list."""
+
+    __slots__ = ('user_ids', 'slots', 'waiting', 'tree')
+
+    def __init__(self, order: list):
+        """order: user ids of the WAITING registrations, first in line first."""
+        by_user = sorted(range(len(order)), key=order.__getitem__)
+        self.user_ids = array('q', [order[slot] for slot in by_user])
+        self.slots = array('i', by_user)
+        self.waiting = bytearray(b'\x01') * len(order)
+        # Fenwick tree (1-based) over all ones: node i covers i & -i slots
+        self.tree = array('i', [i & -i for i in range(len(order) + 1)])
+
+    def _slot(self, user_id) -> Optional[int]:
+        i = bisect_left(self.user_ids, user_id)
+        if i < len(self.user_ids) and self.user_ids[i] == user_id:
+            return self.slots[i]
+        return None
+
+    def _add(self, slot, delta):
+        i = slot + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def position(self, user_id) -> Optional[int]:
+        """1-based position of a WAITING user, or None if they are not waiting."""
+        slot = self._slot(user_id)
+        if slot is None or not self.waiting[slot]:
+            return None
+        position = 0
+        i = slot + 1
+        while i:
+            position += self.tree[i]
+            i -= i & -i
+        return position
+
+    def set_waiting(self, user_id, waiting: bool) -> bool:
+        """Record that a user joined or left the list; False if they were never ranked and joined."""
+        slot = self._slot(user_id)
+        if slot is None:
+            return not waiting
+        if self.waiting[slot] != waiting:
+            self.waiting[slot] = waiting
+            self._add(slot, 1 if waiting else -1)
+        return True
+
+
+_ranks = {}
+# Listeners run on whichever thread wrote; positions are read on the database thread
+_lock = threading.Lock()
+
+
+def _load(event_id) -> WaitingRanks:
+    ranks = WaitingRanks(db.get_waiting_order(event_id))
+    _ranks[event_id] = ranks
+    return ranks
+
+
+def get_positions(user_id, event_ids) -> dict:
+    """event_id -> waiting-list position of the user in those events. Runs on the database thread."""
+    positions = {}
+    with _lock:
+        for event_id in event_ids:
+            ranks = _ranks.get(event_id) or _load(event_id)
+            positions[event_id] = ranks.position(user_id)
+    return positions
+
+
+def _apply_changes(event_id, user_ids):
+    with _lock:
+        ranks = _ranks.get(event_id)
+        if ranks is None:
+            return
+        if len(user_ids) > MAX_INCREMENTAL_CHANGES:
+            del _ranks[event_id]
+            return
+        for row in db.get_registrations_by_users(event_id, user_ids):
+            if not ranks.set_waiting(row['user_id'], row['status'] == 'WAITING'):
+                del _ranks[event_id]
+                return
+
+
+def _on_database_change(kind, data):
+    # Runs right after the commit on the writing thread, which reads the new
+    # rows on its own connection. New registrations are PENDING and never
+    # on a waiting list.
+    if kind == 'status_changed':
+        _apply_changes(data['event_id'], data['user_ids'])
+
+
+db.add_listener(_on_database_change)
@@ -0,0 +1,144 @@
+"""
+Waiting-list offers with deadlines.
+
+When seats free up (a cancellation, a declined or expired offer), every free
+seat is offered at once to the next people on the waiting list, in
+registration order. Each offer has a deadline. The deadline is stored in the
+registration (offer_expires_at) and enforced by a job on the application's
+JobQueue; on start-up restore_offers() re-creates the jobs of offers still
+open, so pending timers survive a restart.
+
+Seat accounting matches allocation: an ACCEPTED or OFFERED registration
+takes one seat, plus one for a partner who holds no registration themselves
+(a cancelled, declined or expired one does not count). The seats in use come
+from the event's counters (database.get_seats_taken), which follow that rule
+as partners cancel, so only the waiting list itself is read.
+"""
+import logging
+import time
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import ContextTypes
+
+import async_db as adb
+import database as db
+import event_catalog
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OFFER_TIMEOUT_MINUTES = 120
+
+# Set from main.py (OFFER_TIMEOUT_MINUTES)
+offer_timeout_seconds = DEFAULT_OFFER_TIMEOUT_MINUTES * 60
+
+
+def _seats_needed(reg):
+    return 1 + reg['partner_seat']
+
+
+def _create_offers(event_id, seat_limit, expires_at):
+    # Runs on the database thread: reads the seat usage and claims the next
+    # waiting registrations in one transaction, so two concurrent calls can
+    # never hand out the same seat twice
+    with db.transaction():
+        free = seat_limit - db.get_seats_taken(event_id, ('ACCEPTED', 'OFFERED'))
+
+        offered = []
+        for reg in db.get_waiting_list(event_id):
+            if free <= 0:
+                break
+            needed = _seats_needed(reg)
+            if needed > free:
+                # Not enough room for this person and their guest; try the next
+                continue
+            offered.append(reg)
+            free -= needed
+
+        db.offer_seats(event_id, [r['user_id'] for r in offered], expires_at)
+        return offered
+
+
+def _job_name(user_id, event_id):
+    return f"offer_expiry_{event_id}_{user_id}"
+
+
+def schedule_expiry(job_queue, user_id, event_id, expires_at):
+    if job_queue is None:
+        # No JobQueue (e.g. mock contexts); restore_offers picks it up on start
+        logger.warning(f"No job queue, offer for {user_id} in event {event_id} will not expire until restart")
+        return
+    job_queue.run_once(
+        expire_offer,
+        when=max(0.0, expires_at - time.time()),
+        data={'user_id': user_id, 'event_id': event_id},
+        name=_job_name(user_id, event_id)
+    )
+
+
+def cancel_expiry(job_queue, user_id, event_id):
+    if job_queue is None:
+        return
+    for job in job_queue.get_jobs_by_name(_job_name(user_id, event_id)):
+        job.schedule_removal()
+
+
+async def fill_free_seats(context: ContextTypes.DEFAULT_TYPE, event_id):
+    """Offer every currently free seat of an event to the waiting list."""
+    event = (await event_catalog.snapshot()).get(event_id)
+    if not event:
+        return []
+
+    expires_at = time.time() + offer_timeout_seconds
+    offered = await adb.run(_create_offers, event_id, event['seat_limit'], expires_at)
+    if offered:
+        metrics.OFFERS.inc(amount=len(offered))
+
+    keyboard = [
+        [InlineKeyboardButton("Annehmen", callback_data=f'offer_accept_{event_id}')],
+        [InlineKeyboardButton("Ablehnen", callback_data=f'offer_deny_{event_id}')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    minutes = int(offer_timeout_seconds // 60)
+
+    for reg in offered:
+        schedule_expiry(context.job_queue, reg['user_id'], event_id, expires_at)
+        try:
+            await context.bot.send_message(
+                chat_id=reg['user_id'],
+                text=f"Ein Platz für '{event['name']}' ist frei geworden! Möchtest du ihn annehmen?\n\n"
+                     f"⏰ Das Angebot gilt {minutes} Minuten.",
+                reply_markup=reply_markup
+            )
+        except Exception as e:
+            logger.error(f"Failed to notify {reg['user_id']}: {e}")
+    return offered
+
+
+async def expire_offer(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue callback: expire an unanswered offer and pass the seat on."""
+    user_id = context.job.data['user_id']
+    event_id = context.job.data['event_id']
+    if not await adb.resolve_offer(user_id, event_id, 'EXPIRED'):
+        # Answered (or cancelled) in the meantime
+        return
+
+    event = (await event_catalog.snapshot()).get(event_id)
+    try:
+        await context.bot.send_message(
+            chat_id=user_id,
+            text=f"⌛ Dein Angebot für '{event['name'] if event else event_id}' ist abgelaufen. Der Platz geht an die nächste Person."
+        )
+    except Exception as e:
+        logger.error(f"Failed to notify {user_id} about expired offer: {e}")
+    await fill_free_seats(context, event_id)
+
+
+async def restore_offers(application):
+    """Re-schedule expiry jobs for offers still open in the database."""
+    offers = await adb.get_open_offers()
+    for offer in offers:
+        expires_at = offer['offer_expires_at'] or time.time()
+        schedule_expiry(application.job_queue, offer['user_id'], offer['event_id'], expires_at)
+    if offers:
+        logger.info(f"Restored {len(offers)} open waiting-list offers")